@@ -0,0 +1,229 @@
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import chess
+import chess.pgn
+import numpy as np
+
+from chess_jepa.pgn import board_state, extract_training_tokens, game_training_samples, read_mainline
+from chess_jepa.replay import replay_games
+from chess_jepa.storage import TokenWriter
+from chess_jepa.tokenizer import encode_batch, encode_game, game_samples_count, sample_length
+
+
+def generate_corpus(games: int, seed: int) -> str:
+    """
+    A fixed PGN corpus of random legal games (the same for a seed and python-chess version),
+    with Lichess-like headers, clock comments and a few variations.
+    """
+    rng = random.Random(seed)
+    texts = []
+    for number in range(games):
+        game = chess.pgn.Game()
+        game.headers["Event"] = "Rated Blitz game"
+        game.headers["White"] = f"white{number}"
+        game.headers["Black"] = f"black{number}"
+        game.headers["WhiteElo"] = str(rng.randint(1800, 2900))
+        game.headers["BlackElo"] = str(rng.randint(1800, 2900))
+        game.headers["TimeControl"] = rng.choice(["180+0", "300+3", "600+5"])
+        board, node = chess.Board(), game
+        for _ in range(rng.randint(20, 160)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            move = rng.choice(moves)
+            node = node.add_variation(move)
+            node.comment = f"[%clk 0:0{rng.randint(0, 9)}:{rng.randint(10, 59)}]"
+            if rng.random() < 0.02 and len(moves) > 1:
+                node.parent.add_variation(moves[0] if moves[0] != move else moves[1])
+            board.push(move)
+        outcome = board.outcome()
+        game.headers["Result"] = outcome.result() if outcome else rng.choice(["1-0", "0-1", "1/2-1/2"])
+        texts.append(str(game))
+    return "\n\n".join(texts) + "\n"
+
+
+def measure(function, repeat: int):
+    # Best time of repeat runs, and the result of the last one
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def rates(seconds: float, games=0, plies=0, samples=0, tokens=0, bytes=0) -> dict:
+    stage = {"seconds": seconds}
+    for name, count in (("games", games), ("plies", plies), ("samples", samples), ("tokens", tokens), ("bytes", bytes)):
+        if count:
+            stage[f"{name}_per_second"] = count / seconds
+    return stage
+
+
+def run_benchmarks(text: str, window_size: int, repeat: int, legacy: bool) -> dict:
+    stages = {}
+
+    # PGN parse: mainline moves of every game as move codes
+    seconds, games = measure(lambda: list(read_mainline(text)), repeat)
+    size = len(text.encode())
+    games = [(headers, codes) for headers, codes in games if len(codes)]
+    moves = [codes for _, codes in games]
+    plies = sum(len(codes) for codes in moves)
+    samples = sum(game_samples_count(len(codes), window_size) for codes in moves)
+    tokens = samples * sample_length(window_size)
+    stages["parse"] = rates(seconds, games=len(games), plies=plies, bytes=size)
+
+    if legacy:
+        # The python-chess game tree parser, for reference
+        def parse_games():
+            stream = io.StringIO(text)
+            while chess.pgn.read_game(stream) is not None:
+                pass
+
+        seconds, _ = measure(parse_games, 1)
+        stages["parse_chess_pgn"] = rates(seconds, games=len(games), bytes=size)
+
+    # Board replay: the board states before every move of every game
+    starts = [board_state(chess.pgn.Headers(headers).board()) for headers, _ in games]
+    seconds, (states, offsets) = measure(lambda: replay_games(moves, starts), repeat)
+    stages["replay"] = rates(seconds, games=len(games), plies=plies)
+
+    # FEN generation: training samples as strings of the parsed games (python-chess boards and FEN)
+    parsed = [
+        (headers, [chess.Move(code & 63, (code >> 6) & 63, (code >> 12) or None) for code in codes.tolist()])
+        for headers, codes in games
+    ]
+
+    def fen_samples():
+        return [sample for headers, game in parsed for sample in game_training_samples(headers, game, window_size)]
+
+    seconds, strings = measure(fen_samples, repeat)
+    stages["fen"] = rates(seconds, games=len(games), plies=plies, samples=len(strings))
+
+    # Encode: the samples strings, or straight from the replayed board states
+    seconds, encoded = measure(lambda: encode_batch(strings, dtype=np.uint8), repeat)
+    stages["encode_strings"] = rates(seconds, samples=len(strings), tokens=encoded.size)
+
+    def encode_games():
+        results = [headers.get("Result", "*") for headers, _ in games]
+        return [
+            encode_game(states[offsets[index] : offsets[index + 1]], codes, results[index], window_size, out=None)
+            for index, codes in enumerate(moves)
+        ]
+
+    seconds, _ = measure(encode_games, repeat)
+    stages["encode_boards"] = rates(seconds, games=len(games), samples=samples, tokens=tokens)
+
+    # Write: the encoded samples to a token file
+    def write():
+        with tempfile.TemporaryDirectory() as directory:
+            with TokenWriter(os.path.join(directory, "tokens.bin"), window_size, encoded.shape[1]) as writer:
+                writer.write(encoded)
+
+    seconds, _ = measure(write, repeat)
+    stages["write"] = rates(seconds, samples=len(encoded), tokens=encoded.size, bytes=encoded.nbytes)
+
+    # End to end: PGN text to tokens (parse, replay and encode)
+    seconds, _ = measure(lambda: sum(len(rows) for rows in extract_training_tokens(text, window_size, np.uint8)), repeat)
+    stages["extract_tokens"] = rates(seconds, games=len(games), plies=plies, samples=samples, tokens=tokens)
+
+    # End to end: pgn_to_bin.py run on the corpus, in a new process (with its start up time)
+    # and with its own window size
+    def convert():
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "corpus.pgn")
+            with open(path, "w") as file:
+                file.write(text)
+            script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pgn_to_bin.py")
+            command = [sys.executable, script, "--pgn", path]
+            command += ["--train", os.path.join(directory, "train.bin"), "--eval", os.path.join(directory, "eval.bin")]
+            subprocess.run(command, check=True, capture_output=True)
+
+    seconds, _ = measure(convert, repeat)
+    stages["pgn_to_bin"] = rates(seconds, games=len(games), plies=plies, bytes=size)
+
+    corpus = {"games": len(games), "plies": plies, "samples": samples, "bytes": size}
+    return {"corpus": corpus, "stages": stages}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    """
+    Stages (and rates) slower than the baseline by more than the tolerance (a fraction).
+    """
+    regressions = []
+    for stage, metrics in results["stages"].items():
+        for name, value in metrics.items():
+            if not name.endswith("_per_second") or name not in baseline["stages"].get(stage, {}):
+                continue
+            change = value / baseline["stages"][stage][name] - 1
+            logging.info(f"{stage} {name}: {value:,.0f} ({change:+.1%} vs baseline)")
+            if change < -tolerance:
+                regressions.append(f"{stage} {name}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of the ingestion pipeline, stage by stage")
+    parser.add_argument("--corpus", default=None, help="PGN file to use, generated (and kept) if it does not exist")
+    parser.add_argument("--games", type=int, default=1000, help="number of games of a generated corpus")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of a generated corpus")
+    parser.add_argument("--window-size", type=int, default=7, help="window size of the training samples")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of every stage, the best one is kept")
+    parser.add_argument("--legacy", action="store_true", help="also time the python-chess game tree parser")
+    parser.add_argument("--output", default="benchmark.json", help="results file path (JSON)")
+    parser.add_argument("--baseline", default=None, help="results of an earlier run (JSON) to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="slowdown reported as a regression")
+    args = parser.parse_args()
+
+    # Configure logging to stdout
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    if args.corpus is not None and os.path.exists(args.corpus):
+        with open(args.corpus, "r") as file:
+            text = file.read()
+    else:
+        logging.info(f"Generating a corpus of {args.games} games (seed {args.seed})")
+        text = generate_corpus(args.games, args.seed)
+        if args.corpus is not None:
+            with open(args.corpus, "w") as file:
+                file.write(text)
+
+    results = run_benchmarks(text, args.window_size, args.repeat, args.legacy)
+    results["environment"] = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "chess": chess.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+    for stage, metrics in results["stages"].items():
+        logging.info(f"{stage}: " + ", ".join(f"{name} {value:,.2f}" for name, value in metrics.items()))
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=1)
+    logging.info(f"Results written to {args.output}")
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+        if baseline["corpus"] != results["corpus"]:
+            logging.warning("The baseline was measured on a different corpus")
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            logging.error(f"Slower than the baseline: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Colour flip augmentation, applied to encoded training samples in bulk: the position with the
+colours swapped (ranks mirrored, white pieces become black and the other way around, side to
+move, castling rights and en passant square swapped) with the same moves mirrored and the
+result swapped. Same as python-chess Board.mirror() for the board.
+
+The flip is a fixed permutation of the board columns (mirroring the ranks) followed by a
+lookup of every token in a table of its column (a token can have different meanings: 'b' is a
+black bishop in the placement and black to move in the side column).
+"""
+
+import numpy as np
+
+try:
+    import torch
+except ImportError:  # Only ColorFlip and flipping tensors need torch
+    torch = None
+
+from .tokenizer import CASTLING_TOKENS, PLACEMENT_ORDER, default_vocabulary, sample_length
+
+
+def _flipped_token(token: str) -> str:
+    # Squares and promotion destinations are mirrored, results swapped
+    if token in ("<1-0>", "<0-1>"):
+        return "<0-1>" if token == "<1-0>" else "<1-0>"
+    if len(token) in (2, 3) and token[0] in "abcdefgh" and token[1] in "12345678":
+        return token[0] + str(9 - int(token[1])) + token[2:]
+    return token
+
+
+def _initialize_flip_tables(window_size: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Column permutation and per column token tables of the colour flip of samples.
+    """
+    length = sample_length(window_size)
+    vocabulary_size = len(default_vocabulary)
+    identity = np.arange(256, dtype=np.uint8)
+
+    moves = identity.copy()
+    for index in range(vocabulary_size):
+        moves[index] = default_vocabulary.get_index(_flipped_token(default_vocabulary.get_token(index)))
+
+    pieces = identity.copy()
+    for piece in "pnbrqkPNBRQK":
+        pieces[default_vocabulary.get_index(piece)] = default_vocabulary.get_index(piece.swapcase())
+
+    side = identity.copy()
+    side[default_vocabulary.get_index("w")] = default_vocabulary.get_index("b")
+    side[default_vocabulary.get_index("b")] = default_vocabulary.get_index("w")
+
+    # Castling masks are in KQkq order, the white and black bits are swapped
+    castling = identity.copy()
+    for mask in range(16):
+        castling[CASTLING_TOKENS[mask]] = CASTLING_TOKENS[((mask & 3) << 2) | (mask >> 2)]
+
+    board = 2 * window_size
+    placement = len(PLACEMENT_ORDER)
+    tables = np.tile(moves, (length, 1))
+    tables[board : board + placement] = pieces
+    tables[board + placement] = side
+    tables[board + placement + 1] = castling
+
+    # The square of every placement column comes from the mirrored square (rank 8 <-> rank 1)
+    permutation = np.arange(length)
+    column = {square: board + index for index, square in enumerate(PLACEMENT_ORDER.tolist()) if square < 64}
+    for index, square in enumerate(PLACEMENT_ORDER.tolist()):
+        if square < 64:
+            permutation[board + index] = column[square ^ 56]
+    return permutation, tables
+
+
+_flip_tables = {}
+
+
+def flip_colors(tokens, window_size: int):
+    """
+    Colour flipped samples (rows of tokens, a numpy array or a tensor), a new array.
+    """
+    if window_size not in _flip_tables:
+        _flip_tables[window_size] = _initialize_flip_tables(window_size)
+    permutation, tables = _flip_tables[window_size]
+
+    tensor = torch is not None and isinstance(tokens, torch.Tensor)
+    rows = tokens.numpy() if tensor else np.asarray(tokens)
+    flipped = tables[np.arange(len(permutation)), rows[:, permutation]].astype(rows.dtype)
+    return torch.from_numpy(flipped) if tensor else flipped
+
+
+class ColorFlip:
+    """
+    Dataset transform (see chess_jepa.dataset) flipping the colours of every sample of a
+    batch with the given probability, in place. Uses the torch random generator, seeded
+    differently in every DataLoader worker.
+    """
+
+    def __init__(self, window_size: int, probability=0.5):
+        self.window_size = window_size
+        self.probability = probability
+
+    def __call__(self, tokens: "torch.Tensor") -> "torch.Tensor":
+        selected = (torch.rand(len(tokens)) < self.probability).numpy()
+        if selected.any():
+            rows = tokens.numpy()
+            rows[selected] = flip_colors(rows[selected], self.window_size)
+        return tokens
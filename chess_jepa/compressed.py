@@ -0,0 +1,189 @@
+"""
+Reading compressed PGN files (.zst, .bz2, .gz, .zip) as streams, without decompressing them
+to disk first. The decompression runs in a separate thread (or a zstd process) and feeds
+the reader through a bounded queue of blocks, so it overlaps with the parsing.
+
+Reading .zst files requires the zstd command line tool (e.g. apt install zstd), the other
+formats use the standard library. A truncated or corrupt file raises an error at the end of
+its data (EOFError), instead of looking like the end of the file.
+"""
+
+import bz2
+import gzip
+import io
+import os
+import queue
+import subprocess
+import threading
+import zipfile
+
+COMPRESSED_SUFFIXES = (".zst", ".bz2", ".gz", ".zip")
+
+
+def is_compressed(path: str) -> bool:
+    return path.lower().endswith(COMPRESSED_SUFFIXES)
+
+
+class _BlockReader(io.RawIOBase):
+    """
+    Raw stream over the blocks returned by read_block, read ahead by a background thread
+    into a queue of at most queue_size blocks. An empty block is the end of the stream.
+    source_position returns the bytes of the compressed file read so far.
+    """
+
+    def __init__(self, read_block, close_source, queue_size: int, source_position=None):
+        self.close_source = close_source
+        self.source_position = source_position
+        self.queue = queue.Queue(queue_size)
+        self.block = b""
+        self.offset = 0
+        self.done = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._read_blocks, args=(read_block,), daemon=True)
+        self.thread.start()
+
+    def _put(self, item) -> bool:
+        # Waits for room in the queue, gives up when the reader is closed
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read_blocks(self, read_block):
+        try:
+            while True:
+                block = read_block()
+                if not self._put(block) or not block:
+                    break
+        except Exception as error:
+            self._put(error)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer) -> int:
+        while self.offset == len(self.block):
+            if self.done:
+                return 0
+            block = self.queue.get()
+            if isinstance(block, Exception):
+                self.done = True
+                raise block
+            if not block:
+                self.done = True
+                return 0
+            self.block, self.offset = block, 0
+
+        count = min(len(buffer), len(self.block) - self.offset)
+        buffer[:count] = self.block[self.offset : self.offset + count]
+        self.offset += count
+        return count
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.close_source()
+        super().close()
+
+
+def _file_position(file) -> int:
+    # Offset of the file descriptor, also moved by a child process reading the same file
+    return os.lseek(file.fileno(), 0, os.SEEK_CUR)
+
+
+def _open_zstd(path: str):
+    # Decompressed by the zstd command line tool in a separate process, reading the file
+    # from its standard input (the offset of the shared descriptor tells how far it is)
+    source = open(path, "rb")
+    try:
+        process = subprocess.Popen(
+            ["zstd", "-d", "-c", "-q"], stdin=source, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+        )
+    except FileNotFoundError:
+        source.close()
+        raise RuntimeError(f"Reading {path} requires the zstd command line tool") from None
+
+    def read(size: int) -> bytes:
+        block = process.stdout.read(size)
+        # The end of the output is the end of the file only if zstd decompressed all of it
+        if not block and process.wait() != 0:
+            error = process.stderr.read().decode(errors="replace").strip()
+            raise EOFError(f"Compressed file {path} is truncated or corrupt (zstd: {error})")
+        return block
+
+    def close():
+        process.stdout.close()
+        process.stderr.close()
+        process.kill()
+        process.wait()
+        source.close()
+
+    return read, close, lambda: _file_position(source)
+
+
+def _open_zip(path: str):
+    # Archives hold a single PGN file (e.g. the Lichess Elite database), read the first one
+    archive = zipfile.ZipFile(path)
+    names = [name for name in archive.namelist() if name.lower().endswith(".pgn")] or archive.namelist()
+    file = archive.open(names[0])
+
+    def close():
+        file.close()
+        archive.close()
+
+    return file.read, close, lambda: _file_position(archive.fp)
+
+
+def open_compressed(path: str, block_size=1 << 20, queue_size=16) -> io.BufferedReader:
+    """
+    Opens a compressed file as a binary stream of the decompressed data. At most queue_size
+    blocks of block_size bytes are decompressed ahead of the reader.
+    """
+    suffix = path.lower().rsplit(".", 1)[-1]
+    if suffix == "zst":
+        read, close, position = _open_zstd(path)
+    elif suffix == "zip":
+        read, close, position = _open_zip(path)
+    elif suffix in ("gz", "bz2"):
+        source = open(path, "rb")
+        file = gzip.GzipFile(fileobj=source, mode="rb") if suffix == "gz" else bz2.BZ2File(source, "rb")
+
+        def close():
+            file.close()
+            source.close()
+
+        read, position = file.read, lambda: _file_position(source)
+    else:
+        raise ValueError(f"Unsupported compressed file: {path}")
+    reader = _BlockReader(lambda: read(block_size), close, queue_size, position)
+    return io.BufferedReader(reader, block_size)
+
+
+def compressed_position(stream: io.BufferedReader) -> int:
+    """
+    Bytes of the compressed file read so far by a stream of open_compressed, e.g. to report
+    the progress through the file. Runs ahead of the data returned by the stream by the
+    blocks decompressed in advance.
+    """
+    return stream.raw.source_position()
+
+
+def read_line_chunks(path: str, chunk_size=4 << 20):
+    """
+    Reads a text file of records on separate lines (e.g. JSON lines or CSV, plain or
+    compressed) as a stream of bytes chunks of about chunk_size, cut at the end of lines.
+    """
+    with open_compressed(path) if is_compressed(path) else open(path, "rb") as stream:
+        pending = b""
+        while block := stream.read(chunk_size):
+            text = pending + block
+            cut = text.rfind(b"\n") + 1
+            text, pending = text[:cut], text[cut:]
+            if text:
+                yield text
+        if pending:
+            yield pending
@@ -0,0 +1,365 @@
+"""
+PyTorch datasets over token files and game-packed files (see chess_jepa.storage).
+"""
+
+import os
+
+import numpy as np
+import torch
+import torch.distributed
+from torch.utils.data import Dataset, IterableDataset, Sampler, get_worker_info
+
+from .replay import replay_games
+from .storage import PackedGames, manifest_path, read_header, read_tokens, shard_paths
+from .tokenizer import encode_game, sample_length
+
+
+def _paths(paths) -> list:
+    # A single file, a list of files or the output path of a sharded writer (its manifest),
+    # or a list of them (e.g. the outputs of the sources of ingest.py)
+    if isinstance(paths, str):
+        paths = [paths]
+    paths = [shard for path in paths for shard in (shard_paths(path) if os.path.exists(manifest_path(path)) else [path])]
+    if not paths:
+        raise ValueError("No files to read")
+    return paths
+
+
+class TokenDataset(Dataset):
+    """
+    Map-style dataset over token files (a single file, a list of shards or the output path
+    of a sharded writer). The files are memory mapped lazily, separately in every DataLoader
+    worker, so the data is never copied into the workers (the pages are shared through the
+    page cache).
+
+    Indexing with a slice or an array of indices returns the whole batch as a single uint8
+    tensor of shape [batch, sample_length]. Use it with a BlockBatchSampler as the sampler
+    of a DataLoader with batch_size=None to avoid any per-sample Python objects.
+
+    The transform (e.g. chess_jepa.augment.ColorFlip) is applied to every batch read.
+    """
+
+    def __init__(self, paths, transform=None):
+        self.paths = _paths(paths)
+        self.transform = transform
+        self.header = read_header(self.paths[0])
+        for path in self.paths[1:]:
+            if read_header(path) != self.header:
+                raise ValueError(f"Token file {path} has a different header: {read_header(path)}")
+        self._tokens = None
+
+        # First sample of every file, the last entry is the number of samples
+        self.offsets = np.concatenate(([0], np.cumsum([len(tokens) for tokens in self.tokens])))
+
+    @property
+    def tokens(self) -> list[np.ndarray]:
+        if self._tokens is None:
+            self._tokens = [read_tokens(path) for path in self.paths]
+        return self._tokens
+
+    def __getstate__(self):
+        # Workers map the files on their own instead of receiving a pickled copy of them
+        state = self.__dict__.copy()
+        state["_tokens"] = None
+        return state
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, index) -> torch.Tensor:
+        if isinstance(index, (int, np.integer)):
+            return self.read_batch([index])[0]
+        if isinstance(index, slice):
+            return self.read_batch(np.arange(len(self))[index])
+        return self.read_batch(index)
+
+    def read_batch(self, indices, out: torch.Tensor = None) -> torch.Tensor:
+        """
+        Reads the samples at the given indices into a [batch, sample_length] uint8 tensor.
+        The output tensor can be preallocated (e.g. in pinned memory) and reused.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if out is None:
+            out = torch.empty((len(indices), self.header.sample_length), dtype=torch.uint8)
+        rows = out.numpy()
+
+        if len(self.paths) == 1:
+            np.take(self.tokens[0], indices, axis=0, out=rows)
+        else:
+            files = np.searchsorted(self.offsets, indices, side="right") - 1
+            for file in np.unique(files):
+                selected = files == file
+                rows[selected] = self.tokens[file][indices[selected] - self.offsets[file]]
+        return out if self.transform is None else self.transform(out)
+
+
+class BlockBatchSampler(Sampler):
+    """
+    Yields batches of sample indices (as arrays) read from a bounded region of the file.
+    With a stride of one every batch is a contiguous block of samples. With a larger
+    stride the samples of a batch are stride apart, which keeps consecutive windows of the
+    same game out of the same batch while still reading from batch_size * stride samples.
+    The order of the batches is shuffled, reseeded with set_epoch.
+    """
+
+    def __init__(self, length: int, batch_size: int, stride=1, shuffle=True, drop_last=False, seed=0):
+        self.length = length
+        self.batch_size = batch_size
+        self.stride = stride
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _starts(self) -> np.ndarray:
+        # Every region of batch_size * stride samples holds stride batches, one per offset
+        span = self.batch_size * self.stride
+        regions = np.arange(0, self.length, span)
+        starts = (regions[:, None] + np.arange(self.stride)).reshape(-1)
+        starts = starts[starts < self.length]
+        if self.drop_last:
+            starts = starts[starts + (self.batch_size - 1) * self.stride < self.length]
+        return starts
+
+    def __len__(self):
+        return len(self._starts())
+
+    def __iter__(self):
+        starts = self._starts()
+        if self.shuffle:
+            starts = np.random.default_rng((self.seed, self.epoch)).permutation(starts)
+        offsets = np.arange(self.batch_size) * self.stride
+        for start in starts:
+            batch = start + offsets
+            yield batch[batch < self.length]
+
+
+class GameDataset(Dataset):
+    """
+    Map-style dataset over game-packed files (a single file, a list of shards or the output
+    path of a sharded writer). The training samples are the same as the ones extracted from
+    the PGN with the given window size, rebuilt when a batch is read: all the games needed by
+    the batch are replayed together (see chess_jepa.replay) and all the windows of every
+    game are encoded together. Batches of
+    consecutive samples (e.g. from a BlockBatchSampler) touch only a few games. The
+    transform (e.g. chess_jepa.augment.ColorFlip) is applied to every batch read.
+    """
+
+    def __init__(self, paths, window_size: int, transform=None):
+        self.paths = _paths(paths)
+        self.window_size = window_size
+        self.transform = transform
+        self._games = None
+
+        # File and number in the file of every game
+        games = [len(games) for games in self.games]
+        self.files = np.repeat(np.arange(len(games)), games)
+        self.numbers = np.concatenate([np.arange(count) for count in games])
+
+        # First sample of every game, the last entry is the number of samples
+        lengths = np.concatenate([games.lengths for games in self.games])
+        counts = lengths + np.minimum(lengths, window_size)
+        self.offsets = np.concatenate(([0], np.cumsum(counts)))
+
+    @property
+    def games(self) -> list[PackedGames]:
+        if self._games is None:
+            self._games = [PackedGames(path) for path in self.paths]
+        return self._games
+
+    def __getstate__(self):
+        # Workers map the files on their own instead of receiving a pickled copy of them
+        state = self.__dict__.copy()
+        state["_games"] = None
+        return state
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, index) -> torch.Tensor:
+        if isinstance(index, (int, np.integer)):
+            return self.read_batch([index])[0]
+        if isinstance(index, slice):
+            return self.read_batch(np.arange(len(self))[index])
+        return self.read_batch(index)
+
+    def read_batch(self, indices, out: torch.Tensor = None) -> torch.Tensor:
+        """
+        Rebuilds the samples at the given indices into a [batch, sample_length] uint8 tensor.
+        The output tensor can be preallocated (e.g. in pinned memory) and reused.
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        if out is None:
+            out = torch.empty((len(indices), sample_length(self.window_size)), dtype=torch.uint8)
+        rows = out.numpy()
+
+        games = np.searchsorted(self.offsets, indices, side="right") - 1
+        unique = np.unique(games)
+        moves = [self.games[self.files[game]].moves(self.numbers[game]) for game in unique]
+        states, offsets = replay_games(moves)
+        for index, game in enumerate(unique):
+            result = self.games[self.files[game]].result(self.numbers[game])
+            boards = states[offsets[index] : offsets[index + 1]]
+            tokens = encode_game(boards, moves[index], result, self.window_size)
+            selected = games == game
+            rows[selected] = tokens[indices[selected] - self.offsets[game]]
+        return out if self.transform is None else self.transform(out)
+
+
+class ShuffledTokenStream(IterableDataset):
+    """
+    Iterable dataset streaming token files (a single file, a list of shards or sharded
+    outputs) through an in-memory shuffle buffer, for datasets too large for a random
+    permutation of all their samples. Yields batches as [batch_size, sample_length] uint8
+    tensors, use it in a DataLoader with batch_size=None.
+
+    The shards are shuffled every epoch and split between the distributed ranks and the
+    DataLoader workers of every rank (shards are cut in parts when there are fewer shards
+    than readers). Every reader reads blocks of block_size consecutive samples (sequential
+    I/O) from interleave of its shards at a time, in random order, into a buffer of
+    buffer_size samples: every sample read takes the place of a random sample of the buffer,
+    which is yielded. Samples of the same game end up spread over about buffer_size samples.
+
+    The order depends on the seed, the epoch (see set_epoch), the rank and the worker. With
+    even=True every reader yields the same number of samples (the smallest share, the rest
+    is dropped), so that all the ranks run the same number of steps. The transform (e.g.
+    chess_jepa.augment.ColorFlip) is applied to every batch.
+    """
+
+    def __init__(
+        self,
+        paths,
+        batch_size: int,
+        buffer_size=1 << 18,
+        block_size=1024,
+        interleave=8,
+        drop_last=False,
+        even=False,
+        seed=0,
+        rank: int = None,
+        world_size: int = None,
+        transform=None,
+    ):
+        self.paths = _paths(paths)
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.block_size = block_size
+        self.interleave = interleave
+        self.drop_last = drop_last
+        self.even = even
+        self.seed = seed
+        self.transform = transform
+        self.epoch = 0
+
+        # Distributed rank, from the default process group unless given
+        distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+        self.rank = rank if rank is not None else (torch.distributed.get_rank() if distributed else 0)
+        self.world_size = world_size if world_size is not None else (torch.distributed.get_world_size() if distributed else 1)
+
+        self.header = read_header(self.paths[0])
+        for path in self.paths[1:]:
+            if read_header(path) != self.header:
+                raise ValueError(f"Token file {path} has a different header: {read_header(path)}")
+        self.lengths = [len(read_tokens(path)) for path in self.paths]
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def _parts(self, readers: int) -> list[list[tuple[int, int, int]]]:
+        # The (file, start, end) parts read by every reader, from the shards in the order of
+        # the epoch (the same for all the readers)
+        order = np.random.default_rng((self.seed, self.epoch)).permutation(len(self.paths))
+        pieces = -(-readers // len(self.paths))
+        parts = []
+        for file in order.tolist():
+            bounds = np.linspace(0, self.lengths[file], pieces + 1).astype(np.int64)
+            parts.extend((file, int(start), int(end)) for start, end in zip(bounds, bounds[1:]) if end > start)
+        return [parts[reader::readers] for reader in range(readers)]
+
+    def _reader(self) -> tuple[int, int]:
+        # This reader (a worker of a rank) and the number of readers
+        info = get_worker_info()
+        worker, workers = (info.id, info.num_workers) if info is not None else (0, 1)
+        return self.rank * workers + worker, self.world_size * workers
+
+    def _counts(self, readers: int) -> list[int]:
+        # Samples yielded by every reader
+        counts = [sum(end - start for _, start, end in parts) for parts in self._parts(readers)]
+        return [min(counts)] * readers if self.even else counts
+
+    def __len__(self):
+        # Batches of this rank read by a single worker (every worker of a rank ends with a
+        # partial batch unless drop_last)
+        count = self._counts(self.world_size)[self.rank]
+        return count // self.batch_size if self.drop_last else -(-count // self.batch_size)
+
+    def _samples(self, parts, rng, block_size: int):
+        # Yields blocks of consecutive samples, read from interleave parts at a time
+        tokens = [None] * len(self.paths)
+        pending = list(parts)
+        active = []
+        while pending or active:
+            while pending and len(active) < self.interleave:
+                active.append(list(pending.pop(0)))
+            part = active[rng.integers(len(active))]
+            file, start, end = part
+            if tokens[file] is None:
+                tokens[file] = read_tokens(self.paths[file])
+            stop = min(start + block_size, end)
+            yield np.array(tokens[file][start:stop])
+            part[1] = stop
+            if stop == end:
+                active.remove(part)
+
+    def _batches(self, rows: np.ndarray, pending: list):
+        # Collects rows into batches, yields the full ones (pending holds the rest)
+        pending.append(rows)
+        count = sum(len(block) for block in pending)
+        if count >= self.batch_size:
+            rows = np.concatenate(pending)
+            full = len(rows) // self.batch_size * self.batch_size
+            pending[:] = [rows[full:]] if full < len(rows) else []
+            for start in range(0, full, self.batch_size):
+                yield rows[start : start + self.batch_size]
+
+    def __iter__(self):
+        reader, readers = self._reader()
+        parts = self._parts(readers)[reader]
+        limit = self._counts(readers)[reader]
+        rng = np.random.default_rng((self.seed, self.epoch, reader))
+
+        size = max(min(self.buffer_size, limit), 1)
+        buffer = np.empty((size, self.header.sample_length), dtype=self.header.dtype)
+        filled = 0
+        pending = []
+        yielded = 0
+        for rows in self._samples(parts, rng, min(self.block_size, size)):
+            rows = rows[: limit - yielded - filled]
+            # Fill the buffer first, then every sample read replaces a random one
+            room = min(size - filled, len(rows))
+            buffer[filled : filled + room] = rows[:room]
+            filled += room
+            rows = rows[room:]
+            if len(rows):
+                slots = rng.choice(size, size=len(rows), replace=False)
+                out = buffer[slots]
+                buffer[slots] = rows
+                yielded += len(out)
+                for batch in self._batches(out, pending):
+                    yield self._tensor(batch)
+            if yielded + filled >= limit:
+                break
+
+        # The end of the stream: the rest of the buffer in random order
+        out = buffer[rng.permutation(filled)]
+        for batch in self._batches(out, pending):
+            yield self._tensor(batch)
+        if pending and not self.drop_last:
+            yield self._tensor(np.concatenate(pending))
+
+    def _tensor(self, rows: np.ndarray) -> torch.Tensor:
+        batch = torch.from_numpy(np.ascontiguousarray(rows))
+        return batch if self.transform is None else self.transform(batch)
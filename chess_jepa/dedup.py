@@ -0,0 +1,240 @@
+"""
+Deduplication of training samples. Every sample (the board and the moves of its window) is
+keyed on a 64-bit Zobrist hash of its tokens, and the number of copies seen for every key is
+kept in a count-min sketch of a fixed size: memory stays within the budget no matter how
+many positions are seen. A sketch never undercounts, so no key is kept more than max_copies
+times. It can overcount when keys collide in all their counters, then a few unique samples
+would be dropped (rare while the budget is a few bytes per distinct sample or more): the
+copies of the first exact_keys keys are also counted exactly, and confirm the sketch.
+"""
+
+import functools
+import os
+
+import numpy as np
+
+# Fixed seed, the hashes are the same in every run
+_ZOBRIST_SEED = 0x5A0B_C4E5
+
+
+@functools.lru_cache(maxsize=8)
+def _zobrist_table(length: int) -> np.ndarray:
+    # One random 64-bit value per (position in the sample, token), shared between the calls
+    table = np.random.default_rng(_ZOBRIST_SEED).integers(0, 2**64, size=(length, 256), dtype=np.uint64)
+    table.flags.writeable = False
+    return table
+
+
+def sample_hashes(tokens: np.ndarray, batch_size=1 << 16) -> np.ndarray:
+    """
+    Zobrist hash (uint64) of every sample of a 2D array of tokens: the XOR of a random value
+    for every (position, token) pair of the sample.
+    """
+    tokens = np.asarray(tokens)
+    table = _zobrist_table(tokens.shape[1])
+    columns = np.arange(tokens.shape[1])
+    hashes = np.empty(len(tokens), dtype=np.uint64)
+    for start in range(0, len(tokens), batch_size):
+        batch = tokens[start : start + batch_size].astype(np.int64)
+        hashes[start : start + batch_size] = np.bitwise_xor.reduce(table[columns, batch], axis=1)
+    return hashes
+
+
+class DuplicateFilter:
+    """
+    Keeps at most max_copies of every sample key. The copies are counted in a count-min
+    sketch of memory_budget one-byte counters (hashes counters per key, conservative update).
+    The copies kept of every key are also counted exactly while there are at most exact_keys
+    keys (9 bytes each), a key the sketch counts as a copy is only dropped if the exact count
+    confirms it. dropped is the number of samples dropped, unconfirmed those dropped on the
+    counts of the sketch alone (once there are more keys) and rescued the samples the sketch
+    counted as copies that the exact counts kept.
+
+    With a path the counters are a file mapped in memory, so they can be kept with the
+    progress of a run and reopened to continue it. The counts of keep are then staged in
+    memory and only written to the file by the commit of a checkpoint (see prepare), so a
+    run interrupted before its checkpoint does not count the samples it redoes as copies.
+    The exact counts are saved next to it ({path}.exact.npz) by every commit.
+    """
+
+    def __init__(
+        self,
+        max_copies=1,
+        memory_budget=1 << 30,
+        hashes=4,
+        path: str = None,
+        append=False,
+        checkpoint=None,
+        exact_keys=1 << 20,
+    ):
+        if not 1 <= max_copies < 255:
+            raise ValueError(f"max_copies must be between 1 and 254, got {max_copies}")
+        self.max_copies = max_copies
+        self.hashes = hashes
+        self.size = np.uint64(memory_budget)
+        self.path = path
+        self.exact_keys = exact_keys
+        self.dropped = self.unconfirmed = self.rescued = 0
+        # Staged counters (sorted indices and their new values), applied by commit
+        self.staged = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint8))
+        # Exact counts (sorted keys and their copies kept), None once there are too many keys
+        self.exact = (np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.uint8))
+        if path is None:
+            self.counters = np.zeros(memory_budget, dtype=np.uint8)
+            return
+        if not append or not os.path.exists(path) or os.path.getsize(path) != memory_budget:
+            with open(path, "wb") as file:
+                file.truncate(memory_budget)
+            if os.path.exists(self._exact_path()):
+                os.remove(self._exact_path())
+        elif os.path.exists(self._exact_path()):
+            self.exact = self._load_exact(self._exact_path())
+        else:
+            # Counters without exact counts, they cannot be confirmed
+            self.exact = None
+        self.counters = np.memmap(path, dtype=np.uint8, mode="r+")
+
+        # Counts prepared for a checkpoint that was committed (the checkpoint of the progress
+        # the run continues from) but maybe not written yet, the others are dropped
+        if append and os.path.exists(self._prepared_path()):
+            with np.load(self._prepared_path()) as data:
+                if checkpoint is not None and int(data["checkpoint"]) == checkpoint:
+                    self.staged = (data["indices"], data["values"])
+                    self.exact = self._load_exact(self._prepared_path())
+                    self.commit()
+        if os.path.exists(self._prepared_path()):
+            os.remove(self._prepared_path())
+
+    def _prepared_path(self) -> str:
+        return self.path + ".prepared.npz"
+
+    def _exact_path(self) -> str:
+        return self.path + ".exact.npz"
+
+    @staticmethod
+    def _load_exact(path: str) -> tuple[np.ndarray, np.ndarray] | None:
+        with np.load(path) as data:
+            return (data["exact_keys"], data["exact_counts"]) if bool(data["exact"]) else None
+
+    def _exact_arrays(self) -> dict:
+        if self.exact is None:
+            return {"exact": np.bool_(False)}
+        return {"exact": np.bool_(True), "exact_keys": self.exact[0], "exact_counts": self.exact[1]}
+
+    def _indices(self, keys: np.ndarray) -> np.ndarray:
+        # Double hashing: counter j of a key is (low + j * high) modulo the size
+        low = keys & np.uint64(0xFFFFFFFF)
+        high = (keys >> np.uint64(32)) | np.uint64(1)
+        steps = np.arange(self.hashes, dtype=np.uint64)
+        return ((low[:, None] + steps * high[:, None]) % self.size).astype(np.int64)
+
+    def _counts(self, indices: np.ndarray) -> np.ndarray:
+        # Counters at the indices, with the staged counts
+        counts = self.counters[indices]
+        staged_indices, staged_values = self.staged
+        if len(staged_indices):
+            found = np.minimum(np.searchsorted(staged_indices, indices), len(staged_indices) - 1)
+            counts = np.where(staged_indices[found] == indices, np.maximum(counts, staged_values[found]), counts)
+        return counts
+
+    def _update(self, indices: np.ndarray, values: np.ndarray):
+        # Counters only grow (max), updating twice with the same values changes nothing
+        if self.path is None:
+            np.maximum.at(self.counters, indices, values)
+            return
+        indices = np.concatenate((self.staged[0], indices))
+        values = np.concatenate((self.staged[1], values))
+        # The largest value of every index
+        order = np.lexsort((values, indices))
+        indices, values = indices[order], values[order]
+        last = np.ones(len(indices), dtype=bool)
+        last[:-1] = indices[1:] != indices[:-1]
+        self.staged = (indices[last], values[last])
+
+    def keep(self, keys: np.ndarray) -> np.ndarray:
+        """
+        Boolean mask of the keys to keep, in order: a key is kept while fewer than
+        max_copies copies of it were kept before (including earlier in the same array).
+        """
+        keys = np.asarray(keys, dtype=np.uint64)
+        unique, inverse = np.unique(keys, return_inverse=True)
+        indices = self._indices(unique)
+        seen = self._counts(indices).min(axis=1).astype(np.int64)
+
+        # Copy number of every key within the array (0 for its first occurrence)
+        order = np.argsort(inverse, kind="stable")
+        first = np.searchsorted(inverse[order], np.arange(len(unique)))
+        copy = np.empty(len(keys), dtype=np.int64)
+        copy[order] = np.arange(len(keys)) - first[inverse[order]]
+
+        mask = seen[inverse] + copy < self.max_copies
+        if self.exact is not None:
+            # The exact counts confirm the copies found by the sketch
+            exact_keys, exact_counts = self.exact
+            found = np.searchsorted(exact_keys, unique)
+            present = found < len(exact_keys)
+            present[present] = exact_keys[found[present]] == unique[present]
+            seen = np.zeros(len(unique), dtype=np.int64)
+            seen[present] = exact_counts[found[present]]
+            confirmed = seen[inverse] + copy < self.max_copies
+            self.rescued += int((confirmed & ~mask).sum())
+            mask = confirmed
+        else:
+            self.unconfirmed += int((~mask).sum())
+        self.dropped += int((~mask).sum())
+        kept = np.bincount(inverse[mask], minlength=len(unique))
+
+        # Conservative update: counters only grow up to the new count of the key
+        updated = np.broadcast_to(np.minimum(seen + kept, 255)[:, None], indices.shape)
+        self._update(indices.reshape(-1), updated.reshape(-1).astype(np.uint8))
+        if self.exact is not None:
+            self._update_exact(unique, seen + kept, found, present)
+        return mask
+
+    def _update_exact(self, unique: np.ndarray, counts: np.ndarray, found: np.ndarray, present: np.ndarray):
+        # New counts of the keys (where they are or would be in the sorted exact keys)
+        exact_keys, exact_counts = self.exact
+        exact_counts[found[present]] = counts[present]
+        added = ~present & (counts > 0)
+        if len(exact_keys) + added.sum() > self.exact_keys:
+            self.exact = None
+            return
+        self.exact = (
+            np.insert(exact_keys, found[added], unique[added]),
+            np.insert(exact_counts, found[added], counts[added].astype(np.uint8)),
+        )
+
+    def prepare(self, checkpoint: int):
+        """
+        Saves the staged counts for a checkpoint of the run (e.g. the games done), before the
+        progress of the checkpoint is saved. A filter reopened from that progress (the same
+        checkpoint) writes them if commit did not.
+        """
+        if self.path is None:
+            return
+        with open(self._prepared_path() + ".tmp", "wb") as file:
+            np.savez(
+                file,
+                checkpoint=np.int64(checkpoint),
+                indices=self.staged[0],
+                values=self.staged[1],
+                **self._exact_arrays(),
+            )
+        os.replace(self._prepared_path() + ".tmp", self._prepared_path())
+
+    def commit(self):
+        """
+        Writes the staged counts to the counters file, once the progress of the checkpoint
+        is saved.
+        """
+        if self.path is None:
+            return
+        indices, values = self.staged
+        self.counters[indices] = np.maximum(self.counters[indices], values)
+        self.counters.flush()
+        with open(self._exact_path() + ".tmp", "wb") as file:
+            np.savez(file, **self._exact_arrays())
+        os.replace(self._exact_path() + ".tmp", self._exact_path())
+        self.staged = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint8))
+        if os.path.exists(self._prepared_path()):
+            os.remove(self._prepared_path())
@@ -0,0 +1,157 @@
+"""
+The Lichess evaluations database (https://database.lichess.org/#evals, JSON lines of a FEN and
+the engine evaluations found for it) as a table of oracle targets for the training samples.
+
+Every FEN is normalized to the board tokens of chess_jepa.tokenizer (piece placement, side,
+castling, legal en passant square) and keyed on their Zobrist hash (see
+chess_jepa.dedup.sample_hashes), so the key of a training sample is computed from its tokens
+alone, without replaying the game. For every position the deepest evaluation is kept: the
+score of its first PV, the depth and the first PV move. The table is a flat array of records
+sorted by key, memory mapped and searched with binary search.
+"""
+
+import json
+import os
+
+import chess
+import numpy as np
+
+from .compressed import read_line_chunks
+from .dedup import sample_hashes
+from .pgn import board_state, map_chunks, move_code
+from .tokenizer import encode_boards
+
+# Score from the point of view of white in centipawns, or mate in moves (0 when there is
+# no forced mate, negative when black mates). Depth 0 for the positions not in the table.
+EVAL_DTYPE = np.dtype([("key", "<u8"), ("cp", "<i4"), ("mate", "<i2"), ("depth", "<u2"), ("move", "<u2")])
+
+
+def board_keys(board_tokens: np.ndarray) -> np.ndarray:
+    """
+    Keys (uint64) of boards encoded as tokens (see encode_boards, the board part of a sample).
+    """
+    return sample_hashes(board_tokens)
+
+
+def sample_board_keys(tokens: np.ndarray, window_size: int) -> np.ndarray:
+    """
+    Keys of the board of every training sample (rows of tokens).
+    """
+    return board_keys(np.asarray(tokens)[:, 2 * window_size : -2 * window_size])
+
+
+def _parse_evaluations(text: bytes) -> np.ndarray:
+    # Records of the JSON lines in the text, the deepest evaluation of every position
+    records, states = [], []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        position = json.loads(line)
+        evaluations = position.get("evals") or []
+        if not evaluations:
+            continue
+        best = max(evaluations, key=lambda evaluation: (evaluation.get("depth", 0), evaluation.get("knodes", 0)))
+        pv = best["pvs"][0]
+        line_moves = pv.get("line", "").split()
+        move = move_code(chess.Move.from_uci(line_moves[0])) if line_moves else 0
+        records.append((0, pv.get("cp", 0), pv.get("mate", 0), best.get("depth", 0), move))
+        states.append(board_state(chess.Board(position["fen"])))
+
+    result = np.array(records, dtype=EVAL_DTYPE)
+    if len(result):
+        result["key"] = board_keys(encode_boards(np.array(states, dtype=np.uint64)))
+    return result
+
+
+def _bucket_path(path: str, bucket: int) -> str:
+    return f"{path}.bucket-{bucket:04d}.tmp"
+
+
+def build_evaluation_table(path: str, output: str, workers=None, chunk_size=4 << 20, bucket_bits=8) -> int:
+    """
+    Builds the evaluation table of a Lichess evaluations file (.jsonl, or compressed e.g.
+    .jsonl.zst) in output, parsing chunks in parallel. Records are spilled to 2**bucket_bits
+    bucket files by the top bits of their key and every bucket is sorted on its own, so the
+    memory used is about the size of a bucket. Returns the number of positions.
+    """
+    buckets = 1 << bucket_bits
+    files = [open(_bucket_path(output, bucket), "wb") for bucket in range(buckets)]
+    try:
+        for records in map_chunks(_parse_evaluations, read_line_chunks(path, chunk_size), workers):
+            numbers = (records["key"] >> np.uint64(64 - bucket_bits)).astype(np.int64)
+            order = np.argsort(numbers, kind="stable")
+            records, numbers = records[order], numbers[order]
+            bounds = np.searchsorted(numbers, np.arange(buckets + 1))
+            for bucket in np.unique(numbers).tolist():
+                records[bounds[bucket] : bounds[bucket + 1]].tofile(files[bucket])
+    finally:
+        for file in files:
+            file.close()
+
+    count = 0
+    with open(output + ".tmp", "wb") as file:
+        for bucket in range(buckets):
+            records = np.fromfile(_bucket_path(output, bucket), dtype=EVAL_DTYPE)
+            # The deepest evaluation of every position comes first
+            records = records[np.lexsort((-records["depth"].astype(np.int64), records["key"]))]
+            first = np.ones(len(records), dtype=bool)
+            first[1:] = records["key"][1:] != records["key"][:-1]
+            records[first].tofile(file)
+            count += int(first.sum())
+            os.remove(_bucket_path(output, bucket))
+    os.replace(output + ".tmp", output)
+    return count
+
+
+class EvaluationTable:
+    """
+    Lookups in an evaluation table built by build_evaluation_table (memory mapped).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.getsize(path) == 0:
+            self.records = np.empty(0, dtype=EVAL_DTYPE)
+        else:
+            self.records = np.memmap(path, dtype=EVAL_DTYPE, mode="r")
+
+    def __len__(self):
+        return len(self.records)
+
+    def lookup(self, keys) -> np.ndarray:
+        """
+        Evaluations (EVAL_DTYPE records) of the positions with the given keys, with depth 0
+        for the positions not in the table.
+        """
+        keys = np.asarray(keys, dtype=np.uint64)
+        result = np.zeros(len(keys), dtype=EVAL_DTYPE)
+        if len(self.records):
+            found = np.minimum(np.searchsorted(self.records["key"], keys), len(self.records) - 1)
+            known = self.records["key"][found] == keys
+            result[known] = self.records[found[known]]
+        result["key"] = keys
+        return result
+
+    def lookup_boards(self, boards: list[chess.Board]) -> np.ndarray:
+        return self.lookup(board_keys(encode_boards(np.array([board_state(board) for board in boards], dtype=np.uint64))))
+
+    def lookup_samples(self, tokens: np.ndarray, window_size: int) -> np.ndarray:
+        """
+        Evaluations of the board of every training sample (rows of tokens).
+        """
+        return self.lookup(sample_board_keys(tokens, window_size))
+
+
+def targets_path(path: str) -> str:
+    # Evaluations of the samples of an output of pgn_to_bin.py, one record per sample
+    return path + ".evals"
+
+
+def read_targets(path: str) -> np.ndarray:
+    """
+    The evaluation targets written next to an output of pgn_to_bin.py (its path), one record
+    per sample in the order of its shards (the order of chess_jepa.dataset.TokenDataset).
+    """
+    if os.path.getsize(targets_path(path)) == 0:
+        return np.empty(0, dtype=EVAL_DTYPE)
+    return np.memmap(targets_path(path), dtype=EVAL_DTYPE, mode="r")
@@ -0,0 +1,115 @@
+"""
+Masking of the moves of training samples for the JEPA setup, after the MaskCollator of I-JEPA
+(papers-and-code/ijepa/src/masks/multiblock.py): collates a batch of token rows and samples
+which move slots are hidden from the context encoder and predicted in latent space.
+
+A sample has window_size move slots before the board and window_size after it (two tokens
+each, see chess_jepa.tokenizer). Slots holding a move (or the result token) are masked,
+padding only when a sample has fewer moves than the number to mask. The masks are sampled
+for the whole batch at once with tensor operations.
+"""
+
+from multiprocessing import Value
+
+import torch
+
+from .tokenizer import PADDING_TOKEN, default_vocabulary, sample_length
+
+
+class MoveMaskCollator:
+    """
+    Collates token rows (a list of [sample_length] tensors, or a [batch, sample_length]
+    tensor from a batch sampler) and returns (tokens, context indices, target indices): the
+    indices are token positions, [batch, sample_length - 2 * k] for the context and
+    [batch, 2 * k] for the targets, with k masked moves per sample.
+
+    - slots: "after" (the future moves), "before" (the past moves) or "both"
+    - mode: "random" masks k of the slots, "span" masks k consecutive slots
+    - num_masked: k, an int, a (min, max) range sampled for every batch, or a function of
+      the step (e.g. to mask more moves as training goes on)
+
+    Every sample has the same k, so that the indices are fixed size tensors: samples with
+    fewer than k moves (e.g. at the end of a game) have padding slots masked as well. The
+    step counter is shared by the DataLoader workers, every batch is masked with a generator
+    seeded with its step.
+    """
+
+    def __init__(self, window_size: int, slots="after", mode="random", num_masked=1, seed=0):
+        if slots not in ("after", "before", "both"):
+            raise ValueError(f"Unknown slots: {slots}")
+        if mode not in ("random", "span"):
+            raise ValueError(f"Unknown mode: {mode}")
+        self.window_size = window_size
+        self.slots = slots
+        self.mode = mode
+        self.num_masked = num_masked
+        self.seed = seed
+        self._itr_counter = Value("i", -1)  # collator is shared across worker processes
+
+        # Token position of the first token of every move slot, in time order (the past
+        # moves, then the future moves)
+        length = sample_length(window_size)
+        before = torch.arange(window_size) * 2
+        after = length - 2 * window_size + torch.arange(window_size) * 2
+        positions = {"after": after, "before": before, "both": torch.cat((before, after))}
+        self.slot_positions = positions[slots]
+        self.length = length
+
+    def step(self) -> int:
+        i = self._itr_counter
+        with i.get_lock():
+            i.value += 1
+            v = i.value
+        return v
+
+    def _sample_num_masked(self, step: int, generator: torch.Generator) -> int:
+        num_masked = self.num_masked(step) if callable(self.num_masked) else self.num_masked
+        if isinstance(num_masked, tuple):
+            low, high = num_masked
+            num_masked = int(torch.randint(low, high + 1, (1,), generator=generator).item())
+        return num_masked
+
+    def __call__(self, batch):
+        tokens = batch if isinstance(batch, torch.Tensor) else torch.stack([torch.as_tensor(row) for row in batch])
+        size = len(tokens)
+
+        step = self.step()
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + step)
+        num_masked = self._sample_num_masked(step, generator)
+
+        # Slots with a move (the first token of a padded slot is padding)
+        padding = default_vocabulary.get_index(PADDING_TOKEN)
+        valid = tokens[:, self.slot_positions].long() != padding
+        counts = valid.sum(dim=1)
+        num_masked = min(num_masked, len(self.slot_positions))
+
+        slots = torch.arange(len(self.slot_positions))
+        if self.mode == "random":
+            # The num_masked valid slots with the smallest random scores
+            scores = torch.rand(valid.shape, generator=generator)
+            scores[~valid] = 2
+            masked = scores.argsort(dim=1)[:, :num_masked].sort(dim=1).values
+        else:
+            # The moves of a sample are consecutive slots, a span starts anywhere in them
+            first = torch.where(valid, slots, len(slots)).min(dim=1).values
+            room = (counts - num_masked + 1).clamp(min=1)
+            starts = first + (torch.rand(size, generator=generator) * room).long()
+            starts = starts.clamp(max=len(slots) - num_masked)
+            masked = starts[:, None] + torch.arange(num_masked)
+
+        # Both tokens of every masked slot are targets, every other token is context
+        first_tokens = self.slot_positions[masked]
+        targets = torch.stack((first_tokens, first_tokens + 1), dim=2).reshape(size, 2 * num_masked)
+        is_context = torch.ones((size, self.length), dtype=torch.bool)
+        is_context[torch.arange(size)[:, None], targets] = False
+        context = is_context.nonzero()[:, 1].reshape(size, self.length - 2 * num_masked)
+        return tokens, context, targets
+
+
+def apply_masks(x: torch.Tensor, indices: torch.Tensor) -> torch.Tensor:
+    """
+    Gathers the positions of indices ([batch, count]) from x ([batch, length, dim]), e.g. the
+    context or target tokens after the embedding.
+    """
+    return torch.gather(x, dim=1, index=indices.unsqueeze(-1).expand(-1, -1, x.size(-1)))
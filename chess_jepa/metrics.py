@@ -0,0 +1,113 @@
+"""
+Lightweight instrumentation of long ingest runs: cumulative wall time of the stages of the
+pipeline and the progress through the input, with a rolling rate and an estimate of the
+time left. Cheap enough to stay on for the whole run (a clock read per stage and game batch).
+"""
+
+import collections
+import contextlib
+import time
+
+_END = object()
+
+
+class StageTimer:
+    """
+    Cumulative wall time (seconds) of named stages, e.g. read, parse, replay, encode, write.
+    Times measured elsewhere (e.g. in a worker process) are merged with add.
+    """
+
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+
+    @contextlib.contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.perf_counter() - start
+
+    def iterate(self, iterable, stage: str):
+        """
+        Yields the items of the iterable, the time waiting for every item added to the stage.
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.time(stage):
+                item = next(iterator, _END)
+            if item is _END:
+                return
+            yield item
+
+    def add(self, seconds: dict[str, float]):
+        for stage, value in seconds.items():
+            self.seconds[stage] += value
+
+    def as_dict(self) -> dict[str, float]:
+        return dict(self.seconds)
+
+    def __str__(self):
+        total = sum(self.seconds.values()) or 1.0
+        return ", ".join(f"{stage} {value:.1f}s ({value / total:.0%})" for stage, value in self.seconds.items())
+
+
+def _format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class Progress:
+    """
+    Progress through an input of total_bytes bytes: the counters given to update (bytes of
+    the input consumed, games, samples, all cumulative) and their rates over the last window
+    seconds, which follow changes of speed during a run (and ignore the work done before a
+    resume). The time left is estimated from the rate of bytes.
+    """
+
+    def __init__(self, total_bytes: int = None, window=60.0):
+        self.total_bytes = total_bytes
+        self.window = window
+        self.started = time.monotonic()
+        self.counters = {"bytes": 0, "games": 0, "samples": 0}
+        self.points = collections.deque()
+
+    def update(self, **counters: int):
+        self.counters.update(counters)
+        now = time.monotonic()
+        self.points.append((now, dict(self.counters)))
+        # Keep at least two points, the rates need an interval
+        while len(self.points) > 2 and now - self.points[1][0] >= self.window:
+            self.points.popleft()
+
+    def rates(self) -> dict[str, float]:
+        if len(self.points) < 2:
+            return {name: 0.0 for name in self.counters}
+        (first, start), (last, end) = self.points[0], self.points[-1]
+        elapsed = max(last - first, 1e-9)
+        return {name: (end[name] - start.get(name, 0)) / elapsed for name in end}
+
+    def eta(self) -> float | None:
+        # Seconds left, None while unknown
+        rate = self.rates()["bytes"]
+        if self.total_bytes is None or rate <= 0:
+            return None
+        return max(self.total_bytes - self.counters["bytes"], 0) / rate
+
+    def as_dict(self) -> dict:
+        return {
+            **self.counters,
+            "total_bytes": self.total_bytes,
+            "elapsed": time.monotonic() - self.started,
+            "rates": self.rates(),
+            "eta": self.eta(),
+        }
+
+    def __str__(self):
+        rates = self.rates()
+        text = f"{self.counters['bytes'] / 2**20:,.0f} MB"
+        if self.total_bytes:
+            text += f" of {self.total_bytes / 2**20:,.0f} MB ({self.counters['bytes'] / self.total_bytes:.1%})"
+        text += f", {rates['games']:,.0f} games/s, {rates['samples']:,.0f} samples/s"
+        eta = self.eta()
+        return text + (f", ETA {_format_duration(eta)}" if eta is not None else "")
@@ -0,0 +1,291 @@
+"""
+A chess engine (e.g. Stockfish) as an oracle to label positions: a pool of UCI engine
+processes driven by asyncio (python-chess), depth or time limited analysis and a persistent
+cache of the evaluations shared by every run.
+
+Positions are keyed on the hash of their board tokens (see chess_jepa.positions) and the
+search settings, so a position is analysed once per settings no matter how many games
+reach it: repeated positions are served from the cache, or wait for the analysis already
+running for them. The move history, halfmove clock and repetitions are not part of the key,
+the engine only gets the position.
+"""
+
+import asyncio
+import sqlite3
+import time
+from typing import NamedTuple
+
+import chess
+import chess.engine
+import numpy as np
+
+from .pgn import board_state, move_code
+from .positions import position_hashes
+
+
+class Evaluation(NamedTuple):
+    # Score from the point of view of white, in centipawns (None for a forced mate) or moves
+    # to mate (None if no forced mate was found, negative when black mates)
+    score: int | None
+    mate: int | None
+    depth: int
+    best_move: chess.Move | None
+    pv: list[chess.Move]
+
+
+def limit_settings(limit: chess.engine.Limit) -> str:
+    """
+    The search settings of a limit as a string, part of the cache key.
+    """
+    values = [(name, getattr(limit, name)) for name in ("depth", "nodes", "time", "mate")]
+    return ",".join(f"{name}={value}" for name, value in values if value is not None)
+
+
+def _signed(key: int) -> int:
+    # SQLite integers are signed 64-bit
+    return key - (1 << 64) if key >= 1 << 63 else key
+
+
+def _decode_move(code: int) -> chess.Move:
+    return chess.Move(code & 63, (code >> 6) & 63, (code >> 12) or None)
+
+
+class EvalCache:
+    """
+    Evaluations stored in an SQLite file by (position key, search settings). Writes are
+    buffered and committed every batch_size evaluations (and by flush), reads are batched.
+    """
+
+    def __init__(self, path: str, batch_size=1024):
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS evaluations ("
+            "key INTEGER, settings TEXT, score INTEGER, mate INTEGER, depth INTEGER, pv BLOB, "
+            "PRIMARY KEY (key, settings)) WITHOUT ROWID"
+        )
+        self.batch_size = batch_size
+        self.pending = []
+
+    def __len__(self):
+        self.flush()
+        return self.connection.execute("SELECT COUNT(*) FROM evaluations").fetchone()[0]
+
+    def get_many(self, keys, settings: str, batch_size=500) -> dict[int, Evaluation]:
+        """
+        Evaluations found for the keys (uint64 position hashes), by key.
+        """
+        self.flush()
+        keys = list({int(key) for key in keys})
+        found = {}
+        for start in range(0, len(keys), batch_size):
+            batch = [_signed(key) for key in keys[start : start + batch_size]]
+            rows = self.connection.execute(
+                "SELECT key, score, mate, depth, pv FROM evaluations "
+                f"WHERE settings = ? AND key IN ({','.join('?' * len(batch))})",
+                [settings, *batch],
+            )
+            for key, score, mate, depth, pv in rows:
+                moves = [_decode_move(code) for code in np.frombuffer(pv, dtype="<u2").tolist()]
+                found[key % (1 << 64)] = Evaluation(score, mate, depth, moves[0] if moves else None, moves)
+        return found
+
+    def put(self, key: int, settings: str, evaluation: Evaluation):
+        pv = np.array([move_code(move) for move in evaluation.pv], dtype="<u2").tobytes()
+        self.pending.append((_signed(int(key)), settings, evaluation.score, evaluation.mate, evaluation.depth, pv))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            with self.connection:
+                self.connection.executemany("INSERT OR REPLACE INTO evaluations VALUES (?, ?, ?, ?, ?, ?)", self.pending)
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+
+class OracleMetrics:
+    """
+    Counters of an engine pool: positions requested, answered by the cache, by an analysis
+    already running (deduplicated) and analysed by an engine, with the time spent.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.requests = 0
+        self.cache_hits = 0
+        self.deduplicated = 0
+        self.analysed = 0
+        self.engine_seconds = 0.0
+
+    def as_dict(self) -> dict:
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return {
+            "requests": self.requests,
+            "cache_hits": self.cache_hits,
+            "deduplicated": self.deduplicated,
+            "analysed": self.analysed,
+            "elapsed": elapsed,
+            "requests_per_second": self.requests / elapsed,
+            "analysed_per_second": self.analysed / elapsed,
+            "seconds_per_analysis": self.engine_seconds / max(self.analysed, 1),
+        }
+
+    def __str__(self):
+        metrics = self.as_dict()
+        return (
+            f"{metrics['requests']} requests ({metrics['requests_per_second']:.1f}/s), "
+            f"{metrics['cache_hits']} cached, {metrics['deduplicated']} deduplicated, "
+            f"{metrics['analysed']} analysed ({metrics['analysed_per_second']:.1f}/s)"
+        )
+
+
+class EnginePool:
+    """
+    A pool of workers UCI engine processes (started with command, configured with the UCI
+    options) analysing positions concurrently, one position per engine at a time. With a
+    cache (an EvalCache) evaluations are looked up before and stored after the analysis.
+
+        async with EnginePool("stockfish", workers=8, cache=EvalCache("evals.sqlite")) as pool:
+            evaluations = await pool.analyse_many(boards, chess.engine.Limit(depth=18))
+    """
+
+    def __init__(self, command, workers=1, options: dict = None, cache: EvalCache = None, retries=1):
+        self.command = command
+        self.workers = workers
+        self.options = options or {}
+        self.cache = cache
+        self.retries = retries
+        self.metrics = OracleMetrics()
+        self.engines = []
+        self.idle = None
+        # Analyses running, by (key, settings)
+        self.running = {}
+
+    async def _open_engine(self) -> chess.engine.UciProtocol:
+        _, engine = await chess.engine.popen_uci(self.command)
+        if self.options:
+            await engine.configure(self.options)
+        return engine
+
+    async def start(self):
+        self.idle = asyncio.Queue()
+        self.engines = await asyncio.gather(*(self._open_engine() for _ in range(self.workers)))
+        for engine in self.engines:
+            self.idle.put_nowait(engine)
+
+    async def close(self):
+        for engine in self.engines:
+            try:
+                await engine.quit()
+            except chess.engine.EngineError:
+                pass
+        self.engines = []
+        if self.cache is not None:
+            self.cache.flush()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _run(self, board: chess.Board, limit: chess.engine.Limit) -> Evaluation:
+        engine = await self.idle.get()
+        if engine is None:
+            # Left by the last engine lost, for the other waiting analyses too
+            self.idle.put_nowait(None)
+            raise chess.engine.EngineError("no engine left in the pool")
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    started = time.monotonic()
+                    info = await engine.analyse(board, limit)
+                    self.metrics.engine_seconds += time.monotonic() - started
+                    break
+                except chess.engine.EngineError:
+                    # Replace a crashed engine, the position is analysed again by the new one.
+                    # If the new one cannot be started the pool has one engine less.
+                    self.engines.remove(engine)
+                    engine = None
+                    engine = await self._open_engine()
+                    self.engines.append(engine)
+                    if attempt == self.retries:
+                        raise
+        finally:
+            if engine is not None:
+                self.idle.put_nowait(engine)
+            elif not self.engines:
+                self.idle.put_nowait(None)
+
+        score = info["score"].white() if "score" in info else chess.engine.Cp(0)
+        pv = info.get("pv", [])
+        return Evaluation(score.score(), score.mate(), info.get("depth", 0), pv[0] if pv else None, pv)
+
+    async def _analyse(self, board: chess.Board, limit: chess.engine.Limit, key: int, settings: str) -> Evaluation:
+        try:
+            evaluation = await self._run(board, limit)
+            self.metrics.analysed += 1
+            if self.cache is not None:
+                self.cache.put(key, settings, evaluation)
+            return evaluation
+        finally:
+            del self.running[key, settings]
+
+    async def analyse_many(self, boards: list[chess.Board], limit: chess.engine.Limit) -> list[Evaluation]:
+        """
+        Evaluations of the positions, in order. The cache is read once for the whole batch,
+        the positions it misses are analysed by all the engines at once, every distinct
+        position once (even when it is being analysed for another batch).
+        """
+        settings = limit_settings(limit)
+        keys = position_hashes(np.stack([board_state(board) for board in boards])).tolist() if boards else []
+        self.metrics.requests += len(keys)
+        found = self.cache.get_many(keys, settings) if self.cache is not None else {}
+
+        tasks = {}
+        for board, key in zip(boards, keys):
+            if key in found:
+                self.metrics.cache_hits += 1
+            elif key in tasks or (key, settings) in self.running:
+                self.metrics.deduplicated += 1
+            else:
+                # Only the position is sent to the engine, not the moves that led to it
+                task = asyncio.ensure_future(self._analyse(board.copy(stack=False), limit, key, settings))
+                self.running[key, settings] = task
+            if key not in found and key not in tasks:
+                tasks[key] = self.running[key, settings]
+
+        evaluations = await asyncio.gather(*(asyncio.shield(task) for task in tasks.values()))
+        found.update(zip(tasks, evaluations))
+        return [found[key] for key in keys]
+
+    async def analyse(self, board: chess.Board, limit: chess.engine.Limit) -> Evaluation:
+        return (await self.analyse_many([board], limit))[0]
+
+
+def evaluate_positions(
+    command, boards: list[chess.Board], limit: chess.engine.Limit, workers=1, cache_path: str = None, batch_size=4096
+) -> list[Evaluation]:
+    """
+    Evaluations of the positions by a pool of engines, in batches of batch_size positions.
+    With a cache_path the evaluations are kept for the next runs.
+    """
+    cache = EvalCache(cache_path) if cache_path is not None else None
+
+    async def run():
+        async with EnginePool(command, workers, cache=cache) as pool:
+            evaluations = []
+            for start in range(0, len(boards), batch_size):
+                evaluations += await pool.analyse_many(boards[start : start + batch_size], limit)
+            return evaluations
+
+    try:
+        return asyncio.run(run())
+    finally:
+        if cache is not None:
+            cache.close()
@@ -1,70 +1,784 @@
+import collections
+import functools
+import hashlib
 import io
+import itertools
+import logging
+import multiprocessing
+import os
+import re
 import chess
 import chess.pgn
+import numpy as np
 
-from .tokenizer import PADDING_TOKEN, START_TOKEN
+from .compressed import compressed_position, is_compressed, open_compressed
+from .metrics import StageTimer
+from .replay import replay_games
+from .storage import RESULTS
+from .tokenizer import (
+    NO_EN_PASSANT,
+    PADDING_TOKEN,
+    START_TOKEN,
+    encode_game,
+    game_samples_count,
+    sample_length,
+)
+
+_logger = logging.getLogger(__name__)
+
+# Castling rights bit mask in KQkq order, indexed by the square of the rook
+_castling_bits = {chess.H1: 1, chess.A1: 2, chess.H8: 4, chess.A8: 8}
 
 
 def extract_training_samples(input, window_size=5):
-    if isinstance(input, str):
-        input = io.StringIO(input)
+    """
+    Yields the training samples (strings of tokens) of every game of the input, a PGN text
+    or a text stream (e.g. open_pgn(path), also for compressed files).
+    """
+    for headers, _, moves in _read_mainline(input):
+        yield from game_training_samples(headers, moves, window_size)
 
-    while True:
-        game = chess.pgn.read_game(input)
-        if game is None:
-            break  # End of file
-        moves = list(game.mainline_moves())
-        board = game.board()
-
-        before_moves = [
-            PADDING_TOKEN,
-        ] * (window_size - 1) + [
-            START_TOKEN,
-        ]
-        after_moves = []
-
-        # Play all the moves and fill the after buffer
-        for move in moves:
-            if len(after_moves) < window_size:
-                after_moves.append(move.uci())
-            else:
-                before_moves.pop(0)
-
-                move_to_play = after_moves.pop(0)
-                board.push(chess.Move.from_uci(move_to_play))
-
-                before_moves.append(move_to_play)
-                after_moves.append(move.uci())
-
-            trimed_fen = board.fen().split(" ")[:-2]
-            yield " ".join(
-                before_moves
-                + trimed_fen
-                + after_moves
-                + [
-                    PADDING_TOKEN,
-                ]
-                * (window_size - len(after_moves))
-            )
 
-        # Play all the moves left in the after buffer
-        outcome_token = "<" + game.headers["Result"] + ">"
-        for index in range(len(after_moves)):
+def game_training_samples(headers: dict, moves: list[chess.Move], window_size=5):
+    """
+    Yields the training samples (strings of tokens) of a game already read: its headers and
+    mainline moves.
+    """
+    board = chess.pgn.Headers(headers).board() if "FEN" in headers else chess.Board()
+
+    before_moves = [
+        PADDING_TOKEN,
+    ] * (window_size - 1) + [
+        START_TOKEN,
+    ]
+    after_moves = []
+    played = 0  # Moves are played in order, the first ones leaving the after buffer
+
+    # Play all the moves and fill the after buffer
+    for move in moves:
+        if len(after_moves) < window_size:
+            after_moves.append(move.uci())
+        else:
             before_moves.pop(0)
 
             move_to_play = after_moves.pop(0)
-            board.push(chess.Move.from_uci(move_to_play))
+            board.push(moves[played])
+            played += 1
 
             before_moves.append(move_to_play)
-            after_moves.append(outcome_token if index == 0 else PADDING_TOKEN)
-
-            trimed_fen = board.fen().split(" ")[:-2]
-            yield " ".join(
-                before_moves
-                + trimed_fen
-                + after_moves
-                + [
-                    PADDING_TOKEN,
-                ]
-                * (window_size - len(after_moves))
+            after_moves.append(move.uci())
+
+        trimed_fen = board.fen().split(" ")[:-2]
+        yield " ".join(
+            before_moves
+            + trimed_fen
+            + after_moves
+            + [
+                PADDING_TOKEN,
+            ]
+            * (window_size - len(after_moves))
+        )
+
+    # Play all the moves left in the after buffer
+    outcome_token = "<" + headers.get("Result", "*") + ">"
+    for index in range(len(after_moves)):
+        before_moves.pop(0)
+
+        move_to_play = after_moves.pop(0)
+        board.push(moves[played])
+        played += 1
+
+        before_moves.append(move_to_play)
+        after_moves.append(outcome_token if index == 0 else PADDING_TOKEN)
+
+        trimed_fen = board.fen().split(" ")[:-2]
+        yield " ".join(
+            before_moves
+            + trimed_fen
+            + after_moves
+            + [
+                PADDING_TOKEN,
+            ]
+            * (window_size - len(after_moves))
+        )
+
+
+def move_code(move: chess.Move) -> int:
+    """
+    Numeric code of a move (layout documented in chess_jepa.tokenizer).
+    """
+    return move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+
+
+def board_state(board: chess.Board) -> list[int]:
+    """
+    Numeric state of a board (layout documented in chess_jepa.tokenizer). Same information
+    as the trimmed FEN used by extract_training_samples.
+    """
+    white, black = board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK]
+    castling = 0
+    for square in chess.scan_forward(board.clean_castling_rights() & chess.BB_CORNERS):
+        castling |= _castling_bits[square]
+    pieces = [board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings]
+    return (
+        [bitboard & white for bitboard in pieces]
+        + [bitboard & black for bitboard in pieces]
+        + [int(board.turn), castling, board.ep_square if board.has_legal_en_passant() else NO_EN_PASSANT]
+    )
+
+
+# Games are split like chess.pgn does: the headers are the tag lines at the start of a game
+# (up to the first line that is not a tag), a game starts at the first line with content and
+# at every tag line following movetext (blank lines in between)
+_GAME_START = re.compile(r"(?:\A|\n)[ \t]*[^\[\s][^\n]*\n(?:[ \t\r]*\n)*(?=\[)")
+_GAME_START_BYTES = re.compile(_GAME_START.pattern.encode())
+_CONTENT = re.compile(r"\S")
+_HEADER_BLOCK = re.compile(r"(?:[ \t]*\[[^\n]*(?:\n|\Z)|[ \t\r]*\n)*")
+
+# Mainline reader: comments (braces, rest of line after ;) and variations are removed in bulk,
+# then every SAN move is found with a single regex and resolved against the board
+_HEADER_TEXT = re.compile(r'^\[(\w+) "(.*)"\]', re.MULTILINE)
+_MOVETEXT_COMMENT = re.compile(r"\{[^}]*\}|;[^\n]*")
+_MOVETEXT_VARIATION = re.compile(r"\([^()]*\)")
+_MOVETEXT_SAN = re.compile(r"([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?|([O0]-[O0](?:-[O0])?)")
+_SAN_PIECE_TYPES = {None: chess.PAWN, "N": chess.KNIGHT, "B": chess.BISHOP, "R": chess.ROOK, "Q": chess.QUEEN, "K": chess.KING}
+_SAN_FILES = {name: chess.BB_FILES[index] for index, name in enumerate(chess.FILE_NAMES)}
+_SAN_RANKS = {name: chess.BB_RANKS[index] for index, name in enumerate(chess.RANK_NAMES)}
+_SAN_SQUARES = {name: chess.BB_SQUARES[index] for index, name in enumerate(chess.SQUARE_NAMES)}
+
+
+def _resolve_san(board: chess.Board, match: re.Match) -> chess.Move:
+    # Same as board.parse_san for a matched move, without parsing the text again
+    piece, file, rank, to_square, promotion, castling = match.groups()
+    if castling:
+        return board.parse_san(castling.replace("0", "O"))
+    from_mask = board.pieces_mask(_SAN_PIECE_TYPES[piece], board.turn)
+    if file:
+        from_mask &= _SAN_FILES[file]
+    if rank:
+        from_mask &= _SAN_RANKS[rank]
+    promotion = _SAN_PIECE_TYPES[promotion] if promotion else None
+
+    found = None
+    for move in board.generate_legal_moves(from_mask, _SAN_SQUARES[to_square]):
+        if move.promotion != promotion:
+            continue
+        if found is not None:
+            raise chess.AmbiguousMoveError(f"ambiguous san: {match[0]!r} in {board.fen()}")
+        found = move
+    if found is None:
+        raise chess.IllegalMoveError(f"illegal san: {match[0]!r} in {board.fen()}")
+    return found
+
+
+def _normalize_newlines(text: str) -> str:
+    return text.replace("\r\n", "\n") if "\r" in text else text
+
+
+def _game_starts(text: str) -> list[int]:
+    # Offsets of the games of a PGN text
+    content = _CONTENT.search(text)
+    if content is None:
+        return []
+    return [content.start()] + [match.end() for match in _GAME_START.finditer(text, content.start())]
+
+
+def _cut_games(stream, chunk_size=4 << 20):
+    # Reads a text stream in chunks of about chunk_size characters cut at the start of games,
+    # yields every chunk with the offsets of its games
+    pending = ""
+    while True:
+        block = stream.read(chunk_size)
+        text = _normalize_newlines(pending + block)
+        starts = _game_starts(text)
+        if block:
+            # Keep the last (possibly incomplete) game for the next chunk
+            if len(starts) < 2:
+                pending = text
+                continue
+            text, pending = text[: starts[-1]], text[starts[-1] :]
+            starts.pop()
+        if starts:
+            yield text, starts
+        if not block:
+            return
+
+
+def _split_games(input):
+    # Yields the text of every game of a PGN text or stream
+    if isinstance(input, str):
+        text = _normalize_newlines(input)
+        chunks = [(text, _game_starts(text))]
+    else:
+        chunks = _cut_games(input)
+    for text, starts in chunks:
+        for start, end in zip(starts, starts[1:] + [len(text)]):
+            yield text[start:end]
+
+
+def _mainline_text(movetext: str) -> str:
+    # The movetext without its comments and variations
+    movetext = _MOVETEXT_COMMENT.sub(" ", movetext)
+    count = 1
+    while count:
+        movetext, count = _MOVETEXT_VARIATION.subn(" ", movetext)
+    return movetext
+
+
+def _read_mainline(input):
+    # Yields the headers, the board state at the start (None for the standard starting
+    # position) and the moves of every game. Like chess.pgn, the rest of the mainline is
+    # skipped after an illegal or ambiguous move, the truncated games are logged. Chess960
+    # games are skipped (and counted): python-chess writes their castling moves as the king
+    # taking its rook, which chess_jepa.replay does not play
+    games = truncated = chess960 = 0
+    for text in _split_games(input):
+        end = _HEADER_BLOCK.match(text).end()
+        headers = dict(_HEADER_TEXT.findall(text, 0, end))
+        if "Variant" in headers and chess.pgn.Headers(headers).is_chess960():
+            chess960 += 1
+            continue
+        board = chess.pgn.Headers(headers).board() if "FEN" in headers else chess.Board()
+        start = board_state(board) if "FEN" in headers else None
+
+        games += 1
+        moves = []
+        for match in _MOVETEXT_SAN.finditer(_mainline_text(text[end:])):
+            try:
+                move = _resolve_san(board, match)
+            except ValueError as error:
+                truncated += 1
+                game = f"{headers.get('White', '?')} - {headers.get('Black', '?')} ({headers.get('Site', '?')})"
+                _logger.warning(f"Game {game} truncated after {len(moves)} plies: {error}")
+                break
+            board.push(move)
+            moves.append(move)
+        yield headers, start, moves
+    if truncated:
+        _logger.warning(f"Truncated {truncated} of {games} games at an illegal or ambiguous move")
+    if chess960:
+        _logger.warning(f"Skipped {chess960} Chess960 games")
+
+
+def read_mainline(input):
+    """
+    Fast reader for the mainline of every game of a PGN text or text stream. Only the headers
+    and the mainline moves are read: comments, annotations and variations are dropped in
+    bulk and every SAN move is resolved once against a single board, without building a
+    chess.pgn game tree. Yields the headers (dict) and the move codes (uint16 array).
+    """
+    for headers, _, moves in _read_mainline(input):
+        yield headers, np.fromiter(map(move_code, moves), dtype=np.uint16, count=len(moves))
+
+
+_STANDARD_START = board_state(chess.Board())
+
+
+def _extract_game_tokens(input, window_size: int, dtype, batch_size=256, timer: StageTimer = None):
+    # Yields the move codes, the result, the start state (None for the standard starting
+    # position) and the samples of every game, see extract_training_tokens. The board states
+    # are replayed for batches of games at once (see chess_jepa.replay). The time spent in
+    # every stage is added to the timer
+    timer = StageTimer() if timer is None else timer
+    games = _read_mainline(input)
+    buffer = None
+    while True:
+        with timer.time("parse"):
+            batch = list(itertools.islice(games, batch_size))
+            codes = [[move_code(move) for move in moves] for _, _, moves in batch]
+        if not batch:
+            break
+        batch = [(headers, start, moves) for (headers, start, _), moves in zip(batch, codes) if moves]
+        starts = None
+        if any(start is not None for _, start, _ in batch):
+            starts = [_STANDARD_START if start is None else start for _, start, _ in batch]
+        with timer.time("replay"):
+            states, offsets = replay_games([moves for _, _, moves in batch], starts)
+
+        for index, (headers, start, moves) in enumerate(batch):
+            count = game_samples_count(len(moves), window_size)
+            if buffer is None or len(buffer) < count:
+                buffer = np.empty((count, sample_length(window_size)), dtype=dtype)
+            boards = states[offsets[index] : offsets[index + 1]]
+            result = headers.get("Result", "*")
+            with timer.time("encode"):
+                tokens = encode_game(boards, moves, result, window_size, out=buffer)
+            yield moves, result, start, tokens
+
+
+def extract_training_tokens(input, window_size=5, dtype=np.int32):
+    """
+    Same samples as extract_training_samples, but encoded straight from the board states
+    without building FEN or UCI strings. Yields a 2D array of tokens for every game. The
+    array is a reused buffer, only valid until the next game is read.
+    """
+    for _, _, _, tokens in _extract_game_tokens(input, window_size, dtype):
+        yield tokens
+
+
+def game_hash(moves) -> int:
+    """
+    Stable 64-bit hash of the moves of a game (move codes), the same in every run and on
+    every machine. Used to split the games between the training and evaluation sets.
+    """
+    data = np.asarray(moves, dtype="<u2").tobytes()
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+def eval_split(hashes, eval_fraction: float) -> np.ndarray:
+    """
+    Boolean mask of the stable hashes (of games, or puzzles) that go to the evaluation set,
+    eval_fraction of them. The split only depends on the hash, every sample of a game goes to
+    the same set in every run.
+    """
+    threshold = min(int(eval_fraction * 2**64), 2**64 - 1)
+    return np.asarray(hashes, dtype=np.uint64) < np.uint64(threshold)
+
+
+def extract_games(input):
+    """
+    Yields the move codes (uint16 array) and the result of every game, the compact form of
+    a game used by the game-packed storage. Only games from the standard starting position
+    are extracted, the others (FEN header) are skipped and counted in a warning.
+    """
+    games = skipped = 0
+    for headers, moves in read_mainline(input):
+        games += 1
+        if headers.get("FEN", chess.STARTING_FEN) != chess.STARTING_FEN:
+            skipped += 1
+            continue
+        yield moves, headers.get("Result", "*")
+    if skipped:
+        _logger.warning(f"Skipped {skipped} of {games} games that do not start from the standard position")
+
+
+def replay_boards(moves: np.ndarray) -> np.ndarray:
+    """
+    Plays the move codes of a game from the standard starting position. Returns the board
+    states before every move and after the last one, the input of encode_game. Use
+    chess_jepa.replay.replay_games to replay many games at once (much faster).
+    """
+    return replay_games([moves])[0]
+
+
+def _find_game_start(file, offset: int, block_size=1 << 20) -> int:
+    """
+    Byte offset of the first game starting at or after the given offset, None if there is none.
+    """
+    # A game start is told by the line before it, read from the last line with content
+    # before the offset (larger blocks for longer lines)
+    size = block_size
+    while True:
+        back = max(offset - size, 0)
+        file.seek(back)
+        before = file.read(offset - back).rstrip()
+        if b"\n" in before or back == 0:
+            break
+        size *= 2
+    position = back + max(before.rfind(b"\n"), 0)
+    while True:
+        file.seek(position)
+        block = file.read(block_size)
+        for match in _GAME_START_BYTES.finditer(block):
+            if position + match.end() >= offset:
+                return position + match.end()
+        if len(block) < block_size:
+            return None  # End of file
+        # The next block starts with the last line of this one (and the blank lines after it)
+        last = block.rstrip().rfind(b"\n")
+        if last > 0:
+            position += last
+        else:
+            block_size *= 2
+
+
+def split_pgn(path: str, chunk_size: int) -> list[tuple[int, int]]:
+    """
+    Splits a PGN file into (start, end) byte ranges of about chunk_size bytes. Every range
+    starts at the beginning of a game. Only looks at the bytes around the split points.
+    """
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, "rb") as file:
+        for offset in range(chunk_size, size, chunk_size):
+            if offset <= boundaries[-1]:
+                continue  # Still inside the previous chunk (very large game)
+            start = _find_game_start(file, offset)
+            if start is None:
+                break
+            boundaries.append(start)
+    boundaries.append(size)
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def open_pgn(path: str):
+    """
+    Opens a PGN file as a text stream. Compressed files (.zst, .bz2, .gz, .zip) are
+    decompressed on the fly, see chess_jepa.compressed.
+    """
+    if is_compressed(path):
+        return io.TextIOWrapper(open_compressed(path), encoding="utf-8")
+    return open(path, "r")
+
+
+def read_pgn_chunks(path: str, chunk_size=4 << 20, start=0, with_position=False):
+    """
+    Reads a PGN file (plain or compressed) as a stream of text chunks of about chunk_size
+    characters, cut at the beginning of games. Yields (first, last, text) for every chunk,
+    with the numbers of the games it holds. The first start games are skipped.
+    With with_position=True, (first, last, text, position) with the bytes of the file read
+    so far (of the compressed file for compressed files, see compressed_position).
+    """
+    with open_pgn(path) as stream:
+        number = 0
+        for text, starts in _cut_games(stream, chunk_size):
+            if number + len(starts) > start:
+                skip = max(start - number, 0)
+                chunk = (number + skip, number + len(starts), text[starts[skip] :])
+                if with_position:
+                    raw = stream.buffer if is_compressed(path) else None
+                    chunk += (compressed_position(raw) if raw is not None else stream.buffer.tell(),)
+                yield chunk
+            number += len(starts)
+
+
+def _read_range(path: str, byte_range: tuple[int, int]) -> str:
+    start, end = byte_range
+    with open(path, "rb") as file:
+        file.seek(start)
+        return file.read(end - start).decode()
+
+
+def _read_chunk(path: str, chunk, game_filter=None, timer: StageTimer = None) -> str:
+    # Chunks are byte ranges of the file, or the text itself (e.g. read from a compressed file)
+    timer = StageTimer() if timer is None else timer
+    with timer.time("read"):
+        text = chunk if isinstance(chunk, str) else _read_range(path, chunk)
+    if game_filter is None:
+        return text
+    with timer.time("filter"):
+        return filter_pgn(text, game_filter)
+
+
+def _extract_training_tokens_chunk(
+    path: str, chunk, window_size: int, with_games=False, game_filter=None, with_times=False
+) -> np.ndarray | tuple:
+    # Tokens fit in a byte, keeps the results sent back to the parent process small
+    timer = StageTimer()
+    text = _read_chunk(path, chunk, game_filter, timer)
+    samples, games = [], []
+    for moves, result, start, tokens in _extract_game_tokens(text, window_size, np.uint8, timer=timer):
+        samples.append(tokens.copy())
+        if with_games:
+            games.append((np.array(moves, dtype=np.uint16), result, start))
+    tokens = np.concatenate(samples) if samples else np.empty((0, sample_length(window_size)), dtype=np.uint8)
+    tokens = (tokens, games) if with_games else tokens
+    return (tokens, timer.as_dict()) if with_times else tokens
+
+
+def _extract_games_chunk(path: str, chunk, game_filter=None, with_times=False) -> list | tuple:
+    timer = StageTimer()
+    text = _read_chunk(path, chunk, game_filter, timer)
+    with timer.time("parse"):
+        games = list(extract_games(text))
+    return (games, timer.as_dict()) if with_times else games
+
+
+def map_chunks(function, chunks, workers=None):
+    """
+    Applies the function to every chunk in a pool of worker processes, yields the results
+    in order. Only a few chunks per worker are read ahead, so chunks can come from a stream.
+    A single worker runs in the calling process.
+    """
+    if workers == 1:
+        yield from map(function, chunks)
+        return
+    workers = workers or os.cpu_count()
+    with multiprocessing.Pool(workers) as pool:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(function, (chunk,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+
+def _pgn_chunks(path: str, chunk_size: int, ranges, texts):
+    if ranges is not None:
+        return ranges
+    if texts is not None:
+        return texts
+    if is_compressed(path):
+        return (text for _, _, text in read_pgn_chunks(path, chunk_size))
+    return split_pgn(path, chunk_size)
+
+
+def extract_training_tokens_parallel(
+    path: str,
+    window_size=5,
+    workers=None,
+    chunk_size=4 << 20,
+    ranges=None,
+    with_games=False,
+    texts=None,
+    game_filter=None,
+    with_times=False,
+):
+    """
+    Same samples as extract_training_tokens for a PGN file, but the games are processed by
+    a pool of worker processes. The file is split into chunks of about chunk_size bytes
+    (or the given byte ranges, e.g. from a PgnIndex, or texts, e.g. from read_pgn_chunks)
+    and a 2D array of tokens is yielded for every chunk, in file order. Compressed files
+    are read as a stream. A single worker runs in the calling process.
+    With with_games=True the tokens come with the list of the games they were extracted from
+    (move codes, result and start state, None for the standard starting position), in order,
+    every game with game_samples_count samples.
+    Games rejected by the game_filter (a GameFilter) are skipped before they are parsed.
+    With with_times=True every result comes with the seconds spent in every stage of its
+    chunk (read, filter, parse, replay, encode), as a (result, seconds) pair.
+    """
+    extract = functools.partial(
+        _extract_training_tokens_chunk,
+        path,
+        window_size=window_size,
+        with_games=with_games,
+        game_filter=game_filter,
+        with_times=with_times,
+    )
+    yield from map_chunks(extract, _pgn_chunks(path, chunk_size, ranges, texts), workers)
+
+
+def extract_games_parallel(
+    path: str, workers=None, chunk_size=4 << 20, ranges=None, texts=None, game_filter=None, with_times=False
+):
+    """
+    Same as extract_games for a PGN file, processed by a pool of worker processes like
+    extract_training_tokens_parallel. Yields the list of games of every chunk, in file order
+    (with the seconds of its stages with with_times=True).
+    """
+    extract = functools.partial(_extract_games_chunk, path, game_filter=game_filter, with_times=with_times)
+    yield from map_chunks(extract, _pgn_chunks(path, chunk_size, ranges, texts), workers)
+
+
+def _count_plies(movetext: str) -> int:
+    """
+    Number of mainline moves of a movetext, without parsing them (the moves found by the
+    mainline reader).
+    """
+    return sum(1 for _ in _MOVETEXT_SAN.finditer(_mainline_text(movetext)))
+
+
+def _parse_elo(value: str) -> int:
+    return int(value) if value.isdecimal() else 0
+
+
+class PgnIndex:
+    """
+    Byte offset of every game in a PGN file, followed by the size of the file, and a few
+    parsed header fields for every game (zero when missing or not indexed): WhiteElo,
+    BlackElo, Result (position in RESULTS) and the number of plies. headers tells whether
+    the fields were indexed.
+    """
+
+    def __init__(self, offsets, white_elo=None, black_elo=None, results=None, plies=None, mtime_ns=0, headers=False):
+        self.offsets = np.asarray(offsets, dtype=np.uint64)
+        games = len(self.offsets) - 1
+        self.white_elo = np.zeros(games, np.uint16) if white_elo is None else np.asarray(white_elo, np.uint16)
+        self.black_elo = np.zeros(games, np.uint16) if black_elo is None else np.asarray(black_elo, np.uint16)
+        self.results = np.zeros(games, np.uint8) if results is None else np.asarray(results, np.uint8)
+        self.plies = np.zeros(games, np.uint16) if plies is None else np.asarray(plies, np.uint16)
+        self.mtime_ns = mtime_ns
+        self.headers = headers
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def byte_range(self, first: int, last: int) -> tuple[int, int]:
+        """
+        Byte range of the games from first (included) to last (excluded).
+        """
+        return int(self.offsets[first]), int(self.offsets[last])
+
+    def split(self, chunk_size: int, start=0, end=None) -> list[tuple[int, int]]:
+        """
+        Splits the games from start to end into (first, last) game ranges of about
+        chunk_size bytes, at least one game each.
+        """
+        end = len(self) if end is None else end
+        chunks = []
+        while start < end:
+            target = self.offsets[start] + np.uint64(chunk_size)
+            last = min(max(int(np.searchsorted(self.offsets, target, side="right")) - 1, start + 1), end)
+            chunks.append((start, last))
+            start = last
+        return chunks
+
+    def save(self, path: str):
+        with open(path, "wb") as file:
+            np.savez(
+                file,
+                offsets=self.offsets,
+                white_elo=self.white_elo,
+                black_elo=self.black_elo,
+                results=self.results,
+                plies=self.plies,
+                mtime_ns=np.int64(self.mtime_ns),
+                headers=np.bool_(self.headers),
             )
+
+    @staticmethod
+    def load(path: str) -> "PgnIndex":
+        with np.load(path) as data:
+            return PgnIndex(
+                data["offsets"],
+                data["white_elo"],
+                data["black_elo"],
+                data["results"],
+                data["plies"],
+                int(data["mtime_ns"]),
+                # Indexes saved without the flag are treated as without headers
+                "headers" in data and bool(data["headers"]),
+            )
+
+
+def _time_control_seconds(value: str) -> float | None:
+    """
+    Estimated duration of a game in seconds for a TimeControl header (base + 40 increments,
+    the way lichess classifies the speed of games), infinite without a clock ("-").
+    """
+    if value == "-":
+        return float("inf")
+    base, _, increment = value.partition("+")
+    if not base.isdigit() or not (increment or "0").isdigit():
+        return None
+    return int(base) + 40 * int(increment or "0")
+
+
+class GameFilter:
+    """
+    Accepts or rejects games on their headers alone (and the number of plies, counted
+    without parsing the moves):
+    - min_elo: minimum WhiteElo and BlackElo
+    - min_time_control: minimum estimated duration in seconds (e.g. 180 for blitz and slower)
+    - results: accepted results (e.g. {"1-0", "0-1", "1/2-1/2"} to skip unfinished games)
+    - min_plies: minimum number of mainline moves
+    - variant: accepted Variant (a missing header is Standard), None for any
+    """
+
+    def __init__(self, min_elo=0, min_time_control=0, results=None, min_plies=0, variant="Standard"):
+        self.min_elo = min_elo
+        self.min_time_control = min_time_control
+        self.results = results
+        self.min_plies = min_plies
+        self.variant = variant
+
+    def accepts_headers(self, headers: dict[str, str]) -> bool:
+        if self.min_elo:
+            for key in ("WhiteElo", "BlackElo"):
+                value = headers.get(key, "")
+                if not value.isdigit() or int(value) < self.min_elo:
+                    return False
+        if self.min_time_control:
+            seconds = _time_control_seconds(headers.get("TimeControl", ""))
+            if seconds is None or seconds < self.min_time_control:
+                return False
+        if self.results is not None and headers.get("Result") not in self.results:
+            return False
+        if self.variant is not None and headers.get("Variant", "Standard") != self.variant:
+            return False
+        return True
+
+    def accepts(self, game: str) -> bool:
+        """
+        Decides on the text of a single game, only its headers are parsed.
+        """
+        end = _HEADER_BLOCK.match(game).end()
+        if not self.accepts_headers(dict(_HEADER_TEXT.findall(game, 0, end))):
+            return False
+        if self.min_plies and _count_plies(game[end:]) < self.min_plies:
+            return False
+        return True
+
+
+def filter_pgn(text: str, game_filter: GameFilter) -> str:
+    """
+    Keeps only the games of a PGN text accepted by the filter. The rejected games are cut
+    out of the text before any move is parsed.
+    """
+    return "".join(game for game in _split_games(text) if game_filter.accepts(game))
+
+
+def build_pgn_index(path: str, headers=True) -> PgnIndex:
+    """
+    Scans a PGN file for the start of every game. With headers, also parses the indexed
+    header fields and counts the plies (slower, but still without building games).
+    """
+    offsets, white_elo, black_elo, results, plies = [], [], [], [], []
+    movetext = []
+    offset = 0
+    mtime_ns = os.stat(path).st_mtime_ns
+    # Games start like in _game_starts: the first line with content, then every tag line after movetext
+    after_movetext = True
+    with open(path, "rb") as file:
+        for line in file:
+            if line.strip():
+                is_tag = line.startswith(b"[")
+                if after_movetext and (is_tag or not offsets):
+                    if headers and offsets:
+                        plies.append(_count_plies(b"".join(movetext).decode()))
+                    offsets.append(offset)
+                    white_elo.append(0)
+                    black_elo.append(0)
+                    results.append(0)
+                    movetext = []
+                after_movetext = not is_tag
+            if headers and offsets:
+                match = _HEADER_TEXT.match(line.decode()) if line.startswith(b"[") else None
+                if match is None:
+                    movetext.append(line)
+                elif match[1] == "WhiteElo":
+                    white_elo[-1] = _parse_elo(match[2])
+                elif match[1] == "BlackElo":
+                    black_elo[-1] = _parse_elo(match[2])
+                elif match[1] == "Result" and match[2] in RESULTS:
+                    results[-1] = RESULTS.index(match[2])
+            offset += len(line)
+    if headers and offsets:
+        plies.append(_count_plies(b"".join(movetext).decode()))
+
+    if not headers:
+        return PgnIndex(offsets + [offset], mtime_ns=mtime_ns)
+    return PgnIndex(offsets + [offset], white_elo, black_elo, results, plies, mtime_ns=mtime_ns, headers=True)
+
+
+def pgn_index_path(path: str) -> str:
+    return path + ".idx.npz"
+
+
+def load_pgn_index(path: str, headers=True) -> PgnIndex:
+    """
+    Loads the sidecar index of a PGN file. The index is (re)built and saved if it does not
+    exist, if the PGN file changed since it was built or if it lacks the headers asked for.
+    """
+    index_path = pgn_index_path(path)
+    stat = os.stat(path)
+    if os.path.exists(index_path):
+        index = PgnIndex.load(index_path)
+        current = int(index.offsets[-1]) == stat.st_size and index.mtime_ns == stat.st_mtime_ns
+        if current and (index.headers or not headers):
+            return index
+
+    index = build_pgn_index(path, headers)
+    index.save(index_path)
+    return index
+
+
+def read_game_at(path: str, index: PgnIndex, number: int) -> chess.pgn.Game:
+    """
+    Reads the game with the given number (0 based) using the index to jump straight to it.
+    """
+    start, end = index.byte_range(number, number + 1)
+    with open(path, "rb") as file:
+        file.seek(start)
+        return chess.pgn.read_game(io.StringIO(file.read(end - start).decode()))
@@ -0,0 +1,230 @@
+"""
+Statistics of the positions reached in the ingested games: for every position (keyed on the
+hash of its board tokens, the keys of chess_jepa.evaluations.board_keys) the number of
+visits, the results of the games that went through it and the distribution of the moves
+played next (an opening tree).
+
+The index is built in bounded memory: the (position, move, result) records are spilled to
+bucket files by the top bits of the key, then every bucket is aggregated on its own. The
+result are two flat arrays sorted by key, memory mapped for lookups:
+- positions.bin: key, visits, white wins, draws, black wins, first move and number of moves
+- moves.bin: move code and count, for every position sorted by decreasing count
+"""
+
+import os
+
+import chess
+import numpy as np
+
+from .evaluations import board_keys, sample_board_keys
+from .pgn import board_state
+from .replay import replay_games
+from .storage import RESULTS
+from .tokenizer import BOARD_STATE_SIZE, encode_boards
+
+RECORD_DTYPE = np.dtype([("key", "<u8"), ("move", "<u2"), ("result", "u1")])
+POSITION_DTYPE = np.dtype(
+    [
+        ("key", "<u8"),
+        ("visits", "<u4"),
+        ("white", "<u4"),
+        ("draws", "<u4"),
+        ("black", "<u4"),
+        ("first_move", "<u8"),
+        ("moves", "<u4"),
+    ]
+)
+MOVE_DTYPE = np.dtype([("move", "<u2"), ("count", "<u4")])
+
+_STANDARD_START = board_state(chess.Board())
+
+
+def position_hashes(states: np.ndarray, batch_size=1 << 14) -> np.ndarray:
+    """
+    Keys (uint64) of board states (rows of BOARD_STATE_SIZE, see board_state): the keys of
+    their board tokens, the same as the evaluations and the boards of the training samples.
+    """
+    states = np.asarray(states, dtype=np.uint64).reshape(-1, BOARD_STATE_SIZE)
+    hashes = np.empty(len(states), dtype=np.uint64)
+    for start in range(0, len(states), batch_size):
+        hashes[start : start + batch_size] = board_keys(encode_boards(states[start : start + batch_size]))
+    return hashes
+
+
+def _bucket_path(path: str, bucket: int) -> str:
+    return os.path.join(path, f"bucket-{bucket:04d}.tmp")
+
+
+class PositionIndexBuilder:
+    """
+    Builds the position index in the directory path from games added in any number of calls.
+    Records are kept in memory up to buffer_records, then spilled to 2**bucket_bits bucket
+    files, so the memory used by finalize is about the size of a bucket. The state (size of
+    the bucket files) can be saved with the progress of a run and given back to continue it.
+    """
+
+    def __init__(self, path: str, bucket_bits=8, buffer_records=1 << 22, state: dict = None):
+        self.path = path
+        self.bucket_bits = bucket_bits
+        self.buffer_records = buffer_records
+        self.records = []
+        self.buffered = 0
+
+        os.makedirs(path, exist_ok=True)
+        sizes = state["buckets"] if state is not None else [0] * (1 << bucket_bits)
+        for bucket, size in enumerate(sizes):
+            with open(_bucket_path(path, bucket), "ab") as file:
+                file.truncate(size)
+
+    def add_games(self, games: list[np.ndarray], results: list[str], starts: list = None):
+        """
+        Adds the positions before every move of the games (move codes) with the move played
+        and the result of the game. Games start from the standard starting position, or from
+        the given board states (None for the standard starting position).
+        """
+        if not games:
+            return
+        if starts is not None and any(start is not None for start in starts):
+            starts = [_STANDARD_START if start is None else start for start in starts]
+        else:
+            starts = None
+        states, offsets = replay_games(games, starts)
+        lengths = np.diff(offsets) - 1
+        # Every state but the last one of every game is followed by a move
+        followed = np.ones(len(states), dtype=bool)
+        followed[offsets[1:] - 1] = False
+
+        records = np.empty(int(lengths.sum()), dtype=RECORD_DTYPE)
+        records["key"] = position_hashes(states[followed])
+        records["move"] = np.concatenate(games) if len(records) else []
+        result_codes = [RESULTS.index(result) if result in RESULTS else 0 for result in results]
+        records["result"] = np.repeat(result_codes, lengths)
+
+        self.records.append(records)
+        self.buffered += len(records)
+        if self.buffered >= self.buffer_records:
+            self.flush()
+
+    def flush(self):
+        """
+        Spills the buffered records to the bucket files.
+        """
+        if not self.records:
+            return
+        records = np.concatenate(self.records)
+        self.records, self.buffered = [], 0
+
+        buckets = (records["key"] >> np.uint64(64 - self.bucket_bits)).astype(np.int64)
+        order = np.argsort(buckets, kind="stable")
+        records, buckets = records[order], buckets[order]
+        bounds = np.searchsorted(buckets, np.arange((1 << self.bucket_bits) + 1))
+        for bucket in np.unique(buckets).tolist():
+            with open(_bucket_path(self.path, bucket), "ab") as file:
+                records[bounds[bucket] : bounds[bucket + 1]].tofile(file)
+
+    def state(self) -> dict:
+        """
+        Size of every bucket file, call after flush.
+        """
+        return {"buckets": [os.path.getsize(_bucket_path(self.path, bucket)) for bucket in range(1 << self.bucket_bits)]}
+
+    def finalize(self):
+        """
+        Aggregates the buckets into positions.bin and moves.bin (in key order) and removes them.
+        """
+        self.flush()
+        moves_count = 0
+        with open(os.path.join(self.path, "positions.bin"), "wb") as positions_file, open(
+            os.path.join(self.path, "moves.bin"), "wb"
+        ) as moves_file:
+            for bucket in range(1 << self.bucket_bits):
+                positions, moves = _aggregate(np.fromfile(_bucket_path(self.path, bucket), dtype=RECORD_DTYPE))
+                positions["first_move"] += moves_count
+                moves_count += len(moves)
+                positions.tofile(positions_file)
+                moves.tofile(moves_file)
+        for bucket in range(1 << self.bucket_bits):
+            os.remove(_bucket_path(self.path, bucket))
+
+
+def _aggregate(records: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    # Statistics of every position and its moves from the records of a bucket
+    records = records[np.lexsort((records["move"], records["key"]))]
+    keys, moves = records["key"], records["move"]
+
+    # Segments of equal keys (positions) and equal (key, move) pairs
+    new_key = np.ones(len(records), dtype=bool)
+    new_key[1:] = keys[1:] != keys[:-1]
+    new_pair = new_key.copy()
+    new_pair[1:] |= moves[1:] != moves[:-1]
+    key_starts, pair_starts = np.flatnonzero(new_key), np.flatnonzero(new_pair)
+
+    positions = np.zeros(len(key_starts), dtype=POSITION_DTYPE)
+    positions["key"] = keys[key_starts]
+    positions["visits"] = np.diff(np.append(key_starts, len(records)))
+    for field, result in (("white", "1-0"), ("draws", "1/2-1/2"), ("black", "0-1")):
+        wins = (records["result"] == RESULTS.index(result)).astype(np.int64)
+        positions[field] = np.add.reduceat(wins, key_starts) if len(records) else []
+
+    # Moves of every position, the most played first
+    pair_counts = np.diff(np.append(pair_starts, len(records)))
+    pair_positions = np.cumsum(new_key)[pair_starts] - 1
+    order = np.lexsort((-pair_counts, pair_positions))
+    next_moves = np.empty(len(pair_starts), dtype=MOVE_DTYPE)
+    next_moves["move"] = moves[pair_starts][order]
+    next_moves["count"] = pair_counts[order]
+
+    positions["moves"] = np.bincount(pair_positions, minlength=len(key_starts))
+    positions["first_move"] = np.cumsum(positions["moves"]) - positions["moves"]
+    return positions, next_moves
+
+
+class PositionIndex:
+    """
+    Lookups in a position index built by PositionIndexBuilder (memory mapped, binary search
+    over the sorted keys).
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.positions = _read_array(os.path.join(path, "positions.bin"), POSITION_DTYPE)
+        self.next_moves = _read_array(os.path.join(path, "moves.bin"), MOVE_DTYPE)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def lookup(self, keys) -> np.ndarray:
+        """
+        Statistics (POSITION_DTYPE records) of the positions with the given keys, all zero
+        (but the key) for the positions never seen.
+        """
+        keys = np.asarray(keys, dtype=np.uint64)
+        found = np.minimum(np.searchsorted(self.positions["key"], keys), max(len(self.positions) - 1, 0))
+        result = np.zeros(len(keys), dtype=POSITION_DTYPE)
+        if len(self.positions):
+            known = self.positions["key"][found] == keys
+            result[known] = self.positions[found[known]]
+        result["key"] = keys
+        return result
+
+    def lookup_samples(self, tokens: np.ndarray, window_size: int) -> np.ndarray:
+        """
+        Statistics of the board of every training sample (rows of tokens).
+        """
+        return self.lookup(sample_board_keys(tokens, window_size))
+
+    def visits(self, keys) -> np.ndarray:
+        return self.lookup(keys)["visits"]
+
+    def moves(self, key: int) -> np.ndarray:
+        """
+        Moves played from the position (MOVE_DTYPE records), the most played first.
+        """
+        position = self.lookup([key])[0]
+        return self.next_moves[int(position["first_move"]) : int(position["first_move"]) + int(position["moves"])]
+
+
+def _read_array(path: str, dtype: np.dtype) -> np.ndarray:
+    if os.path.getsize(path) == 0:
+        return np.empty(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
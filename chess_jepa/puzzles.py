@@ -0,0 +1,181 @@
+"""
+The Lichess puzzle database (https://database.lichess.org/#puzzles, CSV) as training samples.
+
+Every puzzle gives one sample in the layout of extract_training_samples: the move that sets
+up the puzzle (the first of its moves, played by the opponent) in the last before slot, the
+board at the start of the puzzle, and the solution moves in the after slots (the first
+window_size of them, padded). The rest of the game is unknown, so there is no start or
+result token.
+"""
+
+import csv
+import functools
+import hashlib
+import io
+
+import chess
+import numpy as np
+
+from .compressed import read_line_chunks
+from .pgn import board_state, map_chunks, move_code
+from .tokenizer import BOARD_STATE_SIZE, PADDING_TOKEN, default_vocabulary, encode_boards, encode_moves, sample_length
+
+PUZZLE_COLUMNS = [
+    "PuzzleId",
+    "FEN",
+    "Moves",
+    "Rating",
+    "RatingDeviation",
+    "Popularity",
+    "NbPlays",
+    "Themes",
+    "GameUrl",
+    "OpeningTags",
+]
+
+
+class PuzzleFilter:
+    """
+    Accepts or rejects puzzles on their CSV fields:
+    - min_rating, max_rating: range of the puzzle Rating (None for no maximum)
+    - themes: the puzzle needs at least one of these themes (e.g. {"mateIn3", "sacrifice"})
+    - exclude_themes: the puzzle has none of these themes
+    """
+
+    def __init__(self, min_rating=0, max_rating=None, themes=None, exclude_themes=None):
+        self.min_rating = min_rating
+        self.max_rating = max_rating
+        self.themes = set(themes) if themes else None
+        self.exclude_themes = set(exclude_themes) if exclude_themes else None
+
+    def accepts(self, puzzle: dict[str, str]) -> bool:
+        rating = int(puzzle["Rating"]) if puzzle.get("Rating", "").isdigit() else 0
+        if rating < self.min_rating or (self.max_rating is not None and rating > self.max_rating):
+            return False
+        themes = set(puzzle.get("Themes", "").split())
+        if self.themes is not None and not themes & self.themes:
+            return False
+        if self.exclude_themes is not None and themes & self.exclude_themes:
+            return False
+        return True
+
+
+def read_puzzles(input, puzzle_filter: PuzzleFilter = None):
+    """
+    Yields the puzzles (dict of the CSV fields) of a CSV text or text stream, with or without
+    the header line. Puzzles rejected by the puzzle_filter are skipped.
+    """
+    if isinstance(input, str):
+        input = io.StringIO(input)
+    for row in csv.reader(input):
+        if not row or row[0] == PUZZLE_COLUMNS[0]:
+            continue
+        puzzle = dict(zip(PUZZLE_COLUMNS, row))
+        if puzzle_filter is None or puzzle_filter.accepts(puzzle):
+            yield puzzle
+
+
+def puzzle_hash(puzzle_id: str) -> int:
+    """
+    Stable 64-bit hash of a puzzle id, used to split the puzzles between the training and
+    evaluation sets.
+    """
+    return int.from_bytes(hashlib.blake2b(puzzle_id.encode(), digest_size=8).digest(), "little")
+
+
+def _play_puzzle(puzzle: dict[str, str]):
+    # Board at the start of the puzzle (after the setup move), setup move and solution moves,
+    # None if a move is not legal
+    board = chess.Board(puzzle["FEN"])
+    moves = [chess.Move.from_uci(move) for move in puzzle["Moves"].split()]
+    if len(moves) < 2 or moves[0] not in board.legal_moves:
+        return None
+    board.push(moves[0])
+    start = board.copy(stack=False)
+    for move in moves[1:]:
+        if move not in board.legal_moves:
+            return None
+        board.push(move)
+    return start, moves[0], moves[1:]
+
+
+def extract_puzzle_samples(input, window_size=5, puzzle_filter: PuzzleFilter = None):
+    """
+    Yields the training sample (string of tokens) of every puzzle of the input (CSV text or
+    text stream), see extract_puzzle_tokens for the same samples encoded.
+    """
+    for puzzle in read_puzzles(input, puzzle_filter):
+        played = _play_puzzle(puzzle)
+        if played is None:
+            continue
+        board, setup, solution = played
+        after_moves = [move.uci() for move in solution[:window_size]]
+        yield " ".join(
+            [PADDING_TOKEN] * (window_size - 1)
+            + [setup.uci()]
+            + board.fen().split(" ")[:-2]
+            + after_moves
+            + [PADDING_TOKEN] * (window_size - len(after_moves))
+        )
+
+
+def encode_puzzles(boards: np.ndarray, setups: np.ndarray, solutions: list, window_size: int, dtype=np.uint8):
+    """
+    Encodes puzzles into training samples, one row each: the board states at the start of
+    the puzzles (see board_state), the setup move codes and the solution move codes.
+    """
+    count = len(setups)
+    padding = default_vocabulary.get_index(PADDING_TOKEN)
+    tokens = np.empty((count, sample_length(window_size)), dtype=dtype)
+
+    before = np.full((count, window_size, 2), padding, dtype=np.uint8)
+    before[:, -1] = encode_moves(setups)
+
+    # The first window_size moves of every solution, at their slot of the after window
+    lengths = np.array([min(len(solution), window_size) for solution in solutions], dtype=np.int64)
+    moves = [solution[:window_size] for solution in solutions]
+    moves = np.concatenate(moves) if count else np.empty(0, dtype=np.int64)
+    rows = np.repeat(np.arange(count), lengths)
+    slots = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    after = np.full((count, window_size, 2), padding, dtype=np.uint8)
+    after[rows, slots] = encode_moves(moves)
+
+    tokens[:, : 2 * window_size] = before.reshape(count, -1)
+    tokens[:, 2 * window_size : -2 * window_size] = encode_boards(boards)
+    tokens[:, -2 * window_size :] = after.reshape(count, -1)
+    return tokens
+
+
+def extract_puzzle_tokens(input, window_size=5, puzzle_filter: PuzzleFilter = None, dtype=np.uint8):
+    """
+    Encoded training samples of the puzzles of the input (CSV text or text stream), one row
+    per puzzle, and the puzzle_hash of every puzzle (uint64).
+    """
+    boards, setups, solutions, hashes = [], [], [], []
+    for puzzle in read_puzzles(input, puzzle_filter):
+        played = _play_puzzle(puzzle)
+        if played is None:
+            continue
+        board, setup, solution = played
+        boards.append(board_state(board))
+        setups.append(move_code(setup))
+        solutions.append(np.array([move_code(move) for move in solution], dtype=np.int64))
+        hashes.append(puzzle_hash(puzzle["PuzzleId"]))
+
+    boards = np.array(boards, dtype=np.uint64).reshape(-1, BOARD_STATE_SIZE)
+    tokens = encode_puzzles(boards, np.array(setups, dtype=np.int64), solutions, window_size, dtype)
+    return tokens, np.array(hashes, dtype=np.uint64)
+
+
+def _extract_puzzle_tokens_chunk(text: bytes, window_size: int, puzzle_filter: PuzzleFilter = None):
+    return extract_puzzle_tokens(text.decode("utf-8"), window_size, puzzle_filter)
+
+
+def extract_puzzle_tokens_parallel(path: str, window_size=5, workers=None, chunk_size=4 << 20, puzzle_filter=None):
+    """
+    Reads a puzzle CSV file (plain or compressed, e.g. lichess_db_puzzle.csv.zst) in chunks
+    of about chunk_size bytes, encoded in a pool of worker processes. Yields the tokens and
+    puzzle hashes of every chunk (see extract_puzzle_tokens), in file order.
+    """
+    extract = functools.partial(_extract_puzzle_tokens_chunk, window_size=window_size, puzzle_filter=puzzle_filter)
+    yield from map_chunks(extract, read_line_chunks(path, chunk_size), workers)
@@ -0,0 +1,260 @@
+"""
+Array-backed replay of many games at once. The positions are kept as a mailbox (one byte per
+square, pieces numbered from 1 in BOARD_STATE_PIECES order, 0 for empty) for every game, and
+each ply is applied to all the games with numpy: castling, en passant and promotions are
+handled, the moves are expected to be legal (e.g. move codes validated when the PGN was read).
+Castling is the king moving two files: a move onto a piece of the same side (the king taking
+its rook, how python-chess writes castling in Chess960) raises a ValueError. The output are
+the board states of chess_jepa.pgn.board_state, the input of encode_game.
+"""
+
+import numpy as np
+
+from .tokenizer import BOARD_STATE_PIECES, BOARD_STATE_SIZE, NO_EN_PASSANT
+
+_PIECES = len(BOARD_STATE_PIECES)
+_PAWN, _KING = 1, 6
+_BLACK = 6  # Offset of the black pieces
+
+# Castling rights lost when a move starts or ends on a square (KQkq mask)
+_CASTLING_LOST = np.zeros(64, dtype=np.uint8)
+_CASTLING_LOST[[4, 7, 0]] = [1 | 2, 1, 2]
+_CASTLING_LOST[[60, 63, 56]] = [4 | 8, 4, 8]
+
+
+def _initialize_start() -> np.ndarray:
+    mailbox = np.zeros(64, dtype=np.uint8)
+    mailbox[:8] = [4, 2, 3, 5, 6, 3, 2, 4]
+    mailbox[8:16] = _PAWN
+    mailbox[48:56] = _PAWN + _BLACK
+    mailbox[56:] = mailbox[:8] + _BLACK
+    return mailbox
+
+
+_START = _initialize_start()
+_START_STATE = (1, 15, NO_EN_PASSANT)  # White to move, all castling rights, no en passant
+_SAME_SIDE_CAPTURE = "Move onto a piece of the same side (Chess960 castling), only standard castling is supported"
+
+_KNIGHT_STEPS = [(1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1), (-2, 1), (-1, 2)]
+_KING_STEPS = [(1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1), (0, -1), (1, -1)]
+_ROOK_DIRECTIONS = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+_BISHOP_DIRECTIONS = [(1, 1), (-1, 1), (-1, -1), (1, -1)]
+
+
+def _attacked(mailbox: list[int], square: int, white: bool) -> bool:
+    """
+    Whether the square is attacked by the pieces of the other side than white.
+    """
+    enemy = _BLACK if white else 0
+    file, rank = square & 7, square >> 3
+
+    def piece_at(step_file, step_rank):
+        if 0 <= file + step_file < 8 and 0 <= rank + step_rank < 8:
+            return mailbox[(rank + step_rank) * 8 + file + step_file]
+        return None
+
+    pawn_rank = 1 if white else -1
+    if _PAWN + enemy in (piece_at(-1, pawn_rank), piece_at(1, pawn_rank)):
+        return True
+    if any(piece_at(*step) == 2 + enemy for step in _KNIGHT_STEPS):
+        return True
+    if any(piece_at(*step) == _KING + enemy for step in _KING_STEPS):
+        return True
+    for directions, slider in ((_ROOK_DIRECTIONS, 4 + enemy), (_BISHOP_DIRECTIONS, 3 + enemy)):
+        for step_file, step_rank in directions:
+            distance = 1
+            while (piece := piece_at(step_file * distance, step_rank * distance)) == 0:
+                distance += 1
+            if piece in (slider, 5 + enemy):
+                return True
+    return False
+
+
+def _legal_en_passant(mailbox: list[int], pushed: int, white: bool) -> bool:
+    """
+    Whether white (or black) to move can capture en passant the pawn just pushed two squares
+    to the pushed square, without leaving its king in check.
+    """
+    pawn = _PAWN + (0 if white else _BLACK)
+    target = pushed + (8 if white else -8)
+    king = mailbox.index(_KING + (0 if white else _BLACK))
+    for square in (pushed - 1, pushed + 1):
+        if (square >> 3) != (pushed >> 3) or mailbox[square] != pawn:
+            continue
+        after = mailbox.copy()
+        after[square], after[pushed], after[target] = 0, 0, pawn
+        if not _attacked(after, king, white):
+            return True
+    return False
+
+
+_SQUARE_BITS = np.left_shift(np.uint64(1), np.arange(64, dtype=np.uint64))
+
+
+def _bitboards(mailbox: np.ndarray) -> np.ndarray:
+    # Bitboard of every piece: one bit per square where the mailbox holds it
+    bits = mailbox[:, None, :] == np.arange(1, _PIECES + 1, dtype=np.uint8)[:, None]
+    return np.packbits(bits, axis=2, bitorder="little").view("<u8")[:, :, 0].astype(np.uint64)
+
+
+_START_BOARD_STATE = np.concatenate((_bitboards(_START[None])[0], np.array(_START_STATE, dtype=np.uint64)))
+
+
+def _replay_game(moves: np.ndarray, start: np.ndarray) -> np.ndarray:
+    """
+    Same as replay_games for a single game, with Python integers: faster than numpy when only
+    a few games are replayed together.
+    """
+    bitboards = [int(bitboard) for bitboard in start[:_PIECES]]
+    mailbox = [0] * 64
+    for index, bitboard in enumerate(bitboards):
+        while bitboard:
+            square = (bitboard & -bitboard).bit_length() - 1
+            mailbox[square] = index + 1
+            bitboard &= bitboard - 1
+    turn, castling, en_passant = (int(value) for value in start[_PIECES:])
+
+    states = [bitboards + [turn, castling, en_passant]]
+    for code in moves.tolist():
+        source, target, promotion = code & 63, (code >> 6) & 63, code >> 12
+        white = turn == 1
+        piece, captured = mailbox[source], mailbox[target]
+        if captured and (captured > _BLACK) == (piece > _BLACK):
+            raise ValueError(_SAME_SIDE_CAPTURE)
+        pawn = piece in (_PAWN, _PAWN + _BLACK)
+        if captured:
+            bitboards[captured - 1] ^= 1 << target
+        elif pawn and (source & 7) != (target & 7):
+            behind = target - 8 if white else target + 8
+            bitboards[mailbox[behind] - 1] ^= 1 << behind
+            mailbox[behind] = 0
+
+        moved = promotion + (0 if white else _BLACK) if promotion else piece
+        mailbox[source], mailbox[target] = 0, moved
+        bitboards[piece - 1] ^= 1 << source
+        bitboards[moved - 1] ^= 1 << target
+
+        if piece in (_KING, _KING + _BLACK) and abs((target & 7) - (source & 7)) == 2:
+            rook_source, rook_target = (target + 1, target - 1) if target > source else (target - 2, target + 1)
+            rook = mailbox[rook_source]
+            mailbox[rook_source], mailbox[rook_target] = 0, rook
+            bitboards[rook - 1] ^= 1 << rook_source | 1 << rook_target
+
+        castling &= ~int(_CASTLING_LOST[source] | _CASTLING_LOST[target])
+        turn ^= 1
+        en_passant = NO_EN_PASSANT
+        if pawn and abs(target - source) == 16 and _legal_en_passant(mailbox, target, not white):
+            en_passant = (source + target) // 2
+        states.append(bitboards + [turn, castling, en_passant])
+    return np.array(states, dtype=np.uint64)
+
+
+# Below this many games, replaying them one by one with Python integers is faster
+_VECTORIZED_GAMES = 32
+
+
+def replay_games(games: list[np.ndarray], starts: np.ndarray = None) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Plays the move codes of many games at once, from the standard starting position or from
+    the given board states (one row per game). Returns the board states of all the games one
+    after the other, for every game the states before every move and after the last one, and
+    the offset of the first state of every game (the last entry is the number of states).
+    """
+    lengths = np.array([len(moves) for moves in games], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths + 1)))
+    if len(games) < _VECTORIZED_GAMES:
+        if starts is None:
+            starts = np.tile(_START_BOARD_STATE, (len(games), 1))
+        starts = np.asarray(starts, dtype=np.uint64).reshape(-1, BOARD_STATE_SIZE)
+        states = [_replay_game(np.asarray(moves), start) for moves, start in zip(games, starts)]
+        return np.concatenate(states) if states else np.empty((0, BOARD_STATE_SIZE), dtype=np.uint64), offsets
+
+    states = np.empty((offsets[-1], BOARD_STATE_SIZE), dtype=np.uint64)
+
+    # Games sorted by decreasing length, the games still playing at any ply are a prefix
+    order = np.argsort(-lengths, kind="stable")
+    lengths = lengths[order]
+    first = offsets[:-1][order]
+    moves = np.zeros((len(games), lengths[0] if len(games) else 0), dtype=np.int64)
+    for row, game in enumerate(order):
+        moves[row, : lengths[row]] = games[game]
+
+    # Side to move, castling rights and en passant square of every game
+    flags = np.empty((len(games), 3), dtype=np.uint64)
+    if starts is None:
+        mailbox = np.tile(_START, (len(games), 1))
+        flags[:] = _START_STATE
+    else:
+        starts = np.asarray(starts, dtype=np.uint64).reshape(-1, BOARD_STATE_SIZE)[order]
+        bits = np.unpackbits(starts[:, :_PIECES].astype("<u8").view(np.uint8), axis=1, bitorder="little")
+        mailbox = np.einsum("nps,p->ns", bits.reshape(len(games), _PIECES, 64), np.arange(1, _PIECES + 1, dtype=np.uint8))
+        flags[:] = starts[:, _PIECES:]
+    turn, castling, en_passant = flags[:, 0], flags[:, 1], flags[:, 2]
+
+    # The bitboards are updated along with the mailbox, only the squares that change
+    bitboards = _bitboards(mailbox)
+    states[first, :_PIECES] = bitboards
+    states[first, _PIECES:] = flags
+
+    for ply in range(moves.shape[1]):
+        count = int(np.searchsorted(-lengths, -ply, side="left"))  # Games with more than ply moves
+        board, white = mailbox[:count], turn[:count] == 1
+        rows = np.arange(count)
+        codes = moves[:count, ply]
+        source, target, promotion = codes & 63, (codes >> 6) & 63, codes >> 12
+
+        piece = board[rows, source].astype(np.int64)
+        captured = board[rows, target].astype(np.int64)
+        if ((captured > 0) & ((captured > _BLACK) == (piece > _BLACK))).any():
+            raise ValueError(_SAME_SIDE_CAPTURE)
+        pawn = (piece == _PAWN) | (piece == _PAWN + _BLACK)
+
+        # Captures on the target square
+        captures = np.flatnonzero(captured)
+        bitboards[captures, captured[captures] - 1] ^= _SQUARE_BITS[target[captures]]
+
+        # En passant: a pawn moving to another file onto an empty square captures behind it
+        captures = np.flatnonzero(pawn & ((source & 7) != (target & 7)) & (captured == 0))
+        behind = target[captures] + np.where(white[captures], -8, 8)
+        bitboards[captures, board[captures, behind].astype(np.int64) - 1] ^= _SQUARE_BITS[behind]
+        board[captures, behind] = 0
+
+        # Promotions use the same piece numbers as python-chess piece types
+        moved = np.where(promotion > 0, promotion + np.where(white, 0, _BLACK), piece)
+        board[rows, source] = 0
+        board[rows, target] = moved
+        bitboards[rows, piece - 1] ^= _SQUARE_BITS[source]
+        bitboards[rows, moved - 1] ^= _SQUARE_BITS[target]
+
+        # Castling: the king moves two files, the rook jumps over it
+        king = (piece == _KING) | (piece == _KING + _BLACK)
+        castles = np.flatnonzero(king & (np.abs((target & 7) - (source & 7)) == 2))
+        kingside = target[castles] > source[castles]
+        rook_source = np.where(kingside, target[castles] + 1, target[castles] - 2)
+        rook_target = np.where(kingside, target[castles] - 1, target[castles] + 1)
+        rook = board[castles, rook_source].astype(np.int64)
+        board[castles, rook_target] = rook
+        board[castles, rook_source] = 0
+        bitboards[castles, rook - 1] ^= _SQUARE_BITS[rook_source] | _SQUARE_BITS[rook_target]
+
+        castling[:count] &= ~(_CASTLING_LOST[source] | _CASTLING_LOST[target])
+        turn[:count] ^= 1
+
+        # En passant square only when the other side can actually capture (as board_state)
+        en_passant[:count] = NO_EN_PASSANT
+        pushes = np.flatnonzero(pawn & (np.abs(target - source) == 16))
+        if len(pushes):
+            # Only a pawn of the other side next to the pushed one can capture, checked in full
+            enemy_pawn = np.where(white[pushes], _PAWN + _BLACK, _PAWN)
+            file = target[pushes] & 7
+            left = (file > 0) & (board[pushes, np.maximum(target[pushes] - 1, 0)] == enemy_pawn)
+            right = (file < 7) & (board[pushes, np.minimum(target[pushes] + 1, 63)] == enemy_pawn)
+            pushes = pushes[left | right]
+        for row in pushes.tolist():
+            if _legal_en_passant(board[row].tolist(), int(target[row]), not white[row]):
+                en_passant[row] = (source[row] + target[row]) // 2
+
+        rows = first[:count] + ply + 1
+        states[rows, :_PIECES] = bitboards[:count]
+        states[rows, _PIECES:] = flags[:count]
+    return states, offsets
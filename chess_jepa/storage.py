@@ -0,0 +1,523 @@
+"""
+Compact on-disk format for encoded training samples. A small fixed size header followed by
+a dense matrix of tokens with one row per sample. All the samples in a file have the same
+length, so the file can be memory mapped and sample i is found at a fixed offset.
+
+Large outputs are split in shards of a bounded size, listed in a JSON manifest.
+"""
+
+import json
+import os
+import queue
+import struct
+import threading
+
+import numpy as np
+
+from .tokenizer import default_vocabulary
+
+MAGIC = b"CHSJEPA\0"
+VERSION = 1
+
+# Header layout: magic, version, dtype code, window size, sample length, vocabulary hash,
+# padded with zeros to HEADER_SIZE bytes so that the tokens start at an aligned offset.
+HEADER_SIZE = 64
+_HEADER_FORMAT = "<8sIIIIQ"
+
+# Token dtypes that can be stored, the code is written in the header
+_DTYPES = {1: np.dtype(np.uint8), 2: np.dtype("<u2")}
+_DTYPE_CODES = {dtype: code for code, dtype in _DTYPES.items()}
+
+
+class TokenFileHeader:
+    def __init__(self, window_size: int, sample_length: int, dtype=np.uint8, vocabulary_hash=None, version=VERSION):
+        self.window_size = window_size
+        self.sample_length = sample_length
+        self.dtype = np.dtype(dtype)
+        self.vocabulary_hash = default_vocabulary.fingerprint() if vocabulary_hash is None else vocabulary_hash
+        self.version = version
+
+    def pack(self) -> bytes:
+        header = struct.pack(
+            _HEADER_FORMAT,
+            MAGIC,
+            self.version,
+            _DTYPE_CODES[self.dtype],
+            self.window_size,
+            self.sample_length,
+            self.vocabulary_hash,
+        )
+        return header.ljust(HEADER_SIZE, b"\0")
+
+    @staticmethod
+    def unpack(data: bytes) -> "TokenFileHeader":
+        if len(data) < HEADER_SIZE:
+            raise ValueError("Token file is too short for the header")
+        magic, version, dtype, window_size, sample_length, vocabulary_hash = struct.unpack_from(_HEADER_FORMAT, data)
+        if magic != MAGIC:
+            raise ValueError("Not a token file (wrong magic)")
+        if version != VERSION:
+            raise ValueError(f"Unsupported token file version: {version}")
+        if dtype not in _DTYPES:
+            raise ValueError(f"Unsupported token dtype code: {dtype}")
+        return TokenFileHeader(window_size, sample_length, _DTYPES[dtype], vocabulary_hash, version)
+
+    def __eq__(self, other) -> bool:
+        return self.pack() == other.pack()
+
+    def __repr__(self):
+        return (
+            f"TokenFileHeader(window_size={self.window_size}, sample_length={self.sample_length}, "
+            f"dtype={self.dtype}, vocabulary_hash={self.vocabulary_hash:#018x})"
+        )
+
+
+def read_header(path: str) -> TokenFileHeader:
+    with open(path, "rb") as file:
+        return TokenFileHeader.unpack(file.read(HEADER_SIZE))
+
+
+def read_tokens(path: str, mmap=True, check_vocabulary=True) -> np.ndarray:
+    """
+    Returns the samples of a token file as a 2D array, memory mapped by default. A partial
+    sample at the end of the file (interrupted write) is ignored.
+    """
+    header = read_header(path)
+    if check_vocabulary and header.vocabulary_hash != default_vocabulary.fingerprint():
+        raise ValueError(f"Token file {path} was written with a different vocabulary")
+
+    row_size = header.sample_length * header.dtype.itemsize
+    count = (os.path.getsize(path) - HEADER_SIZE) // row_size
+    if not mmap:
+        with open(path, "rb") as file:
+            file.seek(HEADER_SIZE)
+            return np.fromfile(file, dtype=header.dtype, count=count * header.sample_length).reshape(
+                count, header.sample_length
+            )
+    if count == 0:
+        return np.empty((0, header.sample_length), dtype=header.dtype)
+    return np.memmap(path, dtype=header.dtype, mode="r", offset=HEADER_SIZE, shape=(count, header.sample_length))
+
+
+# Writes are batched in memory and issued in blocks of this many bytes
+DEFAULT_BUFFER_SIZE = 16 << 20
+
+
+class BufferedOutput:
+    """
+    Output file written in large blocks: small writes are collected in memory until the
+    buffer is full. With background=True the blocks are written by a separate thread, so
+    that the disk writes overlap with the work of the caller (flush waits for them).
+    """
+
+    def __init__(self, path: str, append=False, buffer_size=DEFAULT_BUFFER_SIZE, background=False):
+        self.file = open(path, "ab" if append else "wb", buffering=0)
+        self.position = self.file.tell()
+        self.buffer = bytearray()
+        self.buffer_size = buffer_size
+        self.error = None
+        self.queue = None
+        if background:
+            self.queue = queue.Queue(maxsize=2)
+            self.thread = threading.Thread(target=self._write_blocks, daemon=True)
+            self.thread.start()
+
+    def _write_blocks(self):
+        while True:
+            block = self.queue.get()
+            try:
+                if block is None:
+                    return
+                if self.error is None:
+                    self.file.write(block)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def _write_buffer(self):
+        if self.buffer:
+            if self.queue is None:
+                self.file.write(self.buffer)
+            else:
+                self.queue.put(self.buffer)
+            self.buffer = bytearray()
+
+    def _check_error(self):
+        if self.error is not None:
+            raise self.error
+
+    def write(self, data):
+        self._check_error()
+        self.buffer += data
+        self.position += len(memoryview(data).cast("B"))
+        if len(self.buffer) >= self.buffer_size:
+            self._write_buffer()
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        self._write_buffer()
+        if self.queue is not None:
+            self.queue.join()
+        self._check_error()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.queue is not None:
+                self.queue.put(None)
+                self.thread.join()
+            self.file.close()
+
+
+class _Writer:
+    """
+    Common part of the writers: buffered output file (self.file) and context manager.
+    """
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def abort(self):
+        # Closes the file as it is, without finishing it (e.g. the table of a GameWriter)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TokenWriter(_Writer):
+    """
+    Writes samples to a token file. In append mode an existing file must have the same
+    header, a partial sample at its end is dropped.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        window_size: int,
+        sample_length: int,
+        dtype=np.uint8,
+        append=False,
+        buffer_size=DEFAULT_BUFFER_SIZE,
+        background=False,
+    ):
+        self.header = TokenFileHeader(window_size, sample_length, dtype)
+        self.path = path
+
+        self.row_size = sample_length * self.header.dtype.itemsize
+        if append and os.path.exists(path) and os.path.getsize(path) > 0:
+            existing = read_header(path)
+            if existing != self.header:
+                raise ValueError(f"Token file {path} has a different header: {existing}")
+            self.records = (os.path.getsize(path) - HEADER_SIZE) // self.row_size
+            os.truncate(path, HEADER_SIZE + self.records * self.row_size)
+            self.file = BufferedOutput(path, True, buffer_size, background)
+        else:
+            self.records = 0
+            self.file = BufferedOutput(path, False, buffer_size, background)
+            self.file.write(self.header.pack())
+
+    def write(self, tokens: np.ndarray):
+        tokens = np.asarray(tokens)
+        if tokens.ndim != 2 or tokens.shape[1] != self.header.sample_length:
+            raise ValueError(f"Expected samples of {self.header.sample_length} tokens, got shape {tokens.shape}")
+        self.file.write(np.ascontiguousarray(tokens, dtype=self.header.dtype).data)
+        self.records += len(tokens)
+
+
+# Results of the games as stored in game-packed files and in the PGN and position indexes,
+# anything else is stored as unknown (index 0)
+RESULTS = ["*", "1-0", "0-1", "1/2-1/2"]
+
+# Game-packed files store every game once instead of every training sample: after a
+# HEADER_SIZE header (magic, version) come uint16 records of [moves count, result, moves],
+# with the moves as codes (see chess_jepa.tokenizer) and the result as a position in
+# RESULTS. The training windows are rebuilt at read time. A closed file ends
+# with a table of the games (uint16 moves count and uint8 result of every game) and a footer
+# (magic, number of games), so that readers don't have to scan the records.
+GAMES_MAGIC = b"CHSGAMES"
+GAMES_VERSION = 1
+_GAMES_HEADER_FORMAT = "<8sI"
+_GAMES_TABLE_MAGIC = b"CHSTABLE"
+_GAMES_FOOTER_FORMAT = "<8sQ"
+_GAMES_FOOTER_SIZE = struct.calcsize(_GAMES_FOOTER_FORMAT)
+
+
+class GameWriter(_Writer):
+    """
+    Appends games to a game-packed file, the table of the games is written on close. In
+    append mode an existing file must have the same header.
+    """
+
+    def __init__(self, path: str, append=False, buffer_size=DEFAULT_BUFFER_SIZE, background=False):
+        self.path = path
+        if append and os.path.exists(path) and os.path.getsize(path) > 0:
+            games = PackedGames(path)
+            self.records = len(games)
+            self.lengths, self.results = games.lengths.tolist(), games.results.tolist()
+            # Drop the table and a partial record left by an interrupted write
+            os.truncate(path, HEADER_SIZE + 2 * len(games.data))
+            self.file = BufferedOutput(path, True, buffer_size, background)
+        else:
+            self.records = 0
+            self.lengths, self.results = [], []
+            self.file = BufferedOutput(path, False, buffer_size, background)
+            self.file.write(struct.pack(_GAMES_HEADER_FORMAT, GAMES_MAGIC, GAMES_VERSION).ljust(HEADER_SIZE, b"\0"))
+
+    def write(self, moves: np.ndarray, result: str):
+        record = np.empty(len(moves) + 2, dtype="<u2")
+        record[0] = len(moves)
+        record[1] = RESULTS.index(result) if result in RESULTS else 0
+        record[2:] = moves
+        self.file.write(record.data)
+        self.lengths.append(int(record[0]))
+        self.results.append(int(record[1]))
+        self.records += 1
+
+    def close(self):
+        self.file.write(np.array(self.lengths, dtype="<u2").data)
+        self.file.write(np.array(self.results, dtype=np.uint8).data)
+        self.file.write(struct.pack(_GAMES_FOOTER_FORMAT, _GAMES_TABLE_MAGIC, self.records))
+        self.file.close()
+
+
+def _check_games_header(path: str):
+    with open(path, "rb") as file:
+        magic, version = struct.unpack_from(_GAMES_HEADER_FORMAT, file.read(HEADER_SIZE))
+    if magic != GAMES_MAGIC:
+        raise ValueError("Not a game-packed file (wrong magic)")
+    if version != GAMES_VERSION:
+        raise ValueError(f"Unsupported game-packed file version: {version}")
+
+
+def _read_games_table(path: str, size: int):
+    # Moves count and result of every game from the table at the end of a closed file, None
+    # when there is no table or it does not match the records (e.g. a file still written)
+    if size < HEADER_SIZE + _GAMES_FOOTER_SIZE:
+        return None
+    with open(path, "rb") as file:
+        file.seek(size - _GAMES_FOOTER_SIZE)
+        magic, count = struct.unpack(_GAMES_FOOTER_FORMAT, file.read(_GAMES_FOOTER_SIZE))
+    records_size = size - _GAMES_FOOTER_SIZE - 3 * count - HEADER_SIZE
+    if magic != _GAMES_TABLE_MAGIC or records_size < 0 or records_size % 2:
+        return None
+    if count == 0:
+        return (np.empty(0, dtype="<u2"), np.empty(0, dtype=np.uint8)) if records_size == 0 else None
+    lengths = np.memmap(path, dtype="<u2", mode="r", offset=HEADER_SIZE + records_size, shape=(count,))
+    results = np.memmap(path, dtype=np.uint8, mode="r", offset=HEADER_SIZE + records_size + 2 * count, shape=(count,))
+    if 2 * (int(lengths.sum(dtype=np.int64)) + 2 * count) != records_size:
+        return None
+    return lengths, results
+
+
+class PackedGames:
+    """
+    Games of a game-packed file. The moves are memory mapped, the start and length of every
+    game come from the table at the end of the file, or from a scan of the record headers
+    when the file has no table (not closed yet). A partial record at the end of the file
+    (interrupted write) is ignored.
+    """
+
+    def __init__(self, path: str):
+        _check_games_header(path)
+        self.path = path
+        size = os.path.getsize(path)
+        table = _read_games_table(path, size)
+        if table is not None:
+            lengths, results = table
+            count = (size - _GAMES_FOOTER_SIZE - 3 * len(lengths) - HEADER_SIZE) // 2
+            data = np.memmap(path, dtype="<u2", mode="r", offset=HEADER_SIZE, shape=(count,)) if count else None
+            self.lengths = lengths.astype(np.int64)
+            self.starts = np.cumsum(self.lengths + 2) - self.lengths
+            self.results = np.asarray(results)
+        else:
+            count = (size - HEADER_SIZE) // 2
+            data = np.memmap(path, dtype="<u2", mode="r", offset=HEADER_SIZE, shape=(count,)) if count else None
+            starts, lengths, results = [], [], []
+            position = 0
+            while position + 2 <= count:
+                length = int(data[position])
+                if position + 2 + length > count:
+                    break
+                starts.append(position + 2)
+                lengths.append(length)
+                results.append(int(data[position + 1]))
+                position += 2 + length
+            # Only the complete records
+            data = data[:position] if position else None
+            self.starts = np.array(starts, dtype=np.int64)
+            self.lengths = np.array(lengths, dtype=np.int64)
+            self.results = np.array(results, dtype=np.uint8)
+        self.data = data if data is not None else np.empty(0, dtype="<u2")
+
+    def __len__(self):
+        return len(self.starts)
+
+    def moves(self, index: int) -> np.ndarray:
+        return self.data[self.starts[index] : self.starts[index] + self.lengths[index]]
+
+    def result(self, index: int) -> str:
+        return RESULTS[self.results[index]]
+
+
+def manifest_path(path: str) -> str:
+    return path + ".manifest.json"
+
+
+def shard_path(path: str, number: int) -> str:
+    stem, suffix = os.path.splitext(path)
+    return f"{stem}-{number:05d}{suffix}"
+
+
+def read_manifest(path: str) -> dict:
+    with open(manifest_path(path), "r") as file:
+        return json.load(file)
+
+
+def partial_path(path: str) -> str:
+    # Shards are written under this name and renamed when they are complete
+    return path + ".partial"
+
+
+def shard_paths(path: str) -> list:
+    """
+    Paths of the shards written for the output path (e.g. data/train.bin), from its manifest.
+    """
+    directory = os.path.dirname(path)
+    return [os.path.join(directory, shard["path"]) for shard in read_manifest(path)["shards"]]
+
+
+class ShardedWriter:
+    """
+    Writes an output as a sequence of shards ({stem}-00000{suffix}, ...) of about shard_size
+    bytes each (0 for a single shard), with a JSON manifest of the shards next to them that
+    is updated on every flush. open_shard(path, append) opens the writer of a shard (e.g. a
+    TokenWriter). The state (shards and their sizes) can be saved with the progress of a
+    run and given back to continue it, anything written after it is dropped.
+
+    A shard is written under a partial name ({shard}.partial) and renamed once it is complete
+    (when the next one is started, or on close): a file with the final name is never
+    modified again, and the manifest only lists the complete shards. Leaving the context on
+    an error does not close the output: the last shard stays partial and the manifest as of
+    the last flush, to continue from the saved state.
+    """
+
+    def __init__(self, path: str, open_shard, shard_size=0, state: dict = None):
+        self.path = path
+        self.open_shard = open_shard
+        self.shard_size = shard_size
+        self.writer = None
+        self.shards = []
+
+        if state is not None:
+            self.shards = [dict(shard) for shard in state["shards"]]
+
+        # Remove the shards written after the state (all of them when starting from scratch)
+        number = len(self.shards)
+        while os.path.exists(shard_path(path, number)) or os.path.exists(partial_path(shard_path(path, number))):
+            for name in (shard_path(path, number), partial_path(shard_path(path, number))):
+                if os.path.exists(name):
+                    os.remove(name)
+            number += 1
+
+        if self.shards and not self.shards[-1].get("complete"):
+            # Continue the last shard, renamed back if it was completed after the state
+            last = self.shards[-1]
+            last["complete"] = False
+            last_path = os.path.join(os.path.dirname(path), last["path"])
+            if os.path.exists(last_path):
+                os.replace(last_path, partial_path(last_path))
+            os.truncate(partial_path(last_path), last["bytes"])
+            self.writer = self.open_shard(partial_path(last_path), True)
+
+    def _complete_shard(self):
+        # Closing can write more (e.g. the table of a GameWriter), the state has the final size
+        self.writer.close()
+        self.state()
+        self.writer = None
+        last_path = os.path.join(os.path.dirname(self.path), self.shards[-1]["path"])
+        os.replace(partial_path(last_path), last_path)
+        self.shards[-1]["complete"] = True
+
+    def _next_shard(self):
+        if self.writer is not None:
+            self._complete_shard()
+        path = shard_path(self.path, len(self.shards))
+        self.writer = self.open_shard(partial_path(path), False)
+        self.shards.append({"path": os.path.basename(path), "bytes": 0, "records": 0, "complete": False})
+
+    def write(self, *args):
+        if self.writer is None or (self.shard_size and self.writer.tell() >= self.shard_size):
+            self._next_shard()
+        self.writer.write(*args)
+
+    def write_rows(self, rows: np.ndarray):
+        """
+        Writes the rows of a matrix (e.g. samples to a TokenWriter, that has a fixed row_size),
+        split between shards so that every shard stays within shard_size bytes.
+        """
+        while len(rows) > 0:
+            if self.writer is None or (self.shard_size and self.writer.tell() >= self.shard_size):
+                self._next_shard()
+            count = len(rows)
+            if self.shard_size:
+                count = max((self.shard_size - self.writer.tell()) // self.writer.row_size, 1)
+            self.writer.write(rows[:count])
+            rows = rows[count:]
+
+    def state(self) -> dict:
+        if self.writer is not None:
+            self.shards[-1].update(bytes=self.writer.tell(), records=self.writer.records)
+        return {"shards": [dict(shard) for shard in self.shards]}
+
+    def flush(self):
+        if self.writer is not None:
+            self.writer.flush()
+        self._write_manifest()
+
+    def _write_manifest(self):
+        shards = [shard for shard in self.state()["shards"] if shard.get("complete", True)]
+        manifest = {"shards": shards, "records": sum(shard["records"] for shard in shards)}
+        # Write to a temporary file first, readers never see a partial manifest
+        with open(manifest_path(self.path) + ".tmp", "w") as file:
+            json.dump(manifest, file, indent=1)
+        os.replace(manifest_path(self.path) + ".tmp", manifest_path(self.path))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.flush()
+            self._complete_shard()
+        self._write_manifest()
+
+    def __enter__(self):
+        return self
+
+    def abort(self):
+        """
+        Closes the file of the last shard without completing it or updating the manifest.
+        """
+        if self.writer is not None:
+            try:
+                self.writer.flush()
+            finally:
+                self.writer.abort()
+                self.writer = None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
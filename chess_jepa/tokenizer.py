@@ -2,6 +2,10 @@
 Handcrafted tokenizer. This is as minimal as it can be for the game of chess.
 """
 
+import hashlib
+
+import numpy as np
+
 PADDING_TOKEN = "_"
 START_TOKEN = "<s>"
 
@@ -30,6 +34,13 @@ class Vocabulary:
     def __len__(self):
         return len(self.token_to_index)
 
+    def fingerprint(self) -> int:
+        """
+        64 bit hash of all the tokens in index order. Changes when the vocabulary changes.
+        """
+        tokens = "\n".join(self.index_to_token[index] for index in range(len(self)))
+        return int.from_bytes(hashlib.sha256(tokens.encode()).digest()[:8], "little")
+
 
 _castling_rights = [
     "-",  # No castling rights
@@ -142,6 +153,396 @@ def encode(input: str) -> list[int]:
 
 def decode(input: list[int]) -> str:
     """
-    Decodes the list of tokens into a string. Warning: Not symmetric with encode.
+    Decodes the list of tokens into a string. Warning: Not symmetric with encode, see
+    decode_batch for training samples.
     """
     return "".join(default_vocabulary.get_token(index) for index in input)
+
+
+# Lookup tables used by encode_batch. All of them map to token indices stored as bytes,
+# the vocabulary is small enough for that.
+assert len(default_vocabulary) <= 256, "Vocabulary no longer fits in a byte"
+
+
+def _initialize_square_tokens() -> np.ndarray:
+    """
+    Maps the two characters of a square (read as a little endian uint16) to its token.
+    Zero (the padding token) means the characters are not a square.
+    """
+    table = np.zeros(1 << 16, dtype=np.uint8)
+    for file in "abcdefgh":
+        for rank in "12345678":
+            table[int.from_bytes((file + rank).encode(), "little")] = default_vocabulary.get_index(file + rank)
+    return table
+
+
+def _initialize_promotion_tokens() -> np.ndarray:
+    """
+    Maps a (destination square token, promotion piece character) pair to the promotion token.
+    """
+    table = np.zeros((256, 256), dtype=np.uint8)
+    for file in "abcdefgh":
+        for rank in "18":
+            for piece in "qrbn":
+                square = default_vocabulary.get_index(file + rank)
+                table[square, ord(piece)] = default_vocabulary.get_index(file + rank + piece)
+    return table
+
+
+def _initialize_character_tokens() -> tuple[np.ndarray, np.ndarray]:
+    """
+    Maps every character of a FEN piece placement to a token and the number of times
+    the token is repeated (digits expand into empty squares). Invalid characters repeat
+    zero times.
+    """
+    tokens = np.zeros(256, dtype=np.uint8)
+    counts = np.zeros(256, dtype=np.int64)
+    for char in "rnbqkpRNBQKP/":
+        tokens[ord(char)] = default_vocabulary.get_index(char)
+        counts[ord(char)] = 1
+    for count in range(1, 9):
+        tokens[ord(str(count))] = default_vocabulary.get_index(".")
+        counts[ord(str(count))] = count
+    return tokens, counts
+
+
+def _word_key(word: str) -> int:
+    return int.from_bytes(word.encode()[:8].ljust(8, b"\0"), "little")
+
+
+def _initialize_word_tokens() -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Sorted lookup table for all the vocabulary words: the key (first 8 characters read as
+    a little endian uint64), the word length, the tokens (one or two) and the token count.
+    """
+    entries = sorted((_word_key(word), len(word), encode(word)) for word in default_vocabulary.token_to_index)
+    keys = np.array([key for key, _, _ in entries], dtype=np.uint64)
+    lengths = np.array([length for _, length, _ in entries], dtype=np.int64)
+    tokens = np.zeros((len(entries), 2), dtype=np.uint8)
+    counts = np.zeros(len(entries), dtype=np.int64)
+    for index, (_, _, word_tokens) in enumerate(entries):
+        tokens[index, : len(word_tokens)] = word_tokens
+        counts[index] = len(word_tokens)
+    return keys, lengths, tokens, counts
+
+
+_square_tokens = _initialize_square_tokens()
+_promotion_tokens = _initialize_promotion_tokens()
+_character_tokens, _character_counts = _initialize_character_tokens()
+_word_keys, _word_lengths, _word_tokens, _word_counts = _initialize_word_tokens()
+_empty_square_token = default_vocabulary.get_index(".")
+_key_masks = np.array([(1 << (8 * length)) - 1 for length in range(9)], dtype=np.uint64)
+
+
+def _encode_one_by_one(samples: list[str]):
+    """
+    Slow path taken for invalid samples, fails the same way as encode.
+    """
+    for sample in samples:
+        encode(sample)
+    raise ValueError("Invalid FEN piece placement")
+
+
+def encode_batch(samples: list[str], dtype=np.int32, out: np.ndarray = None) -> np.ndarray:
+    """
+    Encodes a batch of samples into a 2D array of tokens, one row per sample. Same output
+    as calling encode for each sample, but all the samples must have the same number of
+    tokens (true for samples generated with the same window size).
+    """
+    if not samples:
+        return np.empty((0, 0), dtype=dtype) if out is None else out
+
+    # All the samples go into a single buffer: words are separated by spaces and samples by
+    # new lines. The zero padding at the end allows reading 8 bytes from any word start.
+    data = "\n".join(samples).encode() + b"\n" + bytes(8)
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    octets = np.ndarray((len(data) - 7,), dtype="<u8", buffer=data, strides=(1,))
+
+    ends = np.flatnonzero((buffer[:-8] == ord(" ")) | (buffer[:-8] == ord("\n")))
+    starts = np.empty_like(ends)
+    starts[0], starts[1:] = 0, ends[:-1] + 1
+    lengths = ends - starts
+
+    # UCI moves are two squares, the second one possibly followed by the promotion piece
+    heads = octets[starts]
+    first = _square_tokens[heads & np.uint64(0xFFFF)]
+    second = _square_tokens[(heads >> np.uint64(16)) & np.uint64(0xFFFF)]
+    promotions = _promotion_tokens[second, (heads >> np.uint64(32)) & np.uint64(0xFF)]
+    is_move = (first > 0) & (second > 0) & ((lengths == 4) | (lengths == 5) & (promotions > 0))
+    second = np.where(lengths == 5, promotions, second)
+    counts = np.full(len(starts), 2, dtype=np.int64)
+
+    # Everything else is either a vocabulary word or a FEN piece placement
+    others = np.flatnonzero(~is_move)
+    keys = heads[others] & _key_masks[np.minimum(lengths[others], 8)]
+    found = np.minimum(np.searchsorted(_word_keys, keys), len(_word_keys) - 1)
+    in_vocabulary = (_word_keys[found] == keys) & (_word_lengths[found] == lengths[others])
+    words, found = others[in_vocabulary], found[in_vocabulary]
+    first[words], second[words], counts[words] = _word_tokens[found, 0], _word_tokens[found, 1], _word_counts[found]
+
+    # The characters of all the placements, one after the other
+    placements = others[~in_vocabulary]
+    placement_lengths = lengths[placements]
+    boundaries = np.cumsum(placement_lengths) - placement_lengths
+    offsets = np.repeat(starts[placements] - boundaries, placement_lengths)
+    characters = buffer[offsets + np.arange(len(offsets))]
+    character_counts = _character_counts[characters]
+    if np.isin(placement_lengths, (0, 4, 5)).any() or not character_counts.all():
+        _encode_one_by_one(samples)
+    if len(placements):
+        counts[placements] = np.add.reduceat(character_counts, boundaries)
+        if not (np.add.reduceat(characters == ord("/"), boundaries) > 0).all():
+            _encode_one_by_one(samples)
+
+    # Scatter the tokens of every word into the flat output, empty squares are the default
+    positions = np.cumsum(counts) - counts
+    flat = np.full(positions[-1] + counts[-1], _empty_square_token, dtype=np.uint8)
+    flat[positions] = first
+    flat[positions[counts == 2] + 1] = second[counts == 2]
+    if len(placements):
+        # Every character goes to the first of its tokens (a digit to the first of its empty
+        # squares): a running count of the tokens, that jumps to the output position of the
+        # next placement at the last character of every placement
+        placement_counts = counts[placements]
+        jumps = positions[placements] - (np.cumsum(placement_counts) - placement_counts)
+        character_counts[boundaries[1:] - 1] += np.diff(jumps)
+        character_positions = np.cumsum(character_counts)
+        character_positions -= character_counts - jumps[0]
+        flat[character_positions] = _character_tokens[characters]
+
+    row_ends = (positions + counts)[buffer[ends] == ord("\n")]
+    row_lengths = np.diff(row_ends, prepend=0)
+    if (row_lengths != row_lengths[0]).any():
+        raise ValueError(f"Samples have different number of tokens: {sorted(set(row_lengths.tolist()))}")
+
+    shape = (len(samples), int(row_lengths[0]))
+    if out is None:
+        out = np.empty(shape, dtype=dtype)
+    elif out.shape != shape:
+        raise ValueError(f"Output array has shape {out.shape}, expected {shape}")
+    out[...] = flat.reshape(shape)
+    return out
+
+
+# Board states and moves can also be encoded straight from their numeric representation,
+# without going through FEN and UCI strings. Squares are numbered like in python-chess
+# (a1 = 0, b1 = 1, ..., h8 = 63).
+#
+# A board state is a row of BOARD_STATE_SIZE integers: the bitboards of the pieces in
+# BOARD_STATE_PIECES order, the side to move (1 for white, 0 for black), the castling
+# rights (bit mask in KQkq order, K = 1) and the en passant square (64 for none).
+#
+# A move is an integer code: from square | to square << 6 | promotion piece type << 12,
+# with the piece types numbered like in python-chess (knight = 2, ..., queen = 5).
+BOARD_STATE_PIECES = "PNBRQKpnbrqk"
+BOARD_STATE_SIZE = len(BOARD_STATE_PIECES) + 3
+NO_EN_PASSANT = 64
+
+_square_names = [file + rank for rank in "12345678" for file in "abcdefgh"]
+
+# Tokens for every square, plus the '-' token for the missing en passant square
+_square_index_tokens = np.array(
+    [default_vocabulary.get_index(square) for square in _square_names] + [default_vocabulary.get_index("-")],
+    dtype=np.uint8,
+)
+
+
+def _initialize_destination_tokens() -> np.ndarray:
+    """
+    Maps (promotion piece type, to square) to the token of the move destination.
+    """
+    table = np.zeros((8, 64), dtype=np.uint8)
+    for piece_type in range(8):
+        for square, name in enumerate(_square_names):
+            if piece_type == 0:
+                table[piece_type, square] = default_vocabulary.get_index(name)
+            elif 2 <= piece_type <= 5 and name[1] in "18":
+                table[piece_type, square] = default_vocabulary.get_index(name + " pnbrq"[piece_type])
+    return table
+
+
+_destination_tokens = _initialize_destination_tokens()
+
+# Index into the output of a board row: FEN order (rank 8 first) with a '/' (index 64)
+# between the ranks
+PLACEMENT_ORDER = np.array(
+    sum(([rank * 8 + file for file in range(8)] + [64] for rank in range(7, -1, -1)), [])[:-1],
+    dtype=np.int64,
+)
+# Token for every square, indexed by the 1-based position of the piece in BOARD_STATE_PIECES
+_piece_index_tokens = np.array(
+    [default_vocabulary.get_index(".")] + [default_vocabulary.get_index(piece) for piece in BOARD_STATE_PIECES],
+    dtype=np.uint8,
+)
+_side_tokens = np.array([default_vocabulary.get_index("b"), default_vocabulary.get_index("w")], dtype=np.uint8)
+# Token of the castling rights, indexed by their KQkq bit mask (as in the board states)
+CASTLING_TOKENS = np.array(
+    [
+        default_vocabulary.get_index("".join(right for bit, right in enumerate("KQkq") if mask & (1 << bit)) or "-")
+        for mask in range(16)
+    ],
+    dtype=np.uint8,
+)
+
+
+def encode_moves(moves: np.ndarray) -> np.ndarray:
+    """
+    Encodes move codes into pairs of tokens, one row per move. Same as encode for the
+    UCI string of every move.
+    """
+    moves = np.asarray(moves, dtype=np.int64)
+    tokens = np.empty((len(moves), 2), dtype=np.uint8)
+    tokens[:, 0] = _square_index_tokens[moves & 63]
+    tokens[:, 1] = _destination_tokens[(moves >> 12) & 7, (moves >> 6) & 63]
+    return tokens
+
+
+def encode_boards(boards: np.ndarray) -> np.ndarray:
+    """
+    Encodes board states into tokens, one row per board. Same as encode for the piece
+    placement, side to move, castling rights and en passant square of the FEN.
+    """
+    boards = np.asarray(boards, dtype=np.uint64).reshape(-1, BOARD_STATE_SIZE)
+    pieces = len(BOARD_STATE_PIECES)
+
+    # Unpack the bitboards into one bit per (piece, square), then number the pieces
+    bits = np.unpackbits(boards[:, :pieces].astype("<u8").view(np.uint8), axis=1, bitorder="little")
+    bits = bits.reshape(len(boards), pieces, 64)
+    squares = np.empty((len(boards), 65), dtype=np.uint8)
+    squares[:, :64] = _piece_index_tokens[np.einsum("nps,p->ns", bits, np.arange(1, pieces + 1, dtype=np.uint8))]
+    squares[:, 64] = default_vocabulary.get_index("/")
+
+    tokens = np.empty((len(boards), len(PLACEMENT_ORDER) + 3), dtype=np.uint8)
+    tokens[:, : len(PLACEMENT_ORDER)] = squares[:, PLACEMENT_ORDER]
+    tokens[:, -3] = _side_tokens[boards[:, pieces].astype(np.int64)]
+    tokens[:, -2] = CASTLING_TOKENS[boards[:, pieces + 1].astype(np.int64)]
+    tokens[:, -1] = _square_index_tokens[boards[:, pieces + 2].astype(np.int64)]
+    return tokens
+
+
+def sample_length(window_size: int) -> int:
+    """
+    Number of tokens of a training sample: the before and after windows of moves (two
+    tokens each), the piece placement with rank separators and side, castling, en passant.
+    """
+    return 4 * window_size + len(PLACEMENT_ORDER) + 3
+
+
+def game_samples_count(moves_count: int, window_size: int) -> int:
+    """
+    Number of training samples generated for a game with the given number of moves.
+    """
+    return moves_count + min(moves_count, window_size)
+
+
+def encode_game(boards: np.ndarray, moves: np.ndarray, result: str, window_size: int, out: np.ndarray = None) -> np.ndarray:
+    """
+    Encodes all the training samples of a game, same rows as encode_batch for the samples
+    generated by extract_training_samples. The boards are the states before every move
+    and after the last one (one more board than moves). The output array can be reused
+    between games, it needs at least game_samples_count rows and the returned array is a
+    view into it.
+    """
+    moves_count = len(moves)
+    tail = min(moves_count, window_size)
+    padding = default_vocabulary.get_index(PADDING_TOKEN)
+    offsets = np.arange(window_size)
+
+    # For every sample: the ply of the board and how many entries of the after window are used
+    main = np.arange(moves_count)
+    plies = np.concatenate((np.maximum(main - window_size + 1, 0), np.arange(moves_count - tail + 1, moves_count + 1)))
+    after_lengths = np.concatenate((np.minimum(main + 1, window_size), np.full(tail, tail)))
+
+    move_tokens = encode_moves(moves)
+    before = np.full((window_size + moves_count, 2), padding, dtype=np.uint8)
+    before[window_size - 1, 1] = default_vocabulary.get_index(START_TOKEN)
+    before[window_size:] = move_tokens
+    after = np.full((moves_count + 1 + window_size, 2), padding, dtype=np.uint8)
+    after[:moves_count] = move_tokens
+    after[moves_count, 0] = default_vocabulary.get_index("<" + result + ">")
+
+    shape = (len(plies), sample_length(window_size))
+    if out is None:
+        out = np.empty(shape, dtype=np.int32)
+    elif out.shape[0] < shape[0] or out.shape[1] != shape[1]:
+        raise ValueError(f"Output array has shape {out.shape}, expected at least {shape}")
+    out = out[: shape[0]]
+
+    windows = plies[:, None] + offsets
+    out[:, : 2 * window_size] = before[windows].reshape(len(plies), 2 * window_size)
+    out[:, 2 * window_size : -2 * window_size] = encode_boards(boards)[plies]
+    after_windows = after[windows]
+    after_windows[offsets >= after_lengths[:, None]] = padding
+    out[:, -2 * window_size :] = after_windows.reshape(len(plies), 2 * window_size)
+    return out
+
+
+def _initialize_token_strings() -> np.ndarray:
+    """
+    Maps every token to its string for decode_batch. Padding decodes to nothing, so that the
+    two tokens of a move slot decode to the word of the sample (a UCI move, the start token
+    or a result), or to nothing for a padded slot.
+    """
+    strings = np.full(256, "", dtype=object)
+    for index in range(1, len(default_vocabulary)):
+        strings[index] = default_vocabulary.get_token(index)
+    return strings
+
+
+def _initialize_placement_characters() -> np.ndarray:
+    """
+    Maps the tokens of a board placement (pieces, empty squares and rank separators) to
+    their ASCII code.
+    """
+    characters = np.zeros(256, dtype=np.uint8)
+    for character in "rnbqkpRNBQKP./":
+        characters[default_vocabulary.get_index(character)] = ord(character)
+    return characters
+
+
+_token_strings = _initialize_token_strings()
+_placement_characters = _initialize_placement_characters()
+
+
+def _decode_moves(tokens: np.ndarray) -> np.ndarray:
+    # Words of the move slots of [batch, 2 * slots] tokens, object array [batch, slots]
+    words = _token_strings[tokens[:, 0::2]] + _token_strings[tokens[:, 1::2]]
+    words[words == ""] = PADDING_TOKEN
+    return words
+
+
+def decode_batch(tokens: np.ndarray, window_size: int) -> list[tuple[list[str], str, list[str]]]:
+    """
+    Decodes training samples (rows of tokens, e.g. predicted by a model) into the before
+    moves, the FEN and the after moves, the inverse of encode_batch. Moves are in UCI
+    notation, the other slots hold the words of the samples ('_' for padding, '<s>' or a
+    result such as '<1-0>'). The FEN has the piece placement (empty squares counted, as
+    usual), side to move, castling rights and en passant square, and can be given to
+    python-chess (chess.Board(fen)). " ".join(before + [fen] + after) is the sample.
+    """
+    tokens = np.asarray(tokens).astype(np.uint8)
+    board = 2 * window_size
+    placement = len(PLACEMENT_ORDER)
+
+    # The characters of the placements as [batch, rank, file] (the ninth file of every rank
+    # is its separator, a new line for the last one)
+    characters = np.full((len(tokens), 8, 9), ord("\n"), dtype=np.uint8)
+    characters.reshape(len(tokens), -1)[:, :placement] = _placement_characters[tokens[:, board : board + placement]]
+
+    # Empty squares in a row are counted from the last file of a rank to the first, the
+    # first of them is replaced by the count and the others are dropped
+    empty = characters == ord(".")
+    runs = np.zeros(characters.shape, dtype=np.uint8)
+    for file in range(7, -1, -1):
+        runs[:, :, file] = empty[:, :, file] * (runs[:, :, file + 1] + 1)
+    first = empty.copy()
+    first[:, :, 1:] &= ~empty[:, :, :-1]
+    characters = np.where(first, ord("0") + runs, characters)
+    text = characters[~empty | first].tobytes().decode()
+    fens = np.array(text.split("\n")[:-1], dtype=object)
+    for column in range(board + placement, board + placement + 3):
+        fens = fens + " " + _token_strings[tokens[:, column]]
+
+    before = _decode_moves(tokens[:, :board]).tolist()
+    after = _decode_moves(tokens[:, -board:]).tolist()
+    return list(zip(before, fens.tolist(), after))
@@ -1,4 +1,9 @@
 #!/usr/bin/env bash
+# The archive is read directly by pgn_to_bin.py (decompressed as a stream), no need to unzip it
 wget https://database.nikonoel.fr/lichess_elite_2024-02.zip
-unzip lichess_elite_2024-02.zip
-rm lichess_elite_2024-02.zip
+
+# Evaluations of positions by Stockfish, turned into a table by evals_to_bin.py (read compressed)
+# wget https://database.lichess.org/lichess_db_eval.jsonl.zst
+
+# Puzzles, turned into training samples by puzzles_to_bin.py (read compressed)
+# wget https://database.lichess.org/lichess_db_puzzle.csv.zst
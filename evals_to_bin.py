@@ -0,0 +1,28 @@
+import argparse
+import logging
+import sys
+import time
+
+from chess_jepa.evaluations import build_evaluation_table
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--evals", required=True, help="Lichess evaluations file path (.jsonl, or compressed e.g. .jsonl.zst)"
+    )
+    parser.add_argument("--output", default="evals.bin", help="evaluation table output file path")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    args = parser.parse_args()
+
+    # Configure logging to stdout
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    logging.info(f"Reading evaluations file: {args.evals}")
+    started = time.time()
+    count = build_evaluation_table(args.evals, args.output, workers=args.workers)
+    logging.info(f"Wrote {count} positions to {args.output} in {time.time() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
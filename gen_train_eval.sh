@@ -1,3 +1,7 @@
 #!/usr/bin/env bash
-rm data/*.bin
-python pgn_to_bin.py --pgn data/lichess_elite_2024-02.pgn --train data/train.bin --eval data/eval.bin
+# Continues an interrupted run from its last checkpoint (does nothing once it is complete),
+# run without --resume to convert the games again
+python pgn_to_bin.py --pgn data/lichess_elite_2024-02.zip --train data/train.bin --eval data/eval.bin --resume "$@"
+
+# Many monthly databases at once, a directory of shards each and a manifest of all of them:
+# python ingest.py "data/lichess_db_standard_rated_2024-*.pgn.zst" --output data/dataset
@@ -0,0 +1,270 @@
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import pgn_to_bin
+from chess_jepa.compressed import COMPRESSED_SUFFIXES, is_compressed
+from chess_jepa.storage import read_manifest
+
+# Peak memory of a pgn_to_bin.py process (interpreter, modules and a chunk of games) and of
+# every worker process on chunks of 4MB, measured with some margin
+_PROCESS_MEMORY = 256 << 20
+_WORKER_MEMORY = 128 << 20
+
+# Options of pgn_to_bin.py set by this script for every source, or that would be shared by
+# all the sources
+_SOURCE_OPTIONS = ("--pgn", "--train", "--eval", "--workers", "--resume", "--metrics", "--positions")
+
+
+def source_name(path: str) -> str:
+    # File name without the .pgn and compression suffixes, e.g. lichess_db_standard_rated_2024-01
+    name = os.path.basename(path)
+    for suffix in COMPRESSED_SUFFIXES + (".pgn",):
+        if name.lower().endswith(suffix):
+            name = name[: -len(suffix)]
+    return name
+
+
+def file_checksum(path: str, block_size=1 << 20) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        while block := file.read(block_size):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def memory_estimate(workers: int, options: argparse.Namespace) -> int:
+    """
+    Bytes of memory used by a pgn_to_bin.py run with the given workers and options (its
+    parsed arguments): the processes, the output buffers (and the blocks queued by the background
+    writer) and the duplicate counters and exact counts.
+    """
+    buffers = 2 * options.buffer_size * (3 if options.background_writer else 1)
+    dedup = options.dedup_memory + 9 * options.dedup_exact_keys if options.max_copies else 0
+    return _PROCESS_MEMORY + (workers if workers > 1 else 0) * _WORKER_MEMORY + buffers + dedup
+
+
+class Source:
+    """
+    A PGN file converted into its own directory of the output (train and eval shards, the
+    progress, metrics and log of pgn_to_bin.py).
+    """
+
+    def __init__(self, path: str, output: str):
+        self.path = path
+        self.name = source_name(path)
+        self.output = output
+        self.directory = os.path.join(output, self.name)
+        self.train = os.path.join(self.directory, "train.bin")
+        self.eval = os.path.join(self.directory, "eval.bin")
+        self.process = None
+        self.workers = 0
+        self.memory = 0
+        self.log = None
+
+    def entry(self) -> dict:
+        """
+        Manifest entry of a complete conversion: the source file, the counts of its
+        progress and the shards of its outputs (paths relative to the output directory)
+        with their checksums.
+        """
+        with open(self.train + ".progress", "r") as file:
+            progress = json.load(file)
+        entry = {
+            "pgn": os.path.abspath(self.path),
+            "size": os.path.getsize(self.path),
+            "games": progress["written_games"],
+            "samples": progress["samples"],
+            "train_tokens": progress["train_tokens"],
+            "eval_tokens": progress["eval_tokens"],
+        }
+        for output, path in (("train", self.train), ("eval", self.eval)):
+            shards = read_manifest(path)["shards"]
+            for shard in shards:
+                shard["path"] = os.path.join(self.name, shard["path"])
+                shard["checksum"] = file_checksum(os.path.join(self.output, shard["path"]))
+            entry[output] = {"shards": shards, "records": sum(shard["records"] for shard in shards)}
+        return entry
+
+    def matches(self, entry: dict, verify=True) -> bool:
+        """
+        Whether the manifest entry is for this source file (same size) and all its shards
+        exist with the same size (and the same checksum with verify).
+        """
+        if entry.get("pgn") != os.path.abspath(self.path) or entry.get("size") != os.path.getsize(self.path):
+            return False
+        for output in ("train", "eval"):
+            for shard in entry[output]["shards"]:
+                path = os.path.join(self.output, shard["path"])
+                if not os.path.exists(path) or os.path.getsize(path) != shard["bytes"]:
+                    return False
+                if verify and file_checksum(path) != shard["checksum"]:
+                    return False
+        return True
+
+    def start(self, workers: int, memory: int, resume: bool, options: list[str]):
+        os.makedirs(self.directory, exist_ok=True)
+        command = [sys.executable, pgn_to_bin.__file__, "--pgn", self.path, "--train", self.train, "--eval", self.eval]
+        command += ["--workers", str(workers), "--metrics", os.path.join(self.directory, "metrics.json")]
+        command += (["--resume"] if resume else []) + options
+        self.log = open(os.path.join(self.directory, "pgn_to_bin.log"), "a")
+        # In a session of its own, so that its worker processes are stopped with it
+        self.process = subprocess.Popen(command, stdout=self.log, stderr=subprocess.STDOUT, start_new_session=True)
+        self.workers = workers
+        self.memory = memory
+
+    def stop(self):
+        os.killpg(self.process.pid, signal.SIGTERM)
+        self.process.wait()
+        self.log.close()
+
+    def poll(self) -> int | None:
+        code = self.process.poll()
+        if code is not None:
+            self.log.close()
+        return code
+
+
+def read_dataset_manifest(path: str) -> dict:
+    if not os.path.exists(path):
+        return {"sources": {}}
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def write_dataset_manifest(path: str, manifest: dict):
+    sources = manifest["sources"].values()
+    manifest["totals"] = {
+        "sources": len(sources),
+        **{name: sum(entry[name] for entry in sources) for name in ("games", "samples", "train_tokens", "eval_tokens")},
+        "train_records": sum(entry["train"]["records"] for entry in sources),
+        "eval_records": sum(entry["eval"]["records"] for entry in sources),
+    }
+    # Write to a temporary file first, readers never see a partial manifest
+    with open(path + ".tmp", "w") as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Converts many PGN files (e.g. a few years of monthly Lichess databases) with pgn_to_bin.py, "
+        "several at a time. Other options are passed to pgn_to_bin.py for every file.",
+        allow_abbrev=False,
+    )
+    parser.add_argument("sources", nargs="+", help="PGN file paths or glob patterns (plain or compressed)")
+    parser.add_argument("--output", default="data/dataset", help="output directory, a subdirectory per source")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes for all the sources")
+    parser.add_argument(
+        "--memory",
+        type=int,
+        default=os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2,
+        help="bytes of memory for all the sources (half of the memory by default)",
+    )
+    parser.add_argument(
+        "--no-verify", action="store_true", help="skip sources with shards of the right size, without their checksums"
+    )
+    args, options = parser.parse_known_args()
+    for option in options:
+        if option.split("=")[0] in _SOURCE_OPTIONS:
+            parser.error(f"{option} is set for every source by this script")
+    source_options = pgn_to_bin.build_parser().parse_args(["--pgn", ""] + options)
+
+    # Configure logging to stdout
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    # Patterns only match PGN files (not e.g. the game index written next to them)
+    paths = []
+    for pattern in args.sources:
+        found = [pattern]
+        if glob.has_magic(pattern):
+            found = [path for path in sorted(glob.glob(pattern)) if path.lower().endswith(".pgn") or is_compressed(path)]
+        if not found:
+            logging.warning(f"No files match: {pattern}")
+        paths.extend(path for path in found if path not in paths)
+    sources = [Source(path, args.output) for path in paths]
+    names = [source.name for source in sources]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        parser.error(f"Sources with the same name: {', '.join(sorted(duplicates))}")
+
+    os.makedirs(args.output, exist_ok=True)
+    manifest_path = os.path.join(args.output, "manifest.json")
+    manifest = read_dataset_manifest(manifest_path)
+
+    # Sources converted before (with their shards unchanged) are skipped, the others are
+    # continued from their progress, or converted again when their shards changed
+    pending = []
+    for source in sources:
+        entry = manifest["sources"].get(source.name)
+        if entry is not None and source.matches(entry, verify=not args.no_verify):
+            logging.info(f"Skipping {source.path}, already converted")
+            continue
+        resume = entry is None
+        if not resume:
+            logging.info(f"Shards of {source.path} changed, converting it again")
+            del manifest["sources"][source.name]
+        pending.append((source, resume))
+    # Changed sources are no longer listed, an interrupted run continues them from their progress
+    write_dataset_manifest(manifest_path, manifest)
+    logging.info(f"Converting {len(pending)} of {len(sources)} sources with {args.workers} workers")
+
+    # Sources are started while there are free workers and memory, every one with an equal
+    # share of the free workers (a source too large for the memory runs alone)
+    running, failed = [], []
+    started = time.time()
+    try:
+        while pending or running:
+            free_workers = args.workers - sum(source.workers for source in running)
+            free_memory = args.memory - sum(source.memory for source in running)
+            while pending and free_workers > 0:
+                source, resume = pending[0]
+                workers = max(free_workers // len(pending), 1)
+                memory = memory_estimate(workers, source_options)
+                if memory > free_memory and running:
+                    break
+                pending.pop(0)
+                logging.info(f"Starting {source.path} with {workers} workers (log in {source.directory})")
+                source.start(workers, memory, resume, options)
+                running.append(source)
+                free_workers -= workers
+                free_memory -= memory
+
+            time.sleep(1)
+            for source in list(running):
+                code = source.poll()
+                if code is None:
+                    continue
+                running.remove(source)
+                if code != 0:
+                    logging.error(f"Converting {source.path} failed (exit code {code}), see its log")
+                    failed.append(source)
+                    continue
+                manifest["sources"][source.name] = source.entry()
+                write_dataset_manifest(manifest_path, manifest)
+                logging.info(f"Converted {source.path}: {manifest['sources'][source.name]['samples']} samples")
+    except KeyboardInterrupt:
+        logging.info("Interrupted, the sources continue from their progress on the next run")
+        sys.exit(1)
+    finally:
+        for source in running:
+            source.stop()
+
+    write_dataset_manifest(manifest_path, manifest)
+    totals = manifest["totals"]
+    logging.info(f"Dataset of {totals['sources']} sources in {args.output} ({time.time() - started:.0f}s)")
+    logging.info(f"Total tokens: train {totals['train_tokens']}, eval {totals['eval_tokens']}")
+    if failed:
+        logging.error(f"Failed sources: {', '.join(source.path for source in failed)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,64 +1,562 @@
 import argparse
+import collections
+import cProfile
+import io
+import json
 import logging
 import numpy as np
-import random
+import os
+import pstats
 import sys
+import time
+from typing import NamedTuple
 
-from chess_jepa.tokenizer import encode
-from chess_jepa.pgn import extract_training_samples
+from chess_jepa.compressed import is_compressed
+from chess_jepa.dedup import DuplicateFilter, sample_hashes
+from chess_jepa.evaluations import EVAL_DTYPE, EvaluationTable, targets_path
+from chess_jepa.metrics import Progress, StageTimer
+from chess_jepa.pgn import (
+    GameFilter,
+    eval_split,
+    extract_games_parallel,
+    extract_training_tokens_parallel,
+    game_hash,
+    load_pgn_index,
+    read_pgn_chunks,
+)
+from chess_jepa.positions import PositionIndexBuilder
+from chess_jepa.storage import BufferedOutput, GameWriter, ShardedWriter, TokenWriter
+from chess_jepa.tokenizer import game_samples_count, sample_length
 
 
-def main():
+def load_progress(path: str) -> dict:
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def save_json(path: str, data: dict):
+    # Write to a temporary file first, a crash never leaves a partial progress (or metrics) file behind
+    with open(path + ".tmp", "w") as file:
+        json.dump(data, file)
+    os.replace(path + ".tmp", path)
+
+
+def build_parser() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser()
-    parser.add_argument("--pgn", required=True, help="input file path")
+    parser.add_argument(
+        "--pgn",
+        required=True,
+        help="input file path (.pgn, or compressed .zst, .bz2, .gz, .zip; .zst needs the zstd command line tool)",
+    )
     parser.add_argument("--train", default="train.bin", help="train output file path")
     parser.add_argument("--eval", default="eval.bin", help="eval output file path")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument(
+        "--format",
+        choices=["tokens", "games"],
+        default="tokens",
+        help="store encoded samples or whole games (samples rebuilt when reading)",
+    )
+    parser.add_argument("--resume", action="store_true", help="continue an interrupted run from the last committed game")
+    parser.add_argument("--eval-fraction", type=float, default=0.1, help="fraction of the games used for evaluation")
+    parser.add_argument("--shard-size", type=int, default=1 << 30, help="maximum bytes per output shard, 0 for one shard")
+    parser.add_argument("--buffer-size", type=int, default=16 << 20, help="bytes buffered in memory before writing")
+    parser.add_argument("--background-writer", action="store_true", help="write the output files from a separate thread")
+    parser.add_argument("--min-elo", type=int, default=0, help="skip games with a player rated below this")
+    parser.add_argument(
+        "--min-time-control",
+        type=int,
+        default=0,
+        help="skip games faster than this many seconds (base + 40 increments, e.g. 180 for blitz and slower)",
+    )
+    parser.add_argument("--min-plies", type=int, default=0, help="skip games with fewer moves")
+    parser.add_argument("--skip-unfinished", action="store_true", help="skip games without a result (*)")
+    parser.add_argument("--variant", default=None, help="only keep games of this variant (e.g. Standard)")
+    parser.add_argument(
+        "--max-copies", type=int, default=0, help="keep at most this many copies of every sample, 0 to keep all"
+    )
+    parser.add_argument(
+        "--dedup-memory", type=int, default=1 << 30, help="bytes of counters used to find the duplicate samples"
+    )
+    parser.add_argument(
+        "--dedup-exact-keys",
+        type=int,
+        default=1 << 20,
+        help="samples also counted exactly (9 bytes each) to confirm the duplicates found by the counters",
+    )
+    parser.add_argument(
+        "--positions",
+        default=None,
+        help="directory of a position index (visits, results and next moves of every position) built from the train games",
+    )
+    parser.add_argument(
+        "--evals",
+        default=None,
+        help="evaluation table (see chess_jepa.evaluations) to write the evaluation of every sample next to the outputs",
+    )
+    parser.add_argument("--max-samples", type=int, default=0, help="stop after this many samples, 0 for no limit")
+    parser.add_argument("--max-games", type=int, default=0, help="stop after this many games, 0 for no limit")
+    parser.add_argument(
+        "--max-bytes", type=int, default=0, help="stop once the outputs hold about this many bytes, 0 for no limit"
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=4 << 20, help="bytes of games processed (and committed) at a time"
+    )
+    parser.add_argument("--log-interval", type=float, default=10, help="seconds between progress reports")
+    parser.add_argument("--metrics", default=None, help="file to write the progress and stage times to (JSON)")
+    parser.add_argument("--metrics-interval", type=float, default=60, help="seconds between writes of the metrics")
+    parser.add_argument(
+        "--profile", type=int, default=0, help="run cProfile over this many games, stats written next to the outputs"
+    )
+    parser.add_argument("--profile-after", type=int, default=0, help="games of the run to process before profiling")
+    return parser
+
+
+class Outputs(NamedTuple):
+    """
+    The files of a run: the train and eval outputs and, when used, the duplicate filter, the
+    position index and the evaluation targets (of the train and eval outputs).
+    """
+
+    train: ShardedWriter
+    eval: ShardedWriter
+    duplicates: DuplicateFilter | None = None
+    positions: PositionIndexBuilder | None = None
+    evaluations: EvaluationTable | None = None
+    targets: tuple[BufferedOutput, BufferedOutput] | None = None
+
+
+class Written(NamedTuple):
+    """
+    What a chunk added to the outputs, and whether a limit of the run dropped the rest of it.
+    """
+
+    games: int
+    train_samples: int
+    eval_samples: int
+    limited: bool
+
+
+def open_inputs(args, start: int, timer: StageTimer) -> tuple[dict, collections.deque]:
+    """
+    Inputs of the extract functions for the games of the PGN file from start on, and the
+    chunks they are read in: their game numbers and the bytes of the file read up to their end.
+    """
+    if is_compressed(args.pgn):
+        # Compressed files are decompressed as a stream and split while reading, the games
+        # are numbered as they are found
+        chunks = collections.deque()
+
+        def read_texts():
+            texts = read_pgn_chunks(args.pgn, args.chunk_size, start=start, with_position=True)
+            for first, last, text, position in timer.iterate(texts, "read"):
+                chunks.append((first, last, position))
+                yield text
+
+        return {"texts": read_texts()}, chunks
+
+    # The index (built on the first run) gives the byte offset of every game
+    logging.info(f"Loading the game index for: {args.pgn}")
+    pgn_index = load_pgn_index(args.pgn, headers=False)
+    logging.info(f"Found {len(pgn_index)} games")
+    ranges = pgn_index.split(args.chunk_size, start=start)
+    inputs = {"ranges": [pgn_index.byte_range(first, last) for first, last in ranges]}
+    chunks = collections.deque((first, last, end) for (first, last), (_, end) in zip(ranges, inputs["ranges"]))
+    return inputs, chunks
+
+
+def header_filter(args) -> GameFilter | None:
+    # Games are filtered on their headers, the rejected ones are never parsed
+    if not (args.min_elo or args.min_time_control or args.min_plies or args.skip_unfinished or args.variant):
+        return None
+    return GameFilter(
+        min_elo=args.min_elo,
+        min_time_control=args.min_time_control,
+        results={"1-0", "0-1", "1/2-1/2"} if args.skip_unfinished else None,
+        min_plies=args.min_plies,
+        variant=args.variant,
+    )
+
+
+def open_targets(args, progress: dict) -> tuple[BufferedOutput, BufferedOutput]:
+    # Evaluations of the samples, one record per sample of all the shards of an output,
+    # truncated to the samples of the checkpoint when resuming
+    targets = []
+    for path, state in ((args.train, progress["train"]), (args.eval, progress["eval"])):
+        if state is not None:
+            records = sum(shard["records"] for shard in state["shards"])
+            size = os.path.getsize(targets_path(path)) if os.path.exists(targets_path(path)) else 0
+            if size < records * EVAL_DTYPE.itemsize:
+                raise ValueError(f"{targets_path(path)} has fewer targets than the {records} samples of the progress")
+            os.truncate(targets_path(path), records * EVAL_DTYPE.itemsize)
+        targets.append(BufferedOutput(targets_path(path), append=state is not None, buffer_size=args.buffer_size))
+    return tuple(targets)
+
+
+def limit_left(limit: int, used: int) -> int | None:
+    # Room left under a limit, None without a limit (0)
+    return max(limit - used, 0) if limit else None
+
+
+def output_bytes(outputs: Outputs) -> int:
+    return sum(shard["bytes"] for output in (outputs.train, outputs.eval) for shard in output.state()["shards"])
+
+
+def write_games(
+    chunk: list,
+    outputs: Outputs,
+    window_size: int,
+    eval_fraction: float,
+    timer: StageTimer,
+    games_left: int | None,
+    samples_left: int | None,
+    bytes_left: int | None,
+) -> Written:
+    """
+    Writes the games (move codes and result) of a chunk, as many whole games as fit under the
+    limits left (None for no limit).
+    """
+    size = len(chunk)
+    chunk = chunk[:games_left]
+    if samples_left is not None or bytes_left is not None:
+        # Whole games, as long as their samples and records fit
+        counts = np.array([game_samples_count(len(moves), window_size) for moves, _ in chunk])
+        sizes = np.array([2 * (len(moves) + 2) for moves, _ in chunk])
+        fit = len(chunk)
+        if samples_left is not None:
+            fit = min(fit, int(np.searchsorted(np.cumsum(counts), samples_left, side="right")))
+        if bytes_left is not None:
+            fit = min(fit, int(np.searchsorted(np.cumsum(sizes), bytes_left, side="right")))
+        chunk = chunk[:fit]
+
+    use_for_eval = eval_split([game_hash(moves) for moves, _ in chunk], eval_fraction).tolist()
+    if outputs.positions is not None:
+        # Only the train games, the statistics do not leak the eval games
+        train_games = [game for game, evaluated in zip(chunk, use_for_eval) if not evaluated]
+        with timer.time("positions"):
+            outputs.positions.add_games([moves for moves, _ in train_games], [result for _, result in train_games])
+    samples = [0, 0]  # Train and eval
+    with timer.time("write"):
+        for (moves, result), evaluated in zip(chunk, use_for_eval):
+            (outputs.eval if evaluated else outputs.train).write(moves, result)
+            samples[evaluated] += game_samples_count(len(moves), window_size)
+    return Written(len(chunk), samples[0], samples[1], len(chunk) < size)
+
+
+def write_tokens(
+    chunk: tuple,
+    outputs: Outputs,
+    window_size: int,
+    eval_fraction: float,
+    timer: StageTimer,
+    games_left: int | None,
+    samples_left: int | None,
+    bytes_left: int | None,
+) -> Written:
+    """
+    Writes the samples (token rows) of a chunk and their evaluations, without the duplicates
+    and as many as fit under the limits left (None for no limit).
+    """
+    tokens, games = chunk
+    limited = False
+    counts = [game_samples_count(len(moves), window_size) for moves, _, _ in games]
+    if games_left is not None and games_left < len(games):
+        tokens, games, counts = tokens[: sum(counts[:games_left])], games[:games_left], counts[:games_left]
+        limited = True
+    # Hash and number (in the chunk) of the game of every sample
+    hashes = np.repeat(np.array([game_hash(moves) for moves, _, _ in games], dtype=np.uint64), counts)
+    numbers = np.repeat(np.arange(len(games)), counts)
+    if outputs.duplicates is not None:
+        # Drop the samples (e.g. popular openings) already seen max_copies times
+        with timer.time("dedup"):
+            keep = outputs.duplicates.keep(sample_hashes(tokens))
+            tokens, hashes, numbers = tokens[keep], hashes[keep], numbers[keep]
+    if bytes_left is not None:
+        samples_left = min(bytes_left // sample_length(window_size), len(tokens) if samples_left is None else samples_left)
+    if samples_left is not None and samples_left < len(tokens):
+        tokens, hashes = tokens[:samples_left], hashes[:samples_left]
+        limited = True
+        games = games[: numbers[samples_left - 1] + 1 if samples_left else 0]
+
+    if outputs.positions is not None:
+        # Only the train games, the statistics do not leak the eval games
+        games_for_eval = eval_split([game_hash(moves) for moves, _, _ in games], eval_fraction).tolist()
+        train_games = [game for game, evaluated in zip(games, games_for_eval) if not evaluated]
+        if train_games:
+            with timer.time("positions"):
+                moves, results, starts = zip(*train_games)
+                outputs.positions.add_games(list(moves), list(results), list(starts))
+    use_for_eval = eval_split(hashes, eval_fraction)
+    with timer.time("write"):
+        outputs.train.write_rows(tokens[~use_for_eval])
+        outputs.eval.write_rows(tokens[use_for_eval])
+    if outputs.evaluations is not None:
+        with timer.time("evals"):
+            found = outputs.evaluations.lookup_samples(tokens, window_size)
+            outputs.targets[0].write(found[~use_for_eval].data)
+            outputs.targets[1].write(found[use_for_eval].data)
+    eval_samples = int(use_for_eval.sum())
+    return Written(len(games), len(tokens) - eval_samples, eval_samples, limited)
+
+
+def commit(progress: dict, progress_path: str, outputs: Outputs):
+    """
+    Flushes the outputs and saves the progress (the checkpoint a resumed run starts from),
+    the duplicate counts are committed with it.
+    """
+    outputs.train.flush()
+    outputs.eval.flush()
+    if outputs.targets is not None:
+        for output in outputs.targets:
+            output.flush()
+    if outputs.positions is not None:
+        outputs.positions.flush()
+        progress.update(positions=outputs.positions.state())
+    progress.update(train=outputs.train.state(), eval=outputs.eval.state())
+    if outputs.duplicates is not None:
+        outputs.duplicates.prepare(progress["games"])
+    save_json(progress_path, progress)
+    if outputs.duplicates is not None:
+        outputs.duplicates.commit()
+
+
+def run_metrics(progress: dict, meter: Progress, worker_timer: StageTimer, timer: StageTimer) -> dict:
+    return {
+        "pgn": progress["pgn"],
+        "progress": meter.as_dict(),
+        "stages": {"workers": worker_timer.as_dict(), "main": timer.as_dict()},
+        "train_tokens": progress["train_tokens"],
+        "eval_tokens": progress["eval_tokens"],
+        "time": time.time(),
+    }
+
+
+def stop_profiler(profiler: cProfile.Profile, path: str):
+    profiler.disable()
+    profiler.dump_stats(path)
+    report = io.StringIO()
+    pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(20)
+    logging.info(f"Profile written to {path}\n{report.getvalue()}")
+
+
+def main():
+    parser = build_parser()
     args = parser.parse_args()
+    if args.max_copies and args.format == "games":
+        parser.error("--max-copies only applies to the tokens format (games store whole games)")
+    if args.evals and args.format == "games":
+        parser.error("--evals only applies to the tokens format (games store whole games)")
 
     # Configure logging to stdout
     logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
-    # Initialize token counters
-    train_tokens = 0
-    eval_tokens = 0
-
     # Window size for the training samples
     default_window_size = 7
 
-    # Read the PGN file and extract the training samples
-    with open(args.pgn, "r") as file:
-        logging.info(f"Reading PGN file: {args.pgn}")
-
-        with open(args.train, "ab") as train_file:
-            with open(args.eval, "ab") as eval_file:
-                for index, sample in enumerate(extract_training_samples(file, default_window_size)):
-                    # Throw a dice to decide if the sample goes to the training or evaluation set
-                    use_for_train = random.random() < 0.9
-
-                    tokens = np.array(encode(sample), dtype=np.int32)
-                    header = np.array([len(tokens), default_window_size], dtype=np.int32)
-                    
-                    if index == 0:
-                        logging.info(f"Sample header: {header}")
-                    
-                    if use_for_train:
-                        header.tofile(train_file)
-                        tokens.tofile(train_file)
-                        train_tokens += len(tokens)
-                    else:
-                        header.tofile(eval_file)
-                        tokens.tofile(eval_file)
-                        eval_tokens += len(tokens)
-
-                    if index % 10_000 == 0:
-                        logging.info(f"Processed {index} samples. Train tokens: {train_tokens}, Eval tokens: {eval_tokens}")
-
-                    if index > 1000_000:
-                        break # Limit the number of samples to process to 1M
-
-    # Report token statistics
-    logging.info(f"Total tokens persisted to train.bin: {train_tokens}")
-    logging.info(f"Total tokens persisted to eval.bin: {eval_tokens}")
+    # Progress is committed after every chunk (the checkpoint of the run): the number of
+    # games of the PGN file done and the bytes of the file read up to the last of them, the
+    # games and samples written, the tokens of the samples (for games, the tokens of the
+    # samples they expand to), the shards of the outputs at that point and whether the
+    # evaluation targets are written with them
+    progress_path = args.train + ".progress"
+    progress = {
+        "pgn": os.path.abspath(args.pgn),
+        "size": os.path.getsize(args.pgn),
+        "games": 0,
+        "offset": 0,
+        "written_games": 0,
+        "samples": 0,
+        "train_tokens": 0,
+        "eval_tokens": 0,
+        "train": None,
+        "eval": None,
+        "positions": None,
+        "evals": bool(args.evals),
+        "complete": False,
+    }
+    if args.resume and os.path.exists(progress_path):
+        progress = {**progress, **load_progress(progress_path)}
+        if progress["pgn"] != os.path.abspath(args.pgn):
+            raise ValueError(f"Progress file {progress_path} is for a different PGN file: {progress['pgn']}")
+        if progress["size"] != os.path.getsize(args.pgn):
+            raise ValueError(f"PGN file {args.pgn} changed since the progress file {progress_path} was written")
+        if progress["evals"] != bool(args.evals):
+            written = "with" if progress["evals"] else "without"
+            raise ValueError(f"The run of {progress_path} was written {written} --evals, resume it with the same options")
+        if progress["complete"]:
+            logging.info(f"Nothing to do, the run is complete (start without --resume to convert {args.pgn} again)")
+            return
+        logging.info(f"Resuming after game {progress['games']}")
+
+    # Time spent in every stage: in the worker processes (summed over the workers) and in
+    # this process, where waiting for the results of the workers is the wait stage
+    worker_timer = StageTimer()
+    timer = StageTimer()
+    meter = Progress(os.path.getsize(args.pgn))
+
+    # Read the PGN file and extract the training samples (already encoded) or the games of
+    # every chunk, in chunks of about chunk_size bytes
+    logging.info(f"Reading PGN file: {args.pgn}")
+    if args.workers > 1:
+        logging.info(f"Using {args.workers} worker processes")
+    inputs, chunks = open_inputs(args, progress["games"], timer)
+    inputs["game_filter"] = header_filter(args)
+
+    length = sample_length(default_window_size)
+    if args.format == "games":
+        # Every game is stored once, the samples are rebuilt when reading (see chess_jepa.storage)
+        results = extract_games_parallel(args.pgn, workers=args.workers, with_times=True, **inputs)
+        open_shard = lambda path, append: GameWriter(path, append, args.buffer_size, args.background_writer)
+        write_chunk = write_games
+    else:
+        # Samples are stored as a dense matrix of uint8 tokens (see chess_jepa.storage)
+        results = extract_training_tokens_parallel(
+            args.pgn, default_window_size, workers=args.workers, with_games=True, with_times=True, **inputs
+        )
+        open_shard = lambda path, append: TokenWriter(
+            path, default_window_size, length, append=append, buffer_size=args.buffer_size, background=args.background_writer
+        )
+        write_chunk = write_tokens
+
+    # Copies of every sample are counted in a file next to the outputs, committed with the
+    # progress (the counts of the chunks after the checkpoint are dropped)
+    duplicates = None
+    if args.max_copies:
+        duplicates = DuplicateFilter(
+            args.max_copies,
+            args.dedup_memory,
+            path=args.train + ".dedup",
+            exact_keys=args.dedup_exact_keys,
+            append=args.resume and os.path.exists(progress_path),
+            checkpoint=progress["games"],
+        )
+
+    # Position statistics are spilled to bucket files while reading, aggregated at the end
+    positions = None
+    if args.positions:
+        positions = PositionIndexBuilder(args.positions, state=progress.get("positions"))
+
+    evaluations = targets = None
+    if args.evals:
+        evaluations = EvaluationTable(args.evals)
+        logging.info(f"Loaded {len(evaluations)} evaluations from: {args.evals}")
+        targets = open_targets(args, progress)
+
+    # Outputs are split in shards of about shard_size bytes, listed in a manifest next to them
+    outputs = Outputs(
+        ShardedWriter(args.train, open_shard, args.shard_size, progress["train"]),
+        ShardedWriter(args.eval, open_shard, args.shard_size, progress["eval"]),
+        duplicates,
+        positions,
+        evaluations,
+        targets,
+    )
+
+    # A window of games of the run is profiled, in this process: with worker processes the
+    # parsing and encoding happen in the workers, only their times are reported (use
+    # --workers 1 to profile them)
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        if args.workers > 1:
+            logging.info("Profiling this process only, the games are parsed by the workers (see --workers)")
+
+    with outputs.train, outputs.eval:
+        first_game = progress["games"]
+        last_log = last_dump = 0.0
+        profiling = False
+        for chunk, seconds in timer.iterate(results, "wait"):
+            # Chunks are consumed in order, before their results are ready
+            _, last_game, position = chunks.popleft()
+            worker_timer.add(seconds)
+            # Room left under the limits of the run (whole games for the games limit)
+            written = write_chunk(
+                chunk,
+                outputs,
+                default_window_size,
+                args.eval_fraction,
+                timer,
+                games_left=limit_left(args.max_games, progress["written_games"]),
+                samples_left=limit_left(args.max_samples, progress["samples"]),
+                bytes_left=limit_left(args.max_bytes, output_bytes(outputs)),
+            )
+            progress.update(
+                games=last_game,
+                offset=position,
+                written_games=progress["written_games"] + written.games,
+                samples=progress["samples"] + written.train_samples + written.eval_samples,
+                train_tokens=progress["train_tokens"] + written.train_samples * length,
+                eval_tokens=progress["eval_tokens"] + written.eval_samples * length,
+            )
+            with timer.time("commit"):
+                commit(progress, progress_path, outputs)
+            meter.update(bytes=position, games=last_game, samples=progress["samples"])
+
+            # Log the progress and the stage times, write the metrics
+            now = time.monotonic()
+            if now - last_log >= args.log_interval:
+                logging.info(
+                    f"Processed {progress['samples']} samples. "
+                    f"Train tokens: {progress['train_tokens']}, Eval tokens: {progress['eval_tokens']}"
+                )
+                logging.info(f"Progress: {meter}")
+                logging.info(f"Stages (workers): {worker_timer}; (main): {timer}")
+                last_log = now
+            if args.metrics and now - last_dump >= args.metrics_interval:
+                save_json(args.metrics, run_metrics(progress, meter, worker_timer, timer))
+                last_dump = now
+
+            # The profiler runs from the first chunk after profile_after games to the first
+            # one after profile more games
+            if profiler is not None:
+                if not profiling and last_game - first_game >= args.profile_after:
+                    profiling = True
+                    profile_start = last_game
+                    profiler.enable()
+                elif profiling and last_game - profile_start >= args.profile:
+                    stop_profiler(profiler, args.train + ".prof")
+                    profiler = None
+
+            # The run is complete once a limit is reached (the rest of the chunk was dropped)
+            if (
+                written.limited
+                or (args.max_games and progress["written_games"] >= args.max_games)
+                or (args.max_samples and progress["samples"] >= args.max_samples)
+                or (args.max_bytes and output_bytes(outputs) >= args.max_bytes)
+            ):
+                logging.info(
+                    f"Reached a limit of the run after {progress['written_games']} games and {progress['samples']} samples"
+                )
+                break
+
+    if profiler is not None and profiling:
+        stop_profiler(profiler, args.train + ".prof")
+
+    if targets is not None:
+        for output in targets:
+            output.close()
+
+    if positions is not None:
+        logging.info(f"Building the position index in: {args.positions}")
+        positions.finalize()
+
+    # The last shards are complete (renamed to their final names), a resumed run has nothing left to do
+    progress.update(train=outputs.train.state(), eval=outputs.eval.state(), complete=True)
+    save_json(progress_path, progress)
+
+    if duplicates is not None:
+        logging.info(
+            f"Dropped {duplicates.dropped} duplicate samples in this run, {duplicates.unconfirmed} of them on the "
+            f"counters alone (more than --dedup-exact-keys samples); kept {duplicates.rescued} samples the counters "
+            "took for duplicates"
+        )
+
+    # Report the stage times and token statistics (for games, the tokens of the samples they expand to)
+    logging.info(f"Stages (workers): {worker_timer}; (main): {timer}")
+    if args.metrics:
+        save_json(args.metrics, run_metrics(progress, meter, worker_timer, timer))
+    logging.info(f"Total tokens persisted to train.bin: {progress['train_tokens']}")
+    logging.info(f"Total tokens persisted to eval.bin: {progress['eval_tokens']}")
 
 
 if __name__ == "__main__":
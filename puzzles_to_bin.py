@@ -0,0 +1,65 @@
+import argparse
+import logging
+import sys
+
+from chess_jepa.pgn import eval_split
+from chess_jepa.puzzles import PuzzleFilter, extract_puzzle_tokens_parallel
+from chess_jepa.storage import ShardedWriter, TokenWriter
+from chess_jepa.tokenizer import sample_length
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--puzzles", required=True, help="Lichess puzzles file path (.csv, or compressed e.g. .csv.zst)"
+    )
+    parser.add_argument("--train", default="puzzles_train.bin", help="train output file path")
+    parser.add_argument("--eval", default="puzzles_eval.bin", help="eval output file path")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes")
+    parser.add_argument("--eval-fraction", type=float, default=0.1, help="fraction of the puzzles used for evaluation")
+    parser.add_argument("--shard-size", type=int, default=1 << 30, help="maximum bytes per output shard, 0 for one shard")
+    parser.add_argument("--min-rating", type=int, default=0, help="skip puzzles rated below this")
+    parser.add_argument("--max-rating", type=int, default=None, help="skip puzzles rated above this")
+    parser.add_argument("--themes", default=None, help="comma separated themes, keep puzzles with any of them")
+    parser.add_argument("--exclude-themes", default=None, help="comma separated themes, skip puzzles with any of them")
+    args = parser.parse_args()
+
+    # Configure logging to stdout
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    # Same window size as the samples of games (pgn_to_bin.py)
+    default_window_size = 7
+
+    puzzle_filter = PuzzleFilter(
+        min_rating=args.min_rating,
+        max_rating=args.max_rating,
+        themes=args.themes.split(",") if args.themes else None,
+        exclude_themes=args.exclude_themes.split(",") if args.exclude_themes else None,
+    )
+
+    logging.info(f"Reading puzzles file: {args.puzzles}")
+    length = sample_length(default_window_size)
+    open_shard = lambda path, append: TokenWriter(path, default_window_size, length, append=append)
+    train_samples = 0
+    eval_samples = 0
+    with ShardedWriter(args.train, open_shard, args.shard_size) as train_file, ShardedWriter(
+        args.eval, open_shard, args.shard_size
+    ) as eval_file:
+        results = extract_puzzle_tokens_parallel(
+            args.puzzles, default_window_size, workers=args.workers, puzzle_filter=puzzle_filter
+        )
+        for tokens, hashes in results:
+            # The split only depends on the puzzle (the hash of its id)
+            use_for_eval = eval_split(hashes, args.eval_fraction)
+            train_file.write_rows(tokens[~use_for_eval])
+            eval_file.write_rows(tokens[use_for_eval])
+            train_samples += int((~use_for_eval).sum())
+            eval_samples += int(use_for_eval.sum())
+            logging.info(f"Processed {train_samples + eval_samples} puzzles")
+
+    logging.info(f"Total puzzles persisted to {args.train}: {train_samples}")
+    logging.info(f"Total puzzles persisted to {args.eval}: {eval_samples}")
+
+
+if __name__ == "__main__":
+    main()
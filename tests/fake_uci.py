@@ -0,0 +1,53 @@
+"""
+A tiny UCI engine for the tests: answers every go command at once with the first legal move
+(in UCI order) and a score from the material balance. Analysed positions are appended to the
+file given as the first argument. With --crash as the second argument it exits at the first
+go command instead.
+"""
+
+import sys
+
+import chess
+
+VALUES = {chess.PAWN: 100, chess.KNIGHT: 300, chess.BISHOP: 300, chess.ROOK: 500, chess.QUEEN: 900, chess.KING: 0}
+
+
+def main():
+    log = open(sys.argv[1], "a") if len(sys.argv) > 1 else None
+    crash = sys.argv[2:3] == ["--crash"]
+    board = chess.Board()
+    for line in sys.stdin:
+        command = line.split()
+        if not command:
+            continue
+        if command[0] == "uci":
+            print("id name FakeUci\nid author tests\nuciok", flush=True)
+        elif command[0] == "isready":
+            print("readyok", flush=True)
+        elif command[0] == "position":
+            if command[1] == "startpos":
+                board = chess.Board()
+                moves = command[3:] if len(command) > 2 else []
+            else:
+                board = chess.Board(" ".join(command[2:8]))
+                moves = command[9:]
+            for move in moves:
+                board.push_uci(move)
+        elif command[0] == "go":
+            if crash:
+                sys.exit(1)
+            if log is not None:
+                log.write(board.fen() + "\n")
+                log.flush()
+            moves = sorted(board.legal_moves, key=lambda move: move.uci())
+            score = sum(VALUES[piece.piece_type] * (1 if piece.color else -1) for piece in board.piece_map().values())
+            score = score if board.turn else -score
+            pv = " ".join(move.uci() for move in moves[:1])
+            print(f"info depth 1 score cp {score} nodes 1 pv {pv}".strip(), flush=True)
+            print(f"bestmove {moves[0].uci() if moves else '(none)'}", flush=True)
+        elif command[0] == "quit":
+            break
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import chess
+import numpy as np
+import pytest
+
+from chess_jepa.augment import ColorFlip, flip_colors
+from chess_jepa.pgn import extract_training_samples
+from chess_jepa.tokenizer import encode_batch
+
+# Promotion, en passant and castling
+PGN = """[Event "Test"]
+[Result "1-0"]
+
+1. e4 d5 2. exd5 c6 3. dxc6 Qb6 4. cxb7 Qxb2 5. bxa8=Q Qxa1 6. Nf3 e5 7. Be2 e4
+8. d4 exd3 9. O-O Nf6 1-0
+"""
+
+
+def mirrored_sample(sample: str) -> str:
+    # The same sample built from python-chess: mirrored board, moves and result
+    words = sample.split()
+    board = next(index for index, word in enumerate(words) if "/" in word)
+    fen = chess.Board(" ".join(words[board : board + 4]) + " 0 1").mirror().fen().split()[:4]
+
+    def mirror(word):
+        if word in ("<1-0>", "<0-1>"):
+            return "<0-1>" if word == "<1-0>" else "<1-0>"
+        if len(word) >= 4 and word[:4].isalnum():
+            move = chess.Move.from_uci(word)
+            square = chess.square_mirror
+            return chess.Move(square(move.from_square), square(move.to_square), move.promotion).uci()
+        return word
+
+    return " ".join([mirror(word) for word in words[:board]] + fen + [mirror(word) for word in words[board + 4 :]])
+
+
+def test_flip_colors():
+    samples = list(extract_training_samples(PGN, window_size=3))
+    assert len(samples) == 21
+
+    tokens = encode_batch(samples, dtype=np.uint8)
+    expected = encode_batch([mirrored_sample(sample) for sample in samples], dtype=np.uint8)
+    assert np.array_equal(flip_colors(tokens, window_size=3), expected)
+    assert np.array_equal(flip_colors(expected, window_size=3), tokens)
+
+
+def test_color_flip_transform():
+    torch = pytest.importorskip("torch")
+    tokens = torch.from_numpy(encode_batch(list(extract_training_samples(PGN, window_size=3)), dtype=np.uint8))
+    flipped = flip_colors(tokens, window_size=3)
+    torch.manual_seed(0)
+    batch = ColorFlip(window_size=3)(tokens.clone())
+    selected = (batch != tokens).any(dim=1)
+    assert 0 < selected.sum() < len(tokens)
+    assert torch.equal(batch[selected], flipped[selected])
@@ -0,0 +1,26 @@
+from benchmark import compare, generate_corpus, run_benchmarks
+from chess_jepa.pgn import extract_training_samples
+
+
+def test_benchmark():
+    text = generate_corpus(5, seed=1)
+    assert text == generate_corpus(5, seed=1)
+
+    results = run_benchmarks(text, window_size=5, repeat=1, legacy=False)
+    assert results["corpus"]["games"] == 5
+    assert results["corpus"]["samples"] == len(list(extract_training_samples(text, window_size=5)))
+    assert set(results["stages"]) == {
+        "parse",
+        "replay",
+        "fen",
+        "encode_strings",
+        "encode_boards",
+        "write",
+        "extract_tokens",
+        "pgn_to_bin",
+    }
+
+    # A stage twice as fast in the baseline is a regression
+    baseline = {"stages": {"parse": {"games_per_second": 2 * results["stages"]["parse"]["games_per_second"]}}}
+    assert compare(results, baseline, tolerance=0.1) == ["parse games_per_second"]
+    assert compare(results, results, tolerance=0.1) == []
@@ -0,0 +1,64 @@
+import bz2
+import gzip
+import shutil
+import subprocess
+import zipfile
+
+import numpy as np
+import pytest
+
+from chess_jepa.compressed import open_compressed
+from chess_jepa.pgn import extract_training_tokens, extract_training_tokens_parallel, read_pgn_chunks
+
+TEXT = b'[Event "Test"]\n[Result "1-0"]\n\n1. e4 e5 2. Qh5 Nc6 3. Bc4 Nf6 4. Qxf7# 1-0\n\n' * 2000
+
+
+def _truncated(path):
+    data = path.read_bytes()
+    path.write_bytes(data[: len(data) // 2])
+
+
+def _compress(path, data: bytes):
+    suffix = path.suffix
+    if suffix == ".gz":
+        path.write_bytes(gzip.compress(data))
+    elif suffix == ".bz2":
+        path.write_bytes(bz2.compress(data))
+    elif suffix == ".zip":
+        with zipfile.ZipFile(path, "w") as archive:
+            archive.writestr("games.pgn", data)
+    else:
+        path.write_bytes(subprocess.run(["zstd", "-c", "-q"], input=data, capture_output=True, check=True).stdout)
+
+
+@pytest.mark.parametrize("name", ["games.pgn.gz", "games.pgn.bz2", "games.pgn.zip", "games.pgn.zst"])
+def test_read_compressed(tmp_path, name):
+    if name.endswith(".zst") and shutil.which("zstd") is None:
+        pytest.skip("needs the zstd command line tool")
+    path = tmp_path / name
+    _compress(path, TEXT)
+
+    # Read in small blocks, ahead of the reader
+    with open_compressed(str(path), block_size=1000, queue_size=2) as stream:
+        assert stream.read() == TEXT
+
+    # Chunks cut at game starts, numbered, from any game on
+    chunks = list(read_pgn_chunks(str(path), chunk_size=5000, start=10))
+    assert len(chunks) > 1 and chunks[0][0] == 10 and chunks[-1][1] == 2000
+    assert all(last == first for (_, last, _), (first, _, _) in zip(chunks, chunks[1:]))
+    assert "".join(text for _, _, text in chunks) == TEXT.decode()[10 * len(TEXT) // 2000 :]
+
+    # The same samples as the plain text, streamed to the workers
+    tokens = np.concatenate(list(extract_training_tokens_parallel(str(path), 3, workers=2, chunk_size=20000)))
+    assert np.array_equal(tokens, np.concatenate([game.copy() for game in extract_training_tokens(TEXT.decode(), 3)]))
+
+
+@pytest.mark.parametrize("name", ["games.pgn.gz", "games.pgn.bz2", "games.pgn.zst"])
+def test_truncated(tmp_path, name):
+    if name.endswith(".zst") and shutil.which("zstd") is None:
+        pytest.skip("needs the zstd command line tool")
+    path = tmp_path / name
+    _compress(path, TEXT)
+    _truncated(path)
+    with pytest.raises(EOFError), open_compressed(str(path)) as stream:
+        stream.read()
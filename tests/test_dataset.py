@@ -0,0 +1,120 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from torch.utils.data import DataLoader
+
+from chess_jepa.dataset import BlockBatchSampler, GameDataset, ShuffledTokenStream, TokenDataset
+from chess_jepa.pgn import extract_games, extract_training_tokens
+from chess_jepa.storage import HEADER_SIZE, GameWriter, ShardedWriter, TokenWriter
+from chess_jepa.tokenizer import sample_length
+
+# Promotions, en passant, castling and a game shorter than the window
+PGN = """[Event "Test"]
+[Result "0-1"]
+
+1. e4 d5 2. exd5 c6 3. dxc6 Qb6 4. cxb7 Qxb2 5. bxa8=N Qxa1 6. Nf3 e5 7. Be2 e4 8. d4 exd3 9. O-O Nf6 0-1
+
+[Event "Test"]
+[Result "1-0"]
+
+1. e4 1-0
+
+[Event "Test"]
+[Result "1/2-1/2"]
+
+1. d4 d5 2. c4 e6 3. Nc3 Nf6 4. Bg5 Be7 5. e3 O-O 6. Nf3 h6 1/2-1/2
+"""
+
+
+def test_token_dataset(tmp_path):
+    path = str(tmp_path / "train.bin")
+    rows = np.arange(37 * 5, dtype=np.uint8).reshape(37, 5)
+    with TokenWriter(path, window_size=1, sample_length=5) as writer:
+        writer.write(rows)
+
+    # Single samples, slices and index arrays, into a preallocated tensor
+    dataset = TokenDataset(path)
+    assert len(dataset) == 37
+    assert dataset[3].tolist() == rows[3].tolist()
+    assert torch.equal(dataset[5:9], torch.from_numpy(rows[5:9]))
+    assert torch.equal(dataset[np.array([30, 1, 7])], torch.from_numpy(rows[[30, 1, 7]]))
+    out = torch.zeros((3, 5), dtype=torch.uint8)
+    assert dataset.read_batch([2, 4, 6], out=out) is out and torch.equal(out, torch.from_numpy(rows[[2, 4, 6]]))
+
+    # Every sample once per epoch in DataLoader workers, batches of samples stride apart
+    sampler = BlockBatchSampler(len(dataset), batch_size=4, stride=3, seed=1)
+    loader = DataLoader(dataset, sampler=sampler, batch_size=None, num_workers=2)
+    orders = []
+    for epoch in (0, 1):
+        sampler.set_epoch(epoch)
+        batches = list(loader)
+        assert len(batches) == len(sampler) and all(len(batch) <= 4 for batch in batches)
+        assert all((np.diff(batch[:, 0].numpy() // 5) == 3).all() for batch in batches)
+        orders.append(torch.cat(batches)[:, 0].tolist())
+        assert sorted(orders[-1]) == rows[:, 0].tolist()
+    assert orders[0] != orders[1]
+
+
+def test_game_dataset(tmp_path):
+    # The same samples stored as tokens and as games
+    tokens_path, games_path = str(tmp_path / "tokens.bin"), str(tmp_path / "games.bin")
+    rows = np.concatenate([game.copy() for game in extract_training_tokens(PGN * 4, 3, dtype=np.uint8)])
+    with TokenWriter(tokens_path, 3, sample_length(3)) as writer:
+        writer.write(rows)
+    with GameWriter(games_path) as writer:
+        for moves, result in extract_games(PGN * 4):
+            writer.write(moves, result)
+
+    tokens, games = TokenDataset(tokens_path), GameDataset(games_path, window_size=3)
+    assert len(games) == len(tokens) == len(rows)
+    assert torch.equal(games[:], tokens[:])
+    indices = np.random.default_rng(0).permutation(len(rows))[:50]
+    assert torch.equal(games[indices], torch.from_numpy(rows[indices]))
+    assert torch.equal(games[5], tokens[5])
+
+    # Read in DataLoader workers, every sample once
+    sampler = BlockBatchSampler(len(games), batch_size=16, stride=2)
+    batches = list(DataLoader(games, sampler=sampler, batch_size=None, num_workers=2))
+    assert sorted(map(bytes, torch.cat(batches).numpy())) == sorted(map(bytes, rows))
+
+
+def _write_shards(path, count):
+    # Samples numbered in their first two tokens, in shards of 70 samples
+    rows = np.zeros((count, 4), dtype=np.uint8)
+    rows[:, 0], rows[:, 1] = np.arange(count) % 256, np.arange(count) // 256
+    with ShardedWriter(path, lambda shard, append: TokenWriter(shard, 1, 4, append=append), HEADER_SIZE + 70 * 4) as output:
+        output.write_rows(rows)
+
+
+def _numbers(batches) -> list[int]:
+    rows = torch.cat(list(batches)).long()
+    return (rows[:, 0] + 256 * rows[:, 1]).tolist()
+
+
+def test_shuffled_token_stream(tmp_path):
+    path = str(tmp_path / "train.bin")
+    _write_shards(path, 1000)
+
+    # Every sample once per epoch, shuffled beyond the blocks read, in another order every epoch
+    stream = ShuffledTokenStream(path, batch_size=32, buffer_size=200, block_size=16)
+    assert len(stream.paths) == 15 and len(stream) == 32
+    first = _numbers(stream)
+    assert sorted(first) == list(range(1000)) and first != sorted(first)
+    assert _numbers(stream) == first
+    stream.set_epoch(1)
+    assert sorted(_numbers(stream)) == list(range(1000)) and _numbers(stream) != first
+
+    # Split between DataLoader workers
+    loader = DataLoader(stream, batch_size=None, num_workers=2)
+    assert sorted(_numbers(loader)) == list(range(1000))
+
+    # Split between ranks, the same number of full batches each
+    numbers = []
+    for rank in range(4):
+        stream = ShuffledTokenStream(path, batch_size=10, buffer_size=50, rank=rank, world_size=4, even=True, drop_last=True)
+        batches = list(stream)
+        assert len(batches) == len(stream) == 21 and all(len(batch) == 10 for batch in batches)
+        numbers += _numbers(batches)
+    assert len(set(numbers)) == len(numbers) == 840
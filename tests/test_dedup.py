@@ -0,0 +1,83 @@
+import numpy as np
+
+from chess_jepa.dedup import DuplicateFilter, sample_hashes
+
+
+def test_sample_hashes():
+    rows = np.random.default_rng(0).integers(0, 226, size=(500, 94), dtype=np.uint8)
+    rows[250:] = rows[:250]
+    hashes = sample_hashes(rows, batch_size=64)
+    assert np.array_equal(hashes[250:], hashes[:250]) and len(np.unique(hashes)) == 250
+    # Every token counts, at its position
+    changed = rows[:1].copy()
+    changed[0, 93] += 1
+    assert sample_hashes(changed)[0] != hashes[0]
+
+
+def test_max_copies(tmp_path):
+    rng = np.random.default_rng(0)
+    keys = np.arange(200, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    # Batches of repeated keys, one with many copies of the same keys
+    batches = [keys[rng.integers(0, 200, size)] for size in (1, 50, 300, 7, 500)] + [np.repeat(keys[:5], 10)]
+
+    for max_copies in (1, 3):
+        for path in (None, str(tmp_path / f"{max_copies}.dedup")):
+            duplicates = DuplicateFilter(max_copies, 1 << 16, path=path)
+            kept = {}
+            for number, batch in enumerate(batches):
+                # The first max_copies copies of every key are kept, across and within batches
+                expected = []
+                for key in batch.tolist():
+                    expected.append(kept.get(key, 0) < max_copies)
+                    kept[key] = kept.get(key, 0) + expected[-1]
+                assert duplicates.keep(batch).tolist() == expected
+                if path is not None and number % 2:
+                    # Committed with a checkpoint and reopened, the counts continue
+                    duplicates.prepare(number)
+                    duplicates.commit()
+                    duplicates = DuplicateFilter(max_copies, 1 << 16, path=path, append=True, checkpoint=number)
+            assert max(kept.values()) == max_copies
+
+
+def test_counts_committed_with_checkpoint(tmp_path):
+    path = str(tmp_path / "train.bin.dedup")
+    keys = np.arange(100, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+
+    # Counts are staged until committed, the next calls see them
+    duplicates = DuplicateFilter(1, 4096, path=path)
+    assert duplicates.keep(keys[:50]).all()
+    duplicates.prepare(1)
+    duplicates.commit()
+    committed = open(path, "rb").read()
+    assert not duplicates.keep(keys[:50]).any() and duplicates.keep(keys[50:]).all()
+    assert not duplicates.keep(keys[50:]).any()
+    assert open(path, "rb").read() == committed
+
+    # Interrupted before the progress of checkpoint 2 was saved: its counts are dropped
+    duplicates.prepare(2)
+    duplicates = DuplicateFilter(1, 4096, path=path, append=True, checkpoint=1)
+    assert duplicates.keep(keys[50:]).all()
+
+    # Interrupted after the progress was saved, before commit: its counts are written
+    duplicates.prepare(2)
+    duplicates = DuplicateFilter(1, 4096, path=path, append=True, checkpoint=2)
+    assert not duplicates.keep(keys).any()
+
+
+def test_exact_counts(tmp_path):
+    keys = np.arange(300, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+
+    # A sketch far too small counts most unique keys as copies, the exact counts keep them
+    duplicates = DuplicateFilter(1, 16, path=str(tmp_path / "train.bin.dedup"))
+    assert all(duplicates.keep(batch).all() for batch in np.split(keys[:200], 20))
+    assert duplicates.rescued > 0 and duplicates.dropped == 0
+    duplicates.prepare(1)
+    duplicates.commit()
+    duplicates = DuplicateFilter(1, 16, path=str(tmp_path / "train.bin.dedup"), append=True, checkpoint=1)
+    assert not duplicates.keep(keys[:200]).any() and duplicates.keep(keys[200:]).all()
+    assert duplicates.dropped == 200 and duplicates.unconfirmed == 0
+
+    # Past exact_keys keys the sketch decides alone
+    duplicates = DuplicateFilter(1, 16, exact_keys=100)
+    assert all(duplicates.keep(batch).all() for batch in np.split(keys[:110], 11)) and duplicates.exact is None
+    assert not duplicates.keep(keys[110:]).all() and duplicates.dropped == duplicates.unconfirmed > 0
@@ -0,0 +1,36 @@
+import json
+
+import chess
+
+from chess_jepa.evaluations import EvaluationTable, build_evaluation_table
+from chess_jepa.pgn import extract_training_samples
+from chess_jepa.tokenizer import encode_batch
+
+
+def test_evaluation_table(tmp_path):
+    positions = [
+        {
+            "fen": "rnbqkbnr/pppppppp/8/8/4P3/8/PPPP1PPP/RNBQKBNR b KQkq -",
+            "evals": [
+                {"pvs": [{"cp": 10, "line": "c7c5 g1f3"}], "knodes": 100, "depth": 20},
+                {"pvs": [{"cp": 25, "line": "e7e5 g1f3"}], "knodes": 900, "depth": 36},
+            ],
+        },
+        {"fen": "6k1/5ppp/8/8/8/8/8/R5K1 w - -", "evals": [{"pvs": [{"mate": 1, "line": "a1a8"}], "depth": 99}]},
+    ]
+    path = tmp_path / "evals.jsonl"
+    path.write_text("\n".join(json.dumps(position) for position in positions) + "\n")
+    assert build_evaluation_table(str(path), str(tmp_path / "evals.bin"), workers=1) == 2
+
+    table = EvaluationTable(str(tmp_path / "evals.bin"))
+    boards = [chess.Board(positions[0]["fen"]), chess.Board(positions[1]["fen"]), chess.Board()]
+    found = table.lookup_boards(boards)
+    assert found["cp"].tolist() == [25, 0, 0]
+    assert found["mate"].tolist() == [0, 1, 0]
+    assert found["depth"].tolist() == [36, 99, 0]
+    assert chess.Move(int(found["move"][1]) & 63, int(found["move"][1]) >> 6).uci() == "a1a8"
+
+    # The same positions found from the tokens of the training samples
+    samples = list(extract_training_samples('[Event "Test"]\n[Result "*"]\n\n1. e4 e5 *\n', window_size=5))
+    found = table.lookup_samples(encode_batch(samples), window_size=5)
+    assert found["depth"].tolist() == [0, 0, 36, 0]
@@ -0,0 +1,67 @@
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pgn_to_bin
+from ingest import memory_estimate, source_name
+
+INGEST = str(Path(__file__).parent.parent / "ingest.py")
+
+GAME = '[Event "Test"]\n[Result "1-0"]\n\n1. e4 e5 2. Qh5 Nc6 3. Bc4 Nf6 4. Qxf7# 1-0\n\n'
+
+
+def test_source_name():
+    assert source_name("data/lichess_db_standard_rated_2024-01.pgn.zst") == "lichess_db_standard_rated_2024-01"
+    assert source_name("lichess_elite_2024-02.zip") == "lichess_elite_2024-02"
+
+
+def test_memory_estimate():
+    options = pgn_to_bin.build_parser().parse_args(["--pgn", "", "--buffer-size", "1000"])
+    base = memory_estimate(1, options)
+    assert memory_estimate(4, options) > base
+    # The background writer queues more buffers, the duplicate counters are counted with dedup only
+    background = pgn_to_bin.build_parser().parse_args(["--pgn", "", "--buffer-size", "1000", "--background-writer"])
+    assert memory_estimate(1, background) == base + 4000
+    dedup = ["--max-copies", "1", "--dedup-memory", "5000", "--dedup-exact-keys", "100"]
+    dedup = pgn_to_bin.build_parser().parse_args(["--pgn", "", "--buffer-size", "1000"] + dedup)
+    assert memory_estimate(1, dedup) == base + 5900
+
+
+def test_ingest(tmp_path):
+    for month in ("2024-01", "2024-02"):
+        (tmp_path / f"{month}.pgn").write_text(GAME * 3)
+    output = tmp_path / "dataset"
+    command = [sys.executable, INGEST, str(tmp_path / "*.pgn"), "--output", str(output), "--workers", "2"]
+    command += ["--eval-fraction", "0"]
+    subprocess.run(command, check=True, capture_output=True)
+
+    manifest = json.loads((output / "manifest.json").read_text())
+    assert sorted(manifest["sources"]) == ["2024-01", "2024-02"]
+    assert manifest["totals"]["games"] == 6
+    assert manifest["totals"]["train_records"] == 6 * 14  # 7 moves and a window of 7
+    assert all(os.path.exists(output / shard["path"]) for shard in manifest["sources"]["2024-01"]["train"]["shards"])
+
+    # Converted sources are skipped, a source with a changed shard is converted again
+    shard = output / manifest["sources"]["2024-02"]["train"]["shards"][0]["path"]
+    shard.write_bytes(shard.read_bytes()[:-1] + b"\xff")
+    result = subprocess.run(command, check=True, capture_output=True, text=True)
+    assert "Skipping" in result.stdout and "converting it again" in result.stdout
+    assert json.loads((output / "manifest.json").read_text()) == manifest
+
+
+def test_ingest_memory(tmp_path):
+    for month in ("2024-01", "2024-02"):
+        (tmp_path / f"{month}.pgn").write_text(GAME * 3)
+    command = [sys.executable, INGEST, str(tmp_path / "*.pgn"), "--workers", "2", "--eval-fraction", "0"]
+
+    def events(output, memory):
+        arguments = ["--output", str(tmp_path / output), "--memory", str(memory)]
+        result = subprocess.run(command + arguments, check=True, capture_output=True, text=True)
+        lines = [line for line in result.stdout.splitlines() if "Starting" in line or "Converted " in line]
+        return [line.split()[0].split(":")[-1] for line in lines]
+
+    # Both sources at once with enough memory, one at a time (each alone is too large) without
+    assert events("large", 1 << 40)[:2] == ["Starting", "Starting"]
+    assert events("small", 1) == ["Starting", "Converted", "Starting", "Converted"]
@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from chess_jepa.masks import MoveMaskCollator, apply_masks
+from chess_jepa.pgn import extract_training_tokens
+from chess_jepa.tokenizer import PADDING_TOKEN, default_vocabulary
+
+PGN = """[Event "Test"]
+[Result "1-0"]
+
+1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 4. Ba4 Nf6 5. O-O Be7 1-0
+"""
+
+
+def samples(window_size=5):
+    return torch.from_numpy(np.concatenate(list(extract_training_tokens(PGN, window_size, dtype=np.uint8))))
+
+
+def test_random_future_moves():
+    tokens = samples()
+    collator = MoveMaskCollator(window_size=5, num_masked=2)
+    batch, context, targets = collator(list(tokens))
+
+    assert torch.equal(batch, tokens)
+    assert targets.shape == (len(tokens), 4) and context.shape == (len(tokens), tokens.shape[1] - 4)
+    for row in range(len(tokens)):
+        assert set(context[row].tolist()) | set(targets[row].tolist()) == set(range(tokens.shape[1]))
+        # Only moves of the after window are masked, padding only when there are fewer moves
+        assert (targets[row] >= tokens.shape[1] - 10).all()
+        moves = (tokens[row, targets[row][::2]] != default_vocabulary.get_index(PADDING_TOKEN)).sum()
+        assert moves == min(2, (tokens[row, -10::2] != default_vocabulary.get_index(PADDING_TOKEN)).sum())
+
+
+def test_spans_and_seeding():
+    tokens = samples()
+    first = MoveMaskCollator(window_size=5, slots="both", mode="span", num_masked=(1, 3))
+    second = MoveMaskCollator(window_size=5, slots="both", mode="span", num_masked=(1, 3))
+    for _ in range(3):
+        _, _, targets = first(tokens)
+        assert torch.equal(targets, second(tokens)[2])
+        # Consecutive moves, but the board is skipped between the before and after windows
+        steps = targets[:, 2::2] - targets[:, :-2:2]
+        assert ((steps == 2) | (steps == 2 + tokens.shape[1] - 20)).all()
+
+    # Gather the embeddings of the context
+    _, context, _ = first(tokens)
+    embeddings = torch.arange(tokens.shape[1], dtype=torch.float32)[None, :, None].expand(len(tokens), -1, 3)
+    assert torch.equal(apply_masks(embeddings, context)[:, :, 0].long(), context)
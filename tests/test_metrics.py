@@ -0,0 +1,33 @@
+import time
+
+from chess_jepa.metrics import Progress, StageTimer
+from chess_jepa.pgn import extract_training_tokens_parallel
+
+
+def test_stage_timer():
+    timer = StageTimer()
+    with timer.time("parse"):
+        time.sleep(0.01)
+    assert list(timer.iterate([1, 2], "wait")) == [1, 2]
+    timer.add({"parse": 1.0})
+    assert timer.as_dict()["parse"] > 1.0
+    assert set(timer.as_dict()) == {"parse", "wait"}
+
+
+def test_progress():
+    meter = Progress(total_bytes=1000, window=60)
+    assert meter.eta() is None
+    meter.update(bytes=100, games=10, samples=100)
+    meter.points[0] = (meter.points[0][0] - 1.0, meter.points[0][1])  # One second earlier
+    meter.update(bytes=200, games=20, samples=200)
+    assert 95 < meter.rates()["bytes"] <= 100
+    assert 8 <= meter.eta() < 8.5
+    assert "20.0%" in str(meter)
+
+
+def test_chunk_times(tmp_path):
+    path = tmp_path / "games.pgn"
+    path.write_text('[Event "Test"]\n[Result "1-0"]\n\n1. e4 e5 2. Qh5 Nc6 3. Bc4 Nf6 4. Qxf7# 1-0\n')
+    ((tokens, seconds),) = extract_training_tokens_parallel(str(path), window_size=5, workers=1, with_times=True)
+    assert len(tokens) == 12
+    assert {"read", "parse", "replay", "encode"} <= set(seconds)
@@ -0,0 +1,88 @@
+import asyncio
+import os
+import sys
+
+import chess
+import chess.engine
+import pytest
+
+from chess_jepa.oracle import EnginePool, EvalCache, evaluate_positions
+
+FAKE_ENGINE = os.path.join(os.path.dirname(__file__), "fake_uci.py")
+
+
+def engine_command(log_path):
+    return [sys.executable, FAKE_ENGINE, str(log_path)]
+
+
+def analysed(log_path):
+    with open(log_path) as file:
+        return file.read().splitlines()
+
+
+def test_analyse_positions(tmp_path):
+    board = chess.Board()
+    board.push_san("e4")
+    board.push_san("d5")
+    board.push_san("exd5")
+
+    evaluations = evaluate_positions(engine_command(tmp_path / "log"), [chess.Board(), board], chess.engine.Limit(depth=1))
+
+    assert evaluations[0].score == 0 and evaluations[0].mate is None
+    assert evaluations[0].best_move == chess.Move.from_uci("a2a3")
+    assert evaluations[1].score == 100
+    assert evaluations[1].pv == [evaluations[1].best_move]
+
+
+def test_duplicates_analysed_once(tmp_path):
+    boards = [chess.Board(), chess.Board(), chess.Board("8/8/8/4k3/8/8/4P3/4K3 w - - 0 1")]
+    # The same position reached with a different move history
+    board = chess.Board()
+    for san in ["Nf3", "Nf6", "Ng1", "Ng8"]:
+        board.push_san(san)
+    boards.append(board)
+
+    async def run():
+        async with EnginePool(engine_command(tmp_path / "log"), workers=2) as pool:
+            first, second = await asyncio.gather(
+                pool.analyse_many(boards, chess.engine.Limit(depth=1)),
+                pool.analyse_many(boards[:1], chess.engine.Limit(depth=1)),
+            )
+            return first + second, pool.metrics
+
+    evaluations, metrics = asyncio.run(run())
+    assert len(analysed(tmp_path / "log")) == 2
+    assert evaluations[0] == evaluations[1] == evaluations[3] == evaluations[4]
+    assert metrics.requests == 5 and metrics.analysed == 2 and metrics.deduplicated == 3
+
+
+def test_cache_shared_across_runs(tmp_path):
+    boards = [chess.Board(), chess.Board("8/8/8/4k3/8/8/4P3/4K3 w - - 0 1")]
+    cache_path = str(tmp_path / "evals.sqlite")
+
+    first = evaluate_positions(engine_command(tmp_path / "log"), boards, chess.engine.Limit(depth=1), cache_path=cache_path)
+    second = evaluate_positions(engine_command(tmp_path / "log"), boards, chess.engine.Limit(depth=1), cache_path=cache_path)
+    assert first == second
+    assert len(analysed(tmp_path / "log")) == 2
+
+    # Other search settings are another entry
+    evaluate_positions(engine_command(tmp_path / "log"), boards[:1], chess.engine.Limit(depth=2), cache_path=cache_path)
+    assert len(analysed(tmp_path / "log")) == 3
+    cache = EvalCache(cache_path)
+    assert len(cache) == 3
+    cache.close()
+
+
+def test_engine_lost(tmp_path):
+    async def run():
+        async with EnginePool(engine_command(tmp_path / "log") + ["--crash"], workers=1, retries=0) as pool:
+            # The engine crashes and cannot be started again
+            pool.command = [str(tmp_path / "missing")]
+            with pytest.raises(OSError):
+                await pool.analyse(chess.Board(), chess.engine.Limit(depth=1))
+            assert pool.engines == []
+            # Later analyses fail instead of waiting for an engine
+            with pytest.raises(chess.engine.EngineError):
+                await pool.analyse(chess.Board(), chess.engine.Limit(depth=1))
+
+    asyncio.run(run())
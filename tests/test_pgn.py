@@ -1,6 +1,29 @@
 
-from chess_jepa.tokenizer import encode
-from chess_jepa.pgn import extract_training_samples
+import io
+import os
+import random
+
+import chess
+import chess.pgn
+import numpy as np
+
+from chess_jepa.storage import RESULTS
+from chess_jepa.tokenizer import encode, encode_batch, encode_game
+from chess_jepa.pgn import (
+    board_state,
+    extract_games,
+    extract_training_samples,
+    extract_training_tokens,
+    extract_training_tokens_parallel,
+    filter_pgn,
+    GameFilter,
+    load_pgn_index,
+    move_code,
+    pgn_index_path,
+    read_game_at,
+    read_mainline,
+    split_pgn,
+)
 
 def test_simple_pgn():
     pgn = """[Event "Game on 2024.01.23 20:39:12 UTC | Coach Moves: 5"]
@@ -21,4 +44,294 @@ def test_simple_pgn():
     assert len(data[0]) == 94 # tokens for each sample
     
     # verify that all the samples have the same length
-    assert len(set(len(sample) for sample in data)) == 1
\ No newline at end of file
+    assert len(set(len(sample) for sample in data)) == 1
+
+# Games chess.pgn reads: without an Event tag, without a blank line after the headers, with a
+# blank line between tags, a FEN start, comments and variations
+PARITY_GAMES = [
+    '[Event "A"]\n[Result "1-0"]\n\n1. e4 e5 2. Qh5 Nc6 3. Bc4 Nf6 4. Qxf7# 1-0\n\n',
+    '[Site "B"]\n[White "x"]\n[Result "0-1"]\n\n1. f3 e5 2. g4 Qh4# 0-1\n\n',
+    '[Event "C"]\n[Result "*"]\n1. d4 { a comment\n\nover lines } d5 (1... Nf6 2. c4) 2. c4 *\n\n',
+    '[Event "D"]\n[FEN "4k3/8/8/8/8/8/4P3/4K3 w - - 0 1"]\n[SetUp "1"]\n\n1. e4 Kd7 2. e5 *\n\n',
+    '[Event "E"]\n\n[Result "1/2-1/2"]\n\n1. Nf3 Nf6 2. Ng1 Ng8 1/2-1/2\n\n',
+]
+
+
+def _chess_pgn_games(text):
+    games, stream = [], io.StringIO(text)
+    while (game := chess.pgn.read_game(stream)) is not None:
+        games.append((dict(game.headers), [move_code(move) for move in game.mainline_moves()]))
+    return games
+
+
+def test_read_mainline_parity():
+    text = "".join(PARITY_GAMES)
+    for variant in (text, text.replace("\n", "\r\n"), text.replace("\n\n1.", "\n1.")):
+        expected = _chess_pgn_games(variant)
+        assert len(expected) == len(PARITY_GAMES)
+        for input in (variant, io.StringIO(variant)):
+            games = list(read_mainline(input))
+            assert [moves.tolist() for _, moves in games] == [moves for _, moves in expected]
+            # chess.pgn adds the missing tags of the seven tag roster
+            assert all(headers.items() <= full.items() for (headers, _), (full, _) in zip(games, expected))
+        assert len(list(extract_training_samples(variant, window_size=3))) == sum(
+            len(moves) + min(len(moves), 3) for _, moves in expected
+        )
+
+    # A tag line right after movetext starts a new game
+    games = list(read_mainline(PARITY_GAMES[0].rstrip("\n") + "\n" + PARITY_GAMES[1]))
+    assert [headers["Result"] for headers, _ in games] == ["1-0", "0-1"]
+
+
+def test_crlf_file(tmp_path):
+    text = "".join(PARITY_GAMES)
+    (tmp_path / "lf.pgn").write_bytes(text.encode())
+    (tmp_path / "crlf.pgn").write_bytes(text.replace("\n", "\r\n").encode())
+    counts = []
+    for name in ("lf.pgn", "crlf.pgn"):
+        path = str(tmp_path / name)
+        index = load_pgn_index(path)
+        ranges = [index.byte_range(first, last) for first, last in index.split(64)]
+        counts.append(sum(len(tokens) for tokens in extract_training_tokens_parallel(path, 3, workers=1, ranges=ranges)))
+        counts.append(sum(len(tokens) for tokens in extract_training_tokens_parallel(path, 3, workers=1, chunk_size=64)))
+        assert len(index) == len(PARITY_GAMES)
+    assert counts == [36] * 4
+
+
+def test_ply_counts(tmp_path):
+    # Castling written with zeros counts like in the reader
+    games = PARITY_GAMES + ['[Event "F"]\n\n1. e4 e5 2. Nf3 Nc6 3. Bc4 Bc5 4. 0-0 Nf6 *\n\n']
+    text = "".join(games)
+    path = tmp_path / "games.pgn"
+    path.write_text(text)
+    plies = [len(moves) for _, moves in read_mainline(text)]
+    assert plies[-1] == 8
+    assert load_pgn_index(str(path)).plies.tolist() == plies
+    assert [GameFilter(min_plies=count).accepts(game) for game, count in zip(games, plies)] == [True] * 6
+    assert not any(GameFilter(min_plies=count + 1).accepts(game) for game, count in zip(games, plies))
+
+
+# Promotions, en passant, castling, a FEN start, comments and variations, a game shorter than
+# the window and one without moves
+GAMES_PGN = """[Event "A"]
+[Result "0-1"]
+
+1. e4 d5 2. exd5 c6 3. dxc6 Qb6 4. cxb7 Qxb2 5. bxa8=R Qxa1 6. Nf3 e5 7. Be2 e4 8. d4 exd3 9. O-O Nf6 0-1
+
+[Event "B"]
+[Result "*"]
+[FEN "4k3/8/8/8/8/8/4P3/4K3 w - - 0 1"]
+[SetUp "1"]
+
+1. e4 { a comment } Kd7 (1... Kf7 2. e5) 2. e5 *
+
+[Event "C"]
+[Result "1-0"]
+
+1. e4 1-0
+
+[Event "D"]
+[Result "*"]
+
+*
+
+"""
+
+
+def test_extract_training_tokens():
+    games, stream = [], io.StringIO(GAMES_PGN)
+    while (game := chess.pgn.read_game(stream)) is not None:
+        board = game.board()
+        boards, moves = [board_state(board)], []
+        for move in game.mainline_moves():
+            board.push(move)
+            boards.append(board_state(board))
+            moves.append(move_code(move))
+        if moves:
+            games.append((boards, moves, game.headers["Result"]))
+
+    for window_size in (1, 3, 5):
+        expected = encode_batch(list(extract_training_samples(GAMES_PGN, window_size)))
+        tokens = [game.copy() for game in extract_training_tokens(GAMES_PGN, window_size)]
+        assert len(tokens) == len(games)
+        assert np.array_equal(np.concatenate(tokens), expected)
+
+        # Game by game from the board states, into a reused buffer
+        out = np.zeros((64, expected.shape[1]), dtype=np.int32)
+        for (boards, moves, result), game_tokens in zip(games, tokens):
+            assert np.array_equal(encode_game(boards, moves, result, window_size, out=out), game_tokens)
+
+
+def test_split_pgn(tmp_path):
+    # Games with long movetext lines, comments with blank lines and tags inside comments
+    text = "".join(PARITY_GAMES * 3) + '[Event "L"]\n\n' + "1. Nf3 Nf6 2. Ng1 Ng8 " * 40 + "{ [not a tag] } *\n\n"
+    path = tmp_path / "games.pgn"
+    path.write_text(text)
+    expected = _chess_pgn_games(text)
+
+    for chunk_size in (1, 40, 100, 300, 5000):
+        ranges = split_pgn(str(path), chunk_size)
+        assert ranges[0][0] == 0 and ranges[-1][1] == len(text)
+        assert all(end == start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+        # Every range holds whole games: together the same games as the whole file
+        games = [game for start, end in ranges for game in _chess_pgn_games(text[start:end])]
+        assert [moves for _, moves in games] == [moves for _, moves in expected]
+
+        # Worker processes give the same samples, in file order
+        tokens = np.concatenate(list(extract_training_tokens_parallel(str(path), 3, workers=2, chunk_size=chunk_size)))
+        assert np.array_equal(tokens, np.concatenate([game.copy() for game in extract_training_tokens(text, 3)]))
+
+
+def test_pgn_index(tmp_path):
+    games = GAMES_PGN.replace("\n[Event", "\n\x00[Event").split("\x00") * 3
+    games = [
+        game.replace("[Result", '[WhiteElo "1500"]\n[BlackElo "2100"]\n[Result', 1) if number % 2 else game
+        for number, game in enumerate(games)
+    ]
+    text = "".join(games)
+    path = tmp_path / "games.pgn"
+    path.write_text(text)
+    expected, stream = [], io.StringIO(text)
+    while (game := chess.pgn.read_game(stream)) is not None:
+        expected.append((game.headers, [move.uci() for move in game.mainline_moves()]))
+
+    index = load_pgn_index(str(path))
+    assert len(index) == len(expected) and int(index.offsets[-1]) == len(text)
+    for number, (headers, moves) in enumerate(expected):
+        game = read_game_at(str(path), index, number)
+        assert [move.uci() for move in game.mainline_moves()] == moves
+        assert index.white_elo[number] == int(headers.get("WhiteElo", 0))
+        assert index.black_elo[number] == int(headers.get("BlackElo", 0))
+        assert RESULTS[index.results[number]] == headers["Result"]
+        assert index.plies[number] == len(moves)
+
+    # Game ranges of about chunk_size bytes from any game on, at least one game each
+    for chunk_size, start in ((1, 0), (100, 3), (1000, 7), (1 << 20, 0)):
+        chunks = index.split(chunk_size, start=start)
+        assert chunks[0][0] == start and chunks[-1][1] == len(index)
+        assert all(first < last for first, last in chunks)
+        assert all(last == first for (_, last), (first, _) in zip(chunks, chunks[1:]))
+        assert all(
+            last == first + 1 or index.offsets[last] - index.offsets[first] <= chunk_size for first, last in chunks
+        )
+
+    # The saved index is reused, and rebuilt when the file changes
+    assert load_pgn_index(str(path), headers=False).white_elo.any()
+    path.write_text(text + games[0])
+    index = load_pgn_index(str(path), headers=False)
+    assert len(index) == len(expected) + 1 and not index.white_elo.any() and not index.headers
+    assert os.path.exists(pgn_index_path(str(path)))
+
+    # An index saved without headers is rebuilt when they are asked for
+    index = load_pgn_index(str(path))
+    assert index.headers and index.white_elo.any() and index.plies[-1] == len(expected[0][1])
+    assert load_pgn_index(str(path), headers=False).headers
+
+
+def _filter_corpus() -> str:
+    # Random games with missing or malformed ratings and clocks, other variants and unfinished games
+    rng = random.Random(5)
+    texts = []
+    for number in range(60):
+        board = chess.Board()
+        for _ in range(rng.randint(20, 160)):
+            if board.is_game_over():
+                break
+            board.push(rng.choice(list(board.legal_moves)))
+        game = chess.pgn.Game.from_board(board)
+        game.headers["White"] = f"white{number}"
+        game.headers["Result"] = rng.choice(["1-0", "0-1", "1/2-1/2", "*"])
+        for key, values in (
+            ("WhiteElo", [None, "?", "1500", "2400", "2800"]),
+            ("BlackElo", [None, "", "2000", "2600"]),
+            ("TimeControl", [None, "-", "60+0", "120+1", "bad", "300", "180+0", "600+5"]),
+            ("Variant", [None, "Standard", "Chess960", "Crazyhouse"]),
+        ):
+            value = rng.choice(values)
+            if value is not None:
+                game.headers[key] = value
+        texts.append(str(game))
+    return "\n\n".join(texts) + "\n"
+
+
+def test_game_filter():
+    text = _filter_corpus()
+    games = []
+    stream = io.StringIO(text)
+    while (game := chess.pgn.read_game(stream)) is not None:
+        games.append((game.headers, len(list(game.mainline_moves()))))
+
+    def seconds(value):
+        if value == "-":
+            return float("inf")
+        base, _, increment = value.partition("+")
+        return int(base) + 40 * int(increment or 0) if base.isdigit() and (increment or "0").isdigit() else -1
+
+    def rating(headers, key):
+        return int(headers[key]) if headers.get(key, "").isdigit() else -1
+
+    # The games kept are the ones whose headers (as parsed by python-chess) qualify
+    for min_elo, min_time_control, results, min_plies, variant in (
+        (0, 0, None, 0, None),
+        (2000, 0, None, 0, "Standard"),
+        (0, 180, {"1-0", "0-1", "1/2-1/2"}, 0, "Standard"),
+        (1500, 300, None, 60, None),
+        (0, 0, None, 60, "Chess960"),
+        (0, 0, {"*"}, 100, None),
+    ):
+        game_filter = GameFilter(min_elo, min_time_control, results, min_plies, variant)
+        expected = [
+            headers["White"]
+            for headers, plies in games
+            if (not min_elo or min(rating(headers, "WhiteElo"), rating(headers, "BlackElo")) >= min_elo)
+            and (not min_time_control or seconds(headers.get("TimeControl", "")) >= min_time_control)
+            and (results is None or headers["Result"] in results)
+            and plies >= min_plies
+            and (variant is None or headers.get("Variant", "Standard") == variant)
+        ]
+        assert expected
+        kept = io.StringIO(filter_pgn(text, game_filter))
+        assert [game.headers["White"] for game in iter(lambda: chess.pgn.read_game(kept), None)] == expected
+
+
+def test_read_mainline():
+    # Comments, NAGs, nested variations and castling written with zeros (standard chess only)
+    text = GAMES_PGN + filter_pgn(_filter_corpus(), GameFilter()) + (
+        '[Event "E"]\n[Result "*"]\n\n1. e4 $1 { (not a variation) } e5 (1... c5 2. Nf3 (2. c3 d5) d6) 2. Nf3!? ; '
+        "rest of the line\nNc6 3. Bc4 Bc5 4. 0-0 Nf6 *\n\n"
+    )
+    expected, stream = [], io.StringIO(text)
+    while (game := chess.pgn.read_game(stream)) is not None:
+        expected.append((dict(game.headers), [move_code(move) for move in game.mainline_moves()]))
+
+    games = list(read_mainline(text))
+    assert [moves.tolist() for _, moves in games] == [moves for _, moves in expected]
+    assert expected[-1][1][-2:] == [move_code(chess.Move.from_uci("e1g1")), move_code(chess.Move.from_uci("g8f6"))]
+    # chess.pgn adds the missing tags of the seven tag roster
+    assert all(headers.items() <= full.items() for (headers, _), (full, _) in zip(games, expected))
+
+def test_extract_games(caplog):
+    # Games from a FEN position are skipped, and counted
+    with caplog.at_level("WARNING", logger="chess_jepa.pgn"):
+        games = list(extract_games(GAMES_PGN))
+    assert [result for _, result in games] == ["0-1", "1-0", "*"]
+    assert "Skipped 1 of 4 games" in caplog.text
+
+
+def test_read_mainline_truncated(caplog):
+    # Comments, NAGs, variations and an illegal move, the games read by chess.pgn written
+    # back without them give the same samples
+    text = GAMES_PGN + (
+        '[Event "E"]\n[White "A"]\n[Result "*"]\n\n1. e4 $1 {comment} e5 (1... c5 2. Nf3) 2. Nf3 Nc6 '
+        "3. Bb5 a6 4. Bxa6?! Ke7 5. Qh5 Ra8 6. O-O *\n\n"
+        '[Event "E"]\n[Result "1-0"]\n\n1. d4 d5 2. c4 {x} e6 (2... c6) 3. Nc3 $2 Nf6 1-0\n\n'
+    )
+    exported, stream = [], io.StringIO(text)
+    while (game := chess.pgn.read_game(stream)) is not None:
+        exported.append(game.accept(chess.pgn.StringExporter(comments=False, variations=False)) + "\n\n")
+    assert "Qh5" in text and "Qh5" not in exported[-2]
+    with caplog.at_level("WARNING", logger="chess_jepa.pgn"):
+        samples = list(extract_training_samples(text, window_size=3))
+    assert samples == list(extract_training_samples("".join(exported), window_size=3))
+    assert "Game A - ? (?) truncated after 8 plies" in caplog.text
+    assert f"Truncated 1 of {len(exported)} games" in caplog.text
@@ -0,0 +1,79 @@
+import os
+import random
+import subprocess
+import sys
+from pathlib import Path
+
+import chess
+import chess.pgn
+import numpy as np
+
+from chess_jepa.pgn import eval_split, extract_games, extract_training_tokens, game_hash
+from chess_jepa.storage import HEADER_SIZE, PackedGames, read_manifest, read_tokens, shard_paths
+from chess_jepa.tokenizer import sample_length
+
+SCRIPT = str(Path(__file__).parent.parent / "pgn_to_bin.py")
+
+
+def _random_games(count: int, seed: int) -> str:
+    rng = random.Random(seed)
+    games = []
+    for _ in range(count):
+        board = chess.Board()
+        for _ in range(rng.randint(5, 80)):
+            if board.is_game_over():
+                break
+            board.push(rng.choice(list(board.legal_moves)))
+        game = chess.pgn.Game.from_board(board)
+        game.headers["Result"] = board.result(claim_draw=False)
+        games.append(str(game))
+    return "\n\n".join(games) + "\n"
+
+
+def _convert(tmp_path, name: str, *options) -> tuple[str, str]:
+    train, eval = str(tmp_path / f"{name}-train.bin"), str(tmp_path / f"{name}-eval.bin")
+    command = [sys.executable, SCRIPT, "--pgn", str(tmp_path / "games.pgn"), "--train", train, "--eval", eval]
+    subprocess.run(command + ["--eval-fraction", "0.3", *options], check=True, capture_output=True)
+    return train, eval
+
+
+def test_train_eval_split(tmp_path):
+    text = _random_games(40, seed=3)
+    (tmp_path / "games.pgn").write_text(text)
+    window_size = 7  # Of pgn_to_bin.py
+
+    # Every sample of a game goes to the split of its game, in file order
+    games = [moves for moves, _ in extract_games(text)]
+    evaluated = eval_split([game_hash(moves) for moves in games], 0.3)
+    assert 0 < evaluated.sum() < len(games)
+    tokens = [game.copy() for game in extract_training_tokens(text, window_size, dtype=np.uint8)]
+    expected = [np.concatenate([game for game, use in zip(tokens, evaluated) if use == split]) for split in (False, True)]
+
+    # Small shards and buffers, written in the background: the same samples
+    shard_size = HEADER_SIZE + 50 * sample_length(window_size)
+    small = ["--shard-size", str(shard_size), "--buffer-size", "1000", "--background-writer"]
+    for options in ([], small):
+        outputs = _convert(tmp_path, "small" if options else "default", *options)
+        for path, rows in zip(outputs, expected):
+            shards = shard_paths(path)
+            assert np.array_equal(np.concatenate([read_tokens(shard) for shard in shards]), rows)
+            assert read_manifest(path)["records"] == len(rows)
+            if options:
+                assert len(shards) > 1 and all(os.path.getsize(shard) <= shard_size for shard in shards)
+
+    # Games go to the same split as their samples
+    for path, split in zip(_convert(tmp_path, "games", "--format", "games", *small), (False, True)):
+        shards = [PackedGames(shard) for shard in shard_paths(path)]
+        stored = [packed.moves(index).tolist() for packed in shards for index in range(len(packed))]
+        assert stored == [moves.tolist() for moves, use in zip(games, evaluated) if use == split]
+
+
+def test_resume_options(tmp_path):
+    (tmp_path / "games.pgn").write_text(_random_games(10, seed=4))
+    train, eval = _convert(tmp_path, "resume", "--max-games", "5")
+    assert os.path.exists(train + ".progress")
+
+    # A run written without evaluation targets is not continued with them
+    command = [sys.executable, SCRIPT, "--pgn", str(tmp_path / "games.pgn"), "--train", train, "--eval", eval]
+    process = subprocess.run(command + ["--resume", "--evals", str(tmp_path / "evals.bin")], capture_output=True, text=True)
+    assert process.returncode != 0 and "without --evals" in process.stderr
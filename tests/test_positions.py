@@ -0,0 +1,73 @@
+import collections
+import io
+
+import chess
+import chess.pgn
+import numpy as np
+
+from chess_jepa.pgn import board_state, extract_training_tokens, move_code, read_mainline
+from chess_jepa.positions import PositionIndex, PositionIndexBuilder, position_hashes
+
+# Transpositions, en passant (legal or not) and a FEN start
+PGN = """[Event "Test"]
+[Result "1-0"]
+
+1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 1-0
+
+[Event "Test"]
+[Result "1/2-1/2"]
+
+1. Nf3 Nc6 2. e4 e5 3. d4 exd4 1/2-1/2
+
+[Event "Test"]
+[Result "0-1"]
+
+1. e4 d5 2. e5 f5 3. exf6 e6 0-1
+
+[Event "Test"]
+[Result "*"]
+[FEN "4k3/8/8/8/3p4/8/4P3/4K3 w - - 0 1"]
+[SetUp "1"]
+
+1. e4 dxe3 *
+"""
+
+
+def test_position_index(tmp_path):
+    games = list(read_mainline(PGN))
+    path = str(tmp_path / "positions")
+    builder = PositionIndexBuilder(path, bucket_bits=2, buffer_records=8)
+    starts = [board_state(chess.pgn.Headers(headers).board()) if "FEN" in headers else None for headers, _ in games]
+    builder.add_games([moves for _, moves in games], [headers["Result"] for headers, _ in games], starts)
+    builder.finalize()
+    index = PositionIndex(path)
+
+    # Tally of python-chess, by EPD (legal en passant square only, as board_state)
+    visits, results, next_moves = collections.Counter(), collections.defaultdict(collections.Counter), {}
+    boards = {}
+    stream = io.StringIO(PGN)
+    while (game := chess.pgn.read_game(stream)) is not None:
+        board = game.board()
+        for move in game.mainline_moves():
+            epd = board.epd()
+            boards[epd] = board_state(board)
+            visits[epd] += 1
+            results[epd][game.headers["Result"]] += 1
+            next_moves.setdefault(epd, collections.Counter())[move_code(move)] += 1
+            board.push(move)
+    assert len(index) == len(visits)
+
+    found = index.lookup(position_hashes(np.array(list(boards.values()), dtype=np.uint64)))
+    for epd, record in zip(boards, found):
+        assert record["visits"] == visits[epd]
+        assert (record["white"], record["draws"], record["black"]) == tuple(
+            results[epd][result] for result in ("1-0", "1/2-1/2", "0-1")
+        )
+        moves = index.moves(int(record["key"]))
+        assert dict(zip(moves["move"].tolist(), moves["count"].tolist())) == next_moves[epd]
+        assert moves["count"].tolist() == sorted(moves["count"].tolist(), reverse=True)
+
+    # Samples are looked up on their board tokens, the first one of every game is its start
+    tokens = np.stack([game_tokens[0].copy() for game_tokens in extract_training_tokens(PGN, 3, dtype=np.uint8)])
+    first = index.lookup_samples(tokens, window_size=3)
+    assert first["visits"].tolist() == [3, 3, 3, 1]
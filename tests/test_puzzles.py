@@ -0,0 +1,26 @@
+import numpy as np
+
+from chess_jepa.puzzles import PuzzleFilter, extract_puzzle_samples, extract_puzzle_tokens
+from chess_jepa.tokenizer import encode_batch
+
+PUZZLES = """PuzzleId,FEN,Moves,Rating,RatingDeviation,Popularity,NbPlays,Themes,GameUrl,OpeningTags
+00008,r6k/pp2r2p/4Rp1Q/3p4/8/1N1P2R1/PqP2bPP/7K b - - 0 24,f2g3 e6e7 b2b1 b3c1 b1c1 h6c1,1913,75,94,6230,crushing hangingPiece long middlegame,https://lichess.org/787zsVup/black#48,
+0000D,5rk1/1p3ppp/pq3b2/8/8/1P1Q1N2/P4PPP/3R2K1 w - - 2 27,d3d6 f8d8 d6d8 f6d8,1426,500,-11,4,advantage endgame short,https://lichess.org/F8M8OS71#53,
+"""
+
+
+def test_puzzle_samples():
+    samples = list(extract_puzzle_samples(PUZZLES, window_size=3))
+    assert samples[1] == "_ _ d3d6 5rk1/1p3ppp/pq1Q1b2/8/8/1P3N2/P4PPP/3R2K1 b - - f8d8 d6d8 f6d8"
+    # Solutions longer than the window are cut
+    assert samples[0].split()[-3:] == ["e6e7", "b2b1", "b3c1"]
+
+    tokens, hashes = extract_puzzle_tokens(PUZZLES, window_size=3)
+    assert np.array_equal(tokens, encode_batch(samples, dtype=np.uint8))
+    assert len(set(hashes.tolist())) == 2
+
+
+def test_puzzle_filter():
+    assert len(list(extract_puzzle_samples(PUZZLES, puzzle_filter=PuzzleFilter(min_rating=1500)))) == 1
+    assert len(list(extract_puzzle_samples(PUZZLES, puzzle_filter=PuzzleFilter(themes={"endgame"})))) == 1
+    assert len(list(extract_puzzle_samples(PUZZLES, puzzle_filter=PuzzleFilter(exclude_themes={"short", "long"})))) == 0
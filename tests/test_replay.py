@@ -0,0 +1,87 @@
+import random
+
+import chess
+import chess.pgn
+import numpy as np
+import pytest
+
+from chess_jepa.pgn import board_state, move_code, read_mainline
+from chess_jepa.replay import replay_games
+
+# Start position and moves (UCI) of games covering the special moves
+GAMES = [
+    # Castling on both sides, en passant captures
+    (chess.STARTING_FEN, "e2e4 a7a6 e4e5 d7d5 e5d6 c7d6 g1f3 b8c6 f1e2 c8f5 e1g1 d8d7 d2d4 e8c8 d4d5 e7e5 d5e6"),
+    # Rights lost when a rook or the king moves, promotions (captures and underpromotions)
+    (chess.STARTING_FEN, "b2b4 g7g5 b4b5 g5g4 b5b6 g4g3 b6a7 g3h2 a7b8n h2g1r h1g1 a8a7 b8c6 d7c6 d2d3 e8d7"),
+    # En passant square only when the capture is legal: the pawn is pinned on the rank
+    ("8/2p5/8/KP5r/8/8/8/7k b - - 0 1", "c7c5 a5a4"),
+    # Pinned on a diagonal, and two pawns that can capture en passant
+    ("8/8/B7/8/2p5/3k4/1P6/7K w - - 0 1", "b2b4 d3d2 h1g1 c4c3"),
+    ("4k3/8/8/8/2p1p3/8/3P4/4K2b w - - 0 1", "d2d4 e4d3"),
+    # Rights lost when a rook is captured by a promotion, castling from a FEN start
+    ("r2nk2r/1P6/8/8/8/8/1p3P2/R3K2R w KQkq - 0 1", "b7a8q e8g8 e1g1 b2a1n"),
+]
+
+
+def _expected(fen: str, moves: list[chess.Move]) -> np.ndarray:
+    board = chess.Board(fen)
+    states = [board_state(board)]
+    for move in moves:
+        assert board.is_legal(move)
+        board.push(move)
+        states.append(board_state(board))
+    return np.array(states, dtype=np.uint64)
+
+
+def _random_games(count: int, seed: int) -> list:
+    # Random legal games of different lengths
+    rng = random.Random(seed)
+    games = []
+    for _ in range(count):
+        board = chess.Board()
+        while not board.is_game_over() and board.ply() < rng.randint(20, 250):
+            board.push(rng.choice(list(board.legal_moves)))
+        games.append((chess.STARTING_FEN, " ".join(move.uci() for move in board.move_stack)))
+    return games
+
+
+def test_replay_games():
+    games = GAMES + _random_games(40, seed=0)
+    moves = [[chess.Move.from_uci(move) for move in uci.split()] for _, uci in games]
+    codes = [np.array([move_code(move) for move in game], dtype=np.uint16) for game in moves]
+    starts = np.array([board_state(chess.Board(fen)) for fen, _ in games], dtype=np.uint64)
+    expected = [_expected(fen, game) for (fen, _), game in zip(games, moves)]
+
+    # All the games together (vectorized) and one by one (Python integers)
+    states, offsets = replay_games(codes, starts)
+    assert offsets.tolist() == np.cumsum([0] + [len(game) + 1 for game in codes]).tolist()
+    for index, game in enumerate(expected):
+        assert np.array_equal(states[offsets[index] : offsets[index + 1]], game)
+        single, _ = replay_games([codes[index]], starts[index])
+        assert np.array_equal(single, game)
+
+    # From the standard starting position without starts
+    standard = [index for index, (fen, _) in enumerate(games) if fen == chess.STARTING_FEN]
+    states, offsets = replay_games([codes[index] for index in standard])
+    assert np.array_equal(states, np.concatenate([expected[index] for index in standard]))
+
+
+def test_chess960_castling(caplog):
+    # python-chess writes Chess960 castling as the king taking its rook (e1h1, not e1g1)
+    board = chess.Board.from_chess960_pos(518)
+    for san in "e4 e5 Nf3 Nf6 Bc4 Bc5 O-O".split():
+        board.push_san(san)
+    assert board.move_stack[-1] == chess.Move.from_uci("e1h1")
+    codes = np.array([move_code(move) for move in board.move_stack], dtype=np.uint16)
+    for count in (1, 40):
+        with pytest.raises(ValueError, match="Chess960"):
+            replay_games([codes] * count)
+
+    # Chess960 games are skipped by the readers, with a warning
+    game = chess.pgn.Game.from_board(board)
+    game.headers["Variant"] = "Chess960"
+    text = str(game) + "\n\n" + str(chess.pgn.Game.from_board(chess.Board())) + "\n"
+    with caplog.at_level("WARNING", logger="chess_jepa.pgn"):
+        assert len(list(read_mainline(text))) == 1
+    assert "Skipped 1 Chess960 games" in caplog.text
@@ -0,0 +1,124 @@
+import os
+
+import numpy as np
+import pytest
+
+from chess_jepa.storage import (
+    HEADER_SIZE,
+    GameWriter,
+    PackedGames,
+    ShardedWriter,
+    TokenFileHeader,
+    TokenWriter,
+    read_header,
+    read_manifest,
+    read_tokens,
+    shard_paths,
+)
+
+
+def test_token_file(tmp_path):
+    path = str(tmp_path / "tokens.bin")
+    header = TokenFileHeader(window_size=5, sample_length=7, dtype=np.uint16)
+    assert TokenFileHeader.unpack(header.pack()) == header and len(header.pack()) == HEADER_SIZE
+
+    # Samples read back as written, memory mapped or not, a partial sample is dropped
+    rows = np.arange(70, dtype=np.uint16).reshape(10, 7) * 300
+    with TokenWriter(path, 5, 7, dtype=np.uint16) as writer:
+        writer.write(rows[:6])
+    with open(path, "ab") as file:
+        file.write(b"\x01\x02\x03")
+    with TokenWriter(path, 5, 7, dtype=np.uint16, append=True) as writer:
+        writer.write(rows[6:])
+    assert read_header(path) == header
+    assert np.array_equal(read_tokens(path), rows) and np.array_equal(read_tokens(path, mmap=False), rows)
+
+    # Files of another header or vocabulary are rejected
+    with pytest.raises(ValueError, match="different header"):
+        TokenWriter(path, 5, 7, dtype=np.uint8, append=True)
+    with open(path, "r+b") as file:
+        file.write(TokenFileHeader(5, 7, np.uint16, vocabulary_hash=header.vocabulary_hash ^ 1).pack())
+    with pytest.raises(ValueError, match="different vocabulary"):
+        read_tokens(path)
+    assert np.array_equal(read_tokens(path, check_vocabulary=False), rows)
+    with pytest.raises(ValueError, match="wrong magic"):
+        TokenFileHeader.unpack(bytes(HEADER_SIZE))
+
+
+def _open_shard(path, append):
+    return TokenWriter(path, window_size=1, sample_length=4, append=append)
+
+
+def test_sharded_writer_resume(tmp_path):
+    path = str(tmp_path / "train.bin")
+    rows = np.arange(40, dtype=np.uint8).reshape(10, 4)
+    shard_size = HEADER_SIZE + 3 * 4
+
+    # Shards are written under a partial name, the manifest lists the complete ones only
+    output = ShardedWriter(path, _open_shard, shard_size)
+    output.write_rows(rows[:4])
+    output.flush()
+    state = output.state()
+    assert sorted(os.listdir(tmp_path)) == ["train-00000.bin", "train-00001.bin.partial", "train.bin.manifest.json"]
+    assert read_manifest(path)["records"] == 3
+
+    # Rows written after the state are dropped when continuing from it (the second shard was
+    # completed after the state, it is reopened)
+    output.write_rows(np.full((5, 4), 255, dtype=np.uint8))
+    output.flush()
+    output = ShardedWriter(path, _open_shard, shard_size, state)
+    output.write_rows(rows[4:])
+    output.close()
+    assert sorted(os.listdir(tmp_path)) == [f"train-0000{number}.bin" for number in range(4)] + ["train.bin.manifest.json"]
+    assert np.array_equal(np.concatenate([read_tokens(shard) for shard in shard_paths(path)]), rows)
+
+
+def test_sharded_writer_error(tmp_path):
+    path = str(tmp_path / "train.bin")
+    rows = np.arange(40, dtype=np.uint8).reshape(10, 4)
+    shard_size = HEADER_SIZE + 3 * 4
+    output = ShardedWriter(path, _open_shard, shard_size)
+    output.write_rows(rows[:4])
+    output.flush()
+    state = output.state()
+    files = {name: (tmp_path / name).read_bytes() for name in os.listdir(tmp_path)}
+
+    # An error leaves the complete shards and the manifest as they were, the last shard partial
+    with pytest.raises(RuntimeError):
+        with ShardedWriter(path, _open_shard, shard_size, state) as output:
+            output.write_rows(np.full((2, 4), 255, dtype=np.uint8))
+            raise RuntimeError("interrupted")
+    assert sorted(os.listdir(tmp_path)) == sorted(files)
+    assert all((tmp_path / name).read_bytes() == data for name, data in files.items() if not name.endswith(".partial"))
+
+    # Continued from the state
+    with ShardedWriter(path, _open_shard, shard_size, state) as output:
+        output.write_rows(rows[4:])
+    assert read_manifest(path)["records"] == 10
+    assert np.array_equal(np.concatenate([read_tokens(shard) for shard in shard_paths(path)]), rows)
+
+
+def test_packed_games_table(tmp_path):
+    path = str(tmp_path / "games.bin")
+    games = [([1, 2, 3], "1-0"), ([], "*"), ([7], "0-1"), ([4, 5], "1/2-1/2")]
+
+    def read(path):
+        packed = PackedGames(path)
+        return [(packed.moves(index).tolist(), packed.result(index)) for index in range(len(packed))]
+
+    # An interrupted write (no table, a partial record) is scanned, the partial record dropped
+    writer = GameWriter(path)
+    for moves, result in games[:2]:
+        writer.write(np.array(moves, dtype=np.uint16), result)
+    writer.flush()
+    with open(path, "ab") as file:
+        file.write(b"\x05\x00\x01")
+    assert read(path) == games[:2]
+
+    # Appending continues after the complete records, the table of the closed file covers every game
+    for games_written in (3, 4):
+        with GameWriter(path, append=True) as writer:
+            writer.write(np.array(games[games_written - 1][0], dtype=np.uint16), games[games_written - 1][1])
+        assert read(path) == games[:games_written]
+    packed = PackedGames(path)
+    assert packed.starts.tolist() == [2, 7, 9, 12] and len(packed.data) == 14
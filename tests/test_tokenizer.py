@@ -1,4 +1,8 @@
-from chess_jepa.tokenizer import encode, decode, default_vocabulary
+import chess
+import numpy as np
+
+from chess_jepa.pgn import extract_training_samples
+from chess_jepa.tokenizer import decode, decode_batch, default_vocabulary, encode, encode_batch
 
 
 def test_vocabulary():
@@ -34,3 +38,46 @@ def test_typical_training_example():
 
     encoded = encode(past_uci + " " + input_fen + " " + future_uci)
     assert decode(encoded).replace("_", "") == expected
+
+
+def test_encode_batch():
+    pgn = """[Event "Test"]
+[Result "1/2-1/2"]
+
+1. e4 d5 2. exd5 c6 3. dxc6 Qb6 4. cxb7 Qxb2 5. bxa8=N Qxa1 6. Nf3 e5 7. Be2 e4 8. d4 exd3 9. O-O Nf6 1/2-1/2
+
+[Event "Test"]
+[Result "*"]
+[FEN "4k3/1P6/8/8/8/8/6p1/4K3 w - - 0 1"]
+[SetUp "1"]
+
+1. b8=R+ Kd7 2. Kf2 g1=Q+ *
+"""
+    for window_size in (1, 3, 5):
+        samples = list(extract_training_samples(pgn, window_size=window_size))
+        expected = np.array([encode(sample) for sample in samples])
+        assert np.array_equal(encode_batch(samples), expected)
+
+        # Into a preallocated array of a smaller dtype
+        out = np.zeros((len(samples), expected.shape[1]), dtype=np.uint8)
+        assert encode_batch(samples, dtype=np.uint8, out=out) is out
+        assert np.array_equal(out, expected)
+
+    masked = ["_ _ <s> e2e4 ? b8c6 rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - e1g1 e8g8q <1-0> _ _"]
+    assert encode_batch(masked).tolist() == [encode(masked[0])]
+
+
+def test_decode_batch_round_trip():
+    pgn = """[Event "Test"]
+[Result "0-1"]
+
+1. e4 d5 2. exd5 c6 3. dxc6 Qb6 4. cxb7 Qxb2 5. bxa8=Q Qxa1 6. Nf3 e5 7. d4 e4 8. O-O exf3 0-1
+"""
+    samples = list(extract_training_samples(pgn, window_size=3))
+    tokens = encode_batch(samples, dtype=np.uint8)
+
+    decoded = decode_batch(tokens, window_size=3)
+    assert [" ".join(before + [fen] + after) for before, fen, after in decoded] == samples
+    assert decoded[0] == (["_", "_", "<s>"], "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq -", ["e2e4", "_", "_"])
+    assert decoded[-1][2] == ["<0-1>", "_", "_"]
+    assert chess.Board(decoded[-1][1]).is_valid()